@@ -31,6 +31,10 @@ urlpatterns += geocamTiePointPatterns
 urlpatterns = urlpatterns + patterns('',
     (r'^static/(?P<path>.*)$', 'django.views.static.serve',
         {'document_root': settings.MEDIA_ROOT}),
+    # the dev server sends all tile store urls to the tile view, which reads
+    # the tile store itself and generates and stores missing tiles
+    (r'^data/geocamTiePoint/tiles/(?P<quadTreeId>\d+)/(?P<zoom>\d+)/(?P<x>\d+)/(?P<y>[^/]+)$',
+        'geocamTiePoint.views.getTile'),
     (r'^data/(?P<path>.*)$', 'django.views.static.serve',
         {'document_root': settings.DATA_ROOT}),
     )
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Compares the peak memory use of the in-memory and temp-file export
+writers when writing a tarball of many incompressible tiles. Each writer
+runs in its own child process so the peak RSS figures are independent.
+"""
+
+import os
+import time
+import resource
+import multiprocessing
+
+from geocamTiePoint import quadTree
+
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+def getPeakRssMegabytes():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def writeTiles(writer, numTiles, tileSize):
+    tile = os.urandom(tileSize)
+    for i in xrange(numTiles):
+        writer.writeData('tiles/%d.png' % i, tile)
+
+
+def copyToDevNull(fileObj):
+    # stands in for the storage backend reading the saved file in chunks
+    with open(os.devnull, 'wb') as out:
+        while True:
+            chunk = fileObj.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            out.write(chunk)
+
+
+def runInMemory(numTiles, tileSize):
+    writer = quadTree.TarWriter('benchmark')
+    writeTiles(writer, numTiles, tileSize)
+    # the old export path copied the archive into a ContentFile
+    data = writer.getData()
+    return len(data)
+
+
+def runTempFile(numTiles, tileSize):
+    writer = quadTree.TempFileTarWriter('benchmark')
+    writeTiles(writer, numTiles, tileSize)
+    exportFile = writer.getFile()
+    copyToDevNull(exportFile)
+    size = exportFile.tell()
+    exportFile.close()
+    return size
+
+
+def runInChild(name, func, numTiles, tileSize, resultQueue):
+    baseline = getPeakRssMegabytes()
+    startTime = time.time()
+    size = func(numTiles, tileSize)
+    elapsed = time.time() - startTime
+    resultQueue.put((name, size, elapsed, getPeakRssMegabytes() - baseline))
+
+
+def benchmarkExportWriters(numTiles, tileSize):
+    resultQueue = multiprocessing.Queue()
+    for name, func in (('in-memory', runInMemory),
+                       ('temp-file', runTempFile)):
+        proc = multiprocessing.Process(target=runInChild,
+                                       args=(name, func, numTiles, tileSize, resultQueue))
+        proc.start()
+        name, size, elapsed, peakRss = resultQueue.get()
+        proc.join()
+        print ('%-10s archive %7.1f MB  time %6.2f s  peak RSS growth %7.1f MB'
+               % (name, size / 1e6, elapsed, peakRss))
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser('usage: benchmarkExportWriters.py')
+    parser.add_option('-n', '--numTiles',
+                      type='int', default=5000,
+                      help='Number of tiles to write [%default]')
+    parser.add_option('-s', '--tileSize',
+                      type='int', default=40000,
+                      help='Size of each tile in bytes [%default]')
+    opts, args = parser.parse_args()
+    if args:
+        parser.error('expected no args')
+    benchmarkExportWriters(opts.numTiles, opts.tileSize)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Times per-tile MESH construction for quadratic transforms, comparing
+the fixed 8x8 point-at-a-time loop that getPilTransformArgsGeneral()
+used to run against the current adaptive mesh. Also reports the number
+of patches per tile and the mean pixel difference of each warp from a
+reference warp through a dense 2-pixel mesh.
+"""
+
+import math
+import time
+
+import numpy
+from PIL import Image
+
+from geocamTiePoint import quadTree, transform
+from geocamTiePoint.quadTree import TILE_SIZE, tileIndexToPixels, intMap, flatten
+
+PATCH_SIZE = 32
+PATCHES_PER_TILE = int(TILE_SIZE / PATCH_SIZE)
+PATCH_ZOOM_OFFSET = math.log(PATCHES_PER_TILE, 2)
+
+TRANSFORM_DICTS = {
+    'mild': {'type': 'quadratic',
+             'matrix': [[2.0, 0.0, 20000.0, 0.0, -3000000.0],
+                        [0.0, -1.5, 0.0, -20000.0, 5000000.0],
+                        [0.0, 0.0, 0.0, 0.0, 1.0]]},
+    'strong': {'type': 'quadratic',
+               'matrix': [[20.0, 0.0, 20000.0, 0.0, -3000000.0],
+                          [0.0, -15.0, 0.0, -20000.0, 5000000.0],
+                          [0.0, 0.0, 0.0, 0.0, 1.0]]},
+}
+
+
+def getPilTransformArgsGeneralLoop(gen, zoom, x, y):
+    """
+    The original nested-loop mesh construction, kept for comparison.
+    """
+    doublePatchSize = PATCH_SIZE * 2
+    meshPatches = []
+
+    patchTable = {}
+    for px in xrange(PATCHES_PER_TILE + 1):
+        for py in xrange(PATCHES_PER_TILE + 1):
+            targetPatchOrigin = tileIndexToPixels(x * PATCHES_PER_TILE + px,
+                                                  y * PATCHES_PER_TILE + py)
+            mercatorPatchOrigin = transform.pixelsToMeters(targetPatchOrigin[0],
+                                                           targetPatchOrigin[1],
+                                                           zoom + PATCH_ZOOM_OFFSET)
+            sourcePatchOrigin = intMap(gen.transform.reverse(mercatorPatchOrigin))
+            patchTable[(px, py)] = sourcePatchOrigin
+
+    for px in xrange(PATCHES_PER_TILE):
+        for py in xrange(PATCHES_PER_TILE):
+            corners = ((px, py),
+                       (px, py + 1),
+                       (px + 1, py + 1),
+                       (px + 1, py))
+            sourcePatchCorners = [patchTable[corner]
+                                  for corner in corners]
+            if any([c is None
+                    for c in sourcePatchCorners]):
+                continue
+            xoff = px * doublePatchSize
+            yoff = py * doublePatchSize
+            targetBox = (xoff,
+                         yoff,
+                         xoff + doublePatchSize,
+                         yoff + doublePatchSize)
+            meshPatches.append([targetBox, flatten(sourcePatchCorners)])
+
+    return ((int(TILE_SIZE * 2),) * 2,
+            Image.MESH,
+            meshPatches,
+            Image.BICUBIC)
+
+
+def timePerTile(func, tiles, numRepeats):
+    startTime = time.time()
+    for _ in xrange(numRepeats):
+        for tile in tiles:
+            func(*tile)
+    return (time.time() - startTime) / (numRepeats * len(tiles))
+
+
+def getTileDifference(gen, transformArgs, otherTransformArgs):
+    pixels = numpy.asarray(gen.image.transform(*transformArgs), dtype='float64')
+    otherPixels = numpy.asarray(gen.image.transform(*otherTransformArgs), dtype='float64')
+    return numpy.abs(pixels - otherPixels).mean()
+
+
+def getReferenceTransformArgs(gen, zoom, x, y):
+    saved = quadTree.MESH_MAX_ERROR_PIXELS, quadTree.MESH_MIN_PATCH_SIZE
+    quadTree.MESH_MAX_ERROR_PIXELS, quadTree.MESH_MIN_PATCH_SIZE = 0, 2
+    try:
+        return gen.getPilTransformArgsGeneral(zoom, x, y)
+    finally:
+        quadTree.MESH_MAX_ERROR_PIXELS, quadTree.MESH_MIN_PATCH_SIZE = saved
+
+
+def benchmarkMeshConstruction(name, zoom, numRepeats):
+    image = Image.new('RGBA', (640, 480))
+    for i in xrange(0, 640, 8):
+        image.paste((255, 255, 255, 255), (i, 0, i + 4, 480))
+    gen = quadTree.WarpedQuadTreeGenerator('benchmark', image, TRANSFORM_DICTS[name])
+    zoom = min(zoom, int(gen.maxZoom))
+    tiles = gen.getTilesAtZoom(zoom)
+
+    loopTime = timePerTile(lambda *tile: getPilTransformArgsGeneralLoop(gen, *tile),
+                           tiles, numRepeats)
+    adaptiveTime = timePerTile(gen.getPilTransformArgsGeneral, tiles, numRepeats)
+
+    referenceArgs = [getReferenceTransformArgs(gen, *tile) for tile in tiles]
+    print '%s transform, zoom %d, %d tiles' % (name, zoom, len(tiles))
+    for label, func, elapsed in (('fixed 8x8 loop', getPilTransformArgsGeneralLoop, loopTime),
+                                 ('adaptive', quadTree.WarpedQuadTreeGenerator.getPilTransformArgsGeneral,
+                                  adaptiveTime)):
+        args = [func(gen, *tile) for tile in tiles]
+        numPatches = numpy.mean([len(a[2]) for a in args])
+        difference = numpy.mean([getTileDifference(gen, a, ref)
+                                 for a, ref in zip(args, referenceArgs)])
+        print ('  %-15s %8.3f ms/tile  %5.1f patches/tile  mean abs difference from reference %.2f'
+               % (label + ':', 1000 * elapsed, numPatches, difference))
+
+def main():
+    import optparse
+    parser = optparse.OptionParser('usage: benchmarkMeshConstruction.py')
+    parser.add_option('-z', '--zoom',
+                      type='int', default=99,
+                      help='Zoom level to benchmark, clamped to the max zoom [%default]')
+    parser.add_option('-r', '--repeats',
+                      type='int', default=3,
+                      help='Number of passes over the tiles [%default]')
+    opts, args = parser.parse_args()
+    if args:
+        parser.error('expected no args')
+    for name in sorted(TRANSFORM_DICTS.keys()):
+        benchmarkMeshConstruction(name, opts.zoom, opts.repeats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Times warped tile generation at each zoom level for each tile quality
+mode, and reports the mean pixel difference of the tiles from a reference
+warped at 4x resolution and downsampled.
+"""
+
+import time
+import random
+
+import numpy
+from PIL import Image
+
+from geocamTiePoint import quadTree
+from geocamTiePoint.quadTree import TILE_SIZE, TILE_QUALITY_CHOICES
+
+REFERENCE_SUPERSAMPLE = 4
+
+TRANSFORM_DICTS = {
+    'projective': {'type': 'projective',
+                   'matrix': [[2000.0, 100.0, -3000000.0],
+                              [50.0, -2000.0, 5000000.0],
+                              [0.0, 0.0, 1.0]]},
+    'quadratic': {'type': 'quadratic',
+                  'matrix': [[0.02, 0.0, 2000.0, 100.0, -3000000.0],
+                             [0.0, -0.015, 50.0, -2000.0, 5000000.0],
+                             [0.0, 0.0, 0.0, 0.0, 1.0]]},
+}
+
+
+def getTestImage(width, height):
+    # noise plus fine stripes, which alias badly if sampled carelessly
+    numpy.random.seed(0)
+    pixels = numpy.random.randint(0, 64, (height, width, 4)).astype('uint8')
+    pixels[:, ::4, :3] = 255
+    pixels[:, :, 3] = 255
+    return Image.fromarray(pixels, 'RGBA')
+
+
+def getReferenceTile(gen, zoom, x, y):
+    transformArgs = gen.getPilTransformArgs(zoom, x, y, int(TILE_SIZE * REFERENCE_SUPERSAMPLE))
+    return (gen.image.transform(*transformArgs)
+            .resize((int(TILE_SIZE),) * 2, Image.ANTIALIAS))
+
+
+def getTileDifference(tile, otherTile):
+    return numpy.abs(numpy.asarray(tile, dtype='float64')
+                     - numpy.asarray(otherTile, dtype='float64')).mean()
+
+
+def benchmarkTileQuality(name, image, maxTilesPerZoom):
+    gens = dict([(quality, quadTree.WarpedQuadTreeGenerator('benchmark', image,
+                                                            TRANSFORM_DICTS[name], quality))
+                 for quality in TILE_QUALITY_CHOICES])
+    refGen = gens[TILE_QUALITY_CHOICES[0]]
+    random.seed(0)
+
+    print '%s transform, max zoom %d' % (name, refGen.maxZoom)
+    print '  %4s  %-10s %10s  %s' % ('zoom', 'quality', 'ms/tile', 'mean abs difference from reference')
+    for zoom in xrange(int(refGen.maxZoom) + 1):
+        tiles = refGen.getTilesAtZoom(zoom)
+        tiles = random.sample(tiles, min(maxTilesPerZoom, len(tiles)))
+        references = [getReferenceTile(refGen, *tile) for tile in tiles]
+        for quality in TILE_QUALITY_CHOICES:
+            gen = gens[quality]
+            startTime = time.time()
+            results = [gen.generateTile(*tile) for tile in tiles]
+            elapsed = (time.time() - startTime) / len(tiles)
+            difference = numpy.mean([getTileDifference(result, reference)
+                                     for result, reference in zip(results, references)])
+            print '  %4d  %-10s %10.1f  %.2f' % (zoom, quality, 1000 * elapsed, difference)
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser('usage: benchmarkTileQuality.py')
+    parser.add_option('-s', '--size',
+                      default='2000x1500',
+                      help='Source image size [%default]')
+    parser.add_option('-n', '--maxTilesPerZoom',
+                      type='int', default=8,
+                      help='Max number of tiles to sample at each zoom [%default]')
+    opts, args = parser.parse_args()
+    if args:
+        parser.error('expected no args')
+    width, height = [int(v) for v in opts.size.split('x')]
+    image = getTestImage(width, height)
+    for name in sorted(TRANSFORM_DICTS.keys()):
+        benchmarkTileQuality(name, image, opts.maxTilesPerZoom)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Compares warped tile latency at each zoom level when the source is a
+full in-memory PIL image versus a tiled multi-resolution raster.
+"""
+
+import time
+import random
+import shutil
+import tempfile
+
+import numpy
+from PIL import Image
+
+from geocamTiePoint import quadTree, tiledRaster
+
+TRANSFORM_DICT = {'type': 'projective',
+                  'matrix': [[30.0, 2.0, -300000.0],
+                             [1.0, -30.0, 500000.0],
+                             [0.0, 0.0, 1.0]]}
+
+
+def getTestImage(width, height):
+    numpy.random.seed(0)
+    pixels = numpy.random.randint(0, 256, (height, width, 4)).astype('uint8')
+    pixels[:, :, 3] = 255
+    return Image.fromarray(pixels, 'RGBA')
+
+
+def timeTiles(gen, tiles):
+    startTime = time.time()
+    for tile in tiles:
+        gen.generateTile(*tile)
+    return (time.time() - startTime) / len(tiles)
+
+
+def benchmarkTiledSource(width, height, maxTilesPerZoom, quality):
+    image = getTestImage(width, height)
+    rasterDir = tempfile.mkdtemp()
+    try:
+        startTime = time.time()
+        rasterPath = rasterDir + '/raster'
+        tiledRaster.writeTiledRaster(image, rasterPath)
+        print 'wrote %dx%d tiled raster in %.1f s' % (width, height, time.time() - startTime)
+
+        imageGen = quadTree.WarpedQuadTreeGenerator('image', image, TRANSFORM_DICT, quality)
+        tiledGen = quadTree.WarpedQuadTreeGenerator('tiled', tiledRaster.TiledRaster(rasterPath),
+                                                    TRANSFORM_DICT, quality)
+        random.seed(0)
+        print '  %4s  %12s  %12s' % ('zoom', 'image ms/tile', 'tiled ms/tile')
+        for zoom in xrange(int(imageGen.maxZoom) + 1):
+            tiles = imageGen.getTilesAtZoom(zoom)
+            tiles = random.sample(tiles, min(maxTilesPerZoom, len(tiles)))
+            print '  %4d  %12.1f  %12.1f' % (zoom,
+                                            1000 * timeTiles(imageGen, tiles),
+                                            1000 * timeTiles(tiledGen, tiles))
+    finally:
+        shutil.rmtree(rasterDir)
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser('usage: benchmarkTiledSource.py')
+    parser.add_option('-s', '--size',
+                      default='7200x7200',
+                      help='Source image size [%default]')
+    parser.add_option('-n', '--maxTilesPerZoom',
+                      type='int', default=4,
+                      help='Max number of tiles to sample at each zoom [%default]')
+    parser.add_option('-q', '--quality',
+                      default=quadTree.TILE_QUALITY_HIGH,
+                      help='Tile quality mode [%default]')
+    opts, args = parser.parse_args()
+    if args:
+        parser.error('expected no args')
+    width, height = [int(v) for v in opts.size.split('x')]
+    benchmarkTiledSource(width, height, opts.maxTilesPerZoom, opts.quality)
+
+
+if __name__ == '__main__':
+    main()
@@ -86,3 +86,119 @@ GEOCAM_TIE_POINT_LICENSE_CHOICES = (
 # aligned tiles from public overlays can be viewed by any non-logged-in
 # user, even though the app is in private beta.
 GEOCAM_TIE_POINT_PUBLIC_BY_DEFAULT = True
+
+# where ISS photo metadata and images are fetched from
+GEOCAM_TIE_POINT_ISS_PHOTO_INFO_URL = 'http://eo-web.jsc.nasa.gov/GeoCam/PhotoInfo.pl?photo=%s-%s-%s'
+GEOCAM_TIE_POINT_ISS_IMAGE_ROOT_URL = 'http://eo-web.jsc.nasa.gov/DatabaseImages'
+
+# ISS photo metadata (image size, focal length, camera position) is
+# cached in the database so camera model requests don't have to refetch
+# it. entries expire after this many seconds...
+GEOCAM_TIE_POINT_ISS_METADATA_CACHE_SECONDS = 7 * 24 * 60 * 60
+# ...and the least recently used entries are evicted past this count.
+GEOCAM_TIE_POINT_ISS_METADATA_CACHE_MAX_ENTRIES = 10000
+
+# number of worker processes used to render tiles for html exports. 1
+# renders them serially in the exporting process.
+GEOCAM_TIE_POINT_EXPORT_WORKERS = 1
+
+# if True, html exports only warp the max zoom level of the quadtree from
+# the source image and build each lower level by downsampling the level
+# above it.
+GEOCAM_TIE_POINT_EXPORT_DOWNSAMPLE_LOW_ZOOMS = True
+
+# max bytes of decoded image data held by the in-process cache of tile
+# generators. the least recently used generators are evicted past it.
+GEOCAM_TIE_POINT_GENERATOR_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# if True, decoded source images are cached on local disk under
+# DATA_ROOT/geocamTiePoint/rasterCache and memory-mapped by tile
+# generators, so processes share their pages and skip decoding.
+GEOCAM_TIE_POINT_RASTER_CACHE_ENABLED = True
+
+# if True, each display image is also written as an internally tiled,
+# multi-resolution raster under DATA_ROOT/geocamTiePoint/tiledRaster when
+# it is imported, and warped tiles only read the source window they need
+# from the matching overview level. rasters for images imported earlier
+# are written in the background on first use, or all at once with
+# "./manage.py writeTiledRasters".
+GEOCAM_TIE_POINT_TILED_SOURCE_ENABLED = True
+
+# quality mode for warped tiles: 'fast', 'high' or 'adaptive' (see
+# geocamTiePoint.quadTree). served tiles favor latency while exports
+# favor quality.
+GEOCAM_TIE_POINT_TILE_QUALITY = 'adaptive'
+GEOCAM_TIE_POINT_EXPORT_TILE_QUALITY = 'high'
+
+# max bytes of encoded tiles held by the in-process tile cache, which sits
+# in front of the shared django cache. 0 disables it.
+GEOCAM_TIE_POINT_LOCAL_TILE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# max number of quadtree tile content ids held in process. with them, a
+# hot tile is served from the in-process tile cache without touching
+# the shared django cache.
+GEOCAM_TIE_POINT_TILE_CONTENT_ID_CACHE_MAX_ENTRIES = 10000
+
+# if True, served tiles are also written to an on-disk tile store under
+# DATA_ROOT/geocamTiePoint/tiles/<quadTreeId>, which getTile checks before
+# generating a tile, so rendered tiles survive a cache flush or restart.
+GEOCAM_TIE_POINT_TILE_STORE_ENABLED = True
+
+# if True (and the tile store is enabled), overlay JSON gives clients tile
+# urls under DATA_URL that point straight into the tile store, so stored
+# tiles are served by the web server without going through django. the
+# web server must pass misses back to the tile view, e.g. for nginx:
+#   location /data/geocamTiePoint/tiles/ {
+#     root <parent of DATA_ROOT>;
+#     try_files $uri @tileView;
+#   }
+#   location @tileView {
+#     rewrite ^/data/geocamTiePoint/tiles/(.*)$ /tile/$1 break;
+#     proxy_pass http://django;
+#   }
+GEOCAM_TIE_POINT_STATIC_TILES_ENABLED = False
+
+# limits for the batch tile endpoint: max tiles per request, and max
+# threads rendering the tiles of one request that miss the cache.
+GEOCAM_TIE_POINT_TILE_BATCH_MAX_TILES = 64
+GEOCAM_TIE_POINT_TILE_BATCH_THREADS = 4
+
+# if True, saving a new alignment starts rendering the new aligned tiles
+# the editor is about to show, on a pool of GEOCAM_TIE_POINT_WARMUP_THREADS
+# background threads per process. the warm-up starts at the zoom where the
+# overlay bounds span GEOCAM_TIE_POINT_WARMUP_VIEWPORT_TILES tiles, covers
+# GEOCAM_TIE_POINT_WARMUP_ZOOM_LEVELS zoom levels from there, and stops
+# after GEOCAM_TIE_POINT_WARMUP_MAX_TILES tiles.
+GEOCAM_TIE_POINT_WARMUP_ENABLED = True
+GEOCAM_TIE_POINT_WARMUP_THREADS = 2
+GEOCAM_TIE_POINT_WARMUP_VIEWPORT_TILES = 4
+GEOCAM_TIE_POINT_WARMUP_ZOOM_LEVELS = 3
+GEOCAM_TIE_POINT_WARMUP_MAX_TILES = 128
+
+# if True, after an alignment change, a tile of the new aligned quadtree
+# that is not cached yet is served from the cache of one of the last
+# GEOCAM_TIE_POINT_DELTA_RENDER_MAX_ANCESTORS quadtrees of the overlay
+# when the change moves no pixel of the tile by more than
+# GEOCAM_TIE_POINT_DELTA_RENDER_MAX_DISPLACEMENT_PIXELS, instead of being
+# re-rendered.
+GEOCAM_TIE_POINT_DELTA_RENDER_ENABLED = True
+GEOCAM_TIE_POINT_DELTA_RENDER_MAX_DISPLACEMENT_PIXELS = 0.5
+GEOCAM_TIE_POINT_DELTA_RENDER_MAX_ANCESTORS = 4
+
+# if True, export requests are queued as ExportJob rows and run by export
+# worker processes ("./manage.py exportWorker") instead of inside the HTTP
+# request. the worker command starts GEOCAM_TIE_POINT_EXPORT_QUEUE_WORKERS
+# processes by default, which check an empty queue every
+# GEOCAM_TIE_POINT_EXPORT_QUEUE_POLL_SECONDS.
+GEOCAM_TIE_POINT_EXPORT_QUEUE_ENABLED = False
+GEOCAM_TIE_POINT_EXPORT_QUEUE_WORKERS = 2
+GEOCAM_TIE_POINT_EXPORT_QUEUE_POLL_SECONDS = 2.0
+
+# running export jobs record a heartbeat at each progress update and
+# every GEOCAM_TIE_POINT_EXPORT_QUEUE_HEARTBEAT_INTERVAL_SECONDS from a
+# background thread. a job whose heartbeat is older than
+# GEOCAM_TIE_POINT_EXPORT_QUEUE_HEARTBEAT_TIMEOUT_SECONDS is assumed to
+# belong to a dead worker and is marked failed, so the timeout must be
+# several times the interval.
+GEOCAM_TIE_POINT_EXPORT_QUEUE_HEARTBEAT_INTERVAL_SECONDS = 60
+GEOCAM_TIE_POINT_EXPORT_QUEUE_HEARTBEAT_TIMEOUT_SECONDS = 600
@@ -0,0 +1,72 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Worker side of the export job queue. The queue itself is the ExportJob
+table, so workers only need the database to coordinate. Start workers
+with "./manage.py exportWorker".
+"""
+
+import time
+import logging
+import multiprocessing
+
+from django.db import connections
+
+from geocamTiePoint.models import ExportJob
+
+
+def runNextJob():
+    """
+    Runs the oldest queued export job. Returns the job, or None if the
+    queue was empty.
+    """
+    job = ExportJob.claimNext()
+    if job is not None:
+        logging.info('runNextJob: starting %s', job)
+        job.run()
+    return job
+
+
+def runWorker(pollSeconds, maxJobs=None):
+    """
+    Runs queued export jobs until @maxJobs jobs have run (forever if
+    None), checking for new jobs every @pollSeconds when the queue is
+    empty.
+    """
+    numJobs = 0
+    while maxJobs is None or numJobs < maxJobs:
+        if runNextJob() is None:
+            time.sleep(pollSeconds)
+        else:
+            numJobs += 1
+
+
+def runWorkers(numWorkers, pollSeconds):
+    """
+    Runs @numWorkers worker processes until they are killed.
+    """
+    if numWorkers == 1:
+        runWorker(pollSeconds)
+        return
+    # each process must open its own database connection
+    connections.close_all()
+    workers = [multiprocessing.Process(target=runWorker, args=(pollSeconds,))
+               for _ in xrange(numWorkers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
@@ -17,6 +17,8 @@
 # Instance of X has no 'Y' member (false alarm for abstract classes)
 # pylint: disable=E1101
 
+import os
+import shutil
 import logging
 import datetime
 
@@ -158,12 +160,36 @@ def deleteOtherFiles(activeFiles, dryRun=True):
         logging.warning('deleteOtherFiles: dry run mode, nothing actually deleted')
 
 
+def deleteOrphanRasterCaches(dryRun=True):
+    """
+    Deletes raster cache and tiled raster directories of ImageData
+    records that no longer exist, left by deletes that skipped the
+    cleanup.
+    """
+    activeIds = set([str(i) for i in ImageData.objects.values_list('id', flat=True)])
+    numDeleted = 0
+    for cacheRoot in (settings.DATA_ROOT + 'geocamTiePoint/rasterCache',
+                      settings.DATA_ROOT + 'geocamTiePoint/tiledRaster'):
+        if not os.path.isdir(cacheRoot):
+            continue
+        for name in os.listdir(cacheRoot):
+            if name not in activeIds:
+                if not dryRun:
+                    shutil.rmtree(os.path.join(cacheRoot, name), ignore_errors=True)
+                numDeleted += 1
+
+    logging.info('deleteOrphanRasterCaches: numDeleted=%s', numDeleted)
+    if dryRun:
+        logging.warning('deleteOrphanRasterCaches: dry run mode, nothing actually deleted')
+
+
 def garbageCollect(dryRun=True):
     markOthersUnused(QuadTree, getActiveQuadTreeIds, dryRun=dryRun)
     deleteUnusedPastRetainTime(QuadTree, dryRun=dryRun)
 
     markOthersUnused(ImageData, getActiveImageDataIds, dryRun=dryRun)
     deleteUnusedPastRetainTime(ImageData, dryRun=dryRun)
+    deleteOrphanRasterCaches(dryRun=dryRun)
 
     activeFiles = getActiveFiles()
     deleteOtherFiles(activeFiles, dryRun=dryRun)
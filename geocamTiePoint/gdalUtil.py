@@ -15,6 +15,7 @@
 #__END_LICENSE__
 
 import os
+import uuid
 import logging
 
 import numpy as np
@@ -110,36 +111,60 @@ class GdalImage(object):
 
 
 def buildVrtWithRpcMetadata(imgPath, rpcMetadata):
-    noSuffix = os.path.splitext(imgPath)[0]
-    geotiffName = noSuffix + '_rpc.tif'
-    vrt0Name = noSuffix + '_rpc0.vrt'
-    # make a bogus geotiff with same image contents so gdalbuildvrt will build a vrt for us
-    dosys('gdal_translate -a_srs "+proj=latlong" -a_ullr -30 30 30 -30 %s %s'
-          % (imgPath, geotiffName))
-    # create raw vrt
-    dosys('gdalbuildvrt %s %s' % (vrt0Name, geotiffName)) 
-    # edit vrt -- delete srs and geoTransform sections, add RPC metadata
-    vrtName = noSuffix + '_rpc.vrt'
-    vrt0 = open(vrt0Name, 'r').read().splitlines()
-    startTag = vrt0[0]
-    rest = vrt0[1:]
-    dosys('rm -f %s' % vrtName)
-    with open(vrtName, 'w') as vrtOut:
-        vrtOut.write(startTag + '\n')
-        vrtOut.write(rpcMetadata)
-        vrtOut.write('\n'.join(rest) + '\n')
-    logging.info('Inserted RPC metadata into VRT file %s' % vrtName)
-
-    return vrtName
+    """
+    Returns the path of an in-memory (/vsimem/) VRT wrapping @imgPath
+    with the @rpcMetadata dict in its RPC metadata domain. The caller
+    should gdal.Unlink() the path when done with it.
+    """
+    vrtPath = '/vsimem/%s_rpc.vrt' % uuid.uuid4().hex
+    src = gdal.Open(imgPath)
+    if src is None:
+        raise IOError('could not open %s with GDAL' % imgPath)
+    vrt = gdal.GetDriverByName('VRT').CreateCopy(vrtPath, src)
+    # the RPC model alone should place the image, not any georeferencing
+    # the source image happens to carry
+    vrt.SetProjection('')
+    vrt.SetMetadata(dict([(key, str(val)) for key, val in rpcMetadata.iteritems()]), 'RPC')
+    vrt = None  # flush the VRT
+    src = None
+    logging.info('Built VRT %s with RPC metadata for %s', vrtPath, imgPath)
+    return vrtPath
 
 
 GOOGLE_MAPS_SRS = '+proj=merc +datum=WGS84'
 EPSG_4326 = '+proj=longlat +datum=WGS84'
 
-def reprojectWithRpcMetadata(inputPath, inputRpcMetadata, outputSrs, outputPath):
-    # TODO: need to explicitly specify bounding box for output using gdalwarp's option -te
-    #   Without that, the command below may fail when trying to calculate bounds for
-    #   wide-angle photos that include space as well as ground in the image frame.
+# working memory gdalwarp may use for each chunk it warps, in MB
+WARP_MEMORY_MB = 512
+
+
+def reprojectWithRpcMetadata(inputPath, inputRpcMetadata, outputSrs, outputPath,
+                             outputBounds=None):
+    """
+    Warps @inputPath to a tiled GeoTIFF at @outputPath in @outputSrs,
+    placing it with the @inputRpcMetadata dict (see
+    RpcModel.getMetadataDict()). @outputBounds = (xmin, ymin, xmax, ymax)
+    in @outputSrs units sets the output extent explicitly, which is
+    needed for wide-angle photos that include space as well as ground
+    in the image frame, where GDAL can't work out the extent itself.
+    """
     vrtPath = buildVrtWithRpcMetadata(inputPath, inputRpcMetadata)
-    dosys('rm -f %s' % outputPath)
-    dosys('gdalwarp -r lanczos -rpc -t_srs "%s" -of GTiff -co COMPRESS=LZW -co TILED=YES %s %s' % (outputSrs, vrtPath, outputPath))
+    try:
+        if os.path.exists(outputPath):
+            os.unlink(outputPath)
+        options = gdal.WarpOptions(format='GTiff',
+                                   dstSRS=outputSrs,
+                                   outputBounds=outputBounds,
+                                   resampleAlg='lanczos',
+                                   rpc=True,
+                                   multithread=True,
+                                   warpMemoryLimit=WARP_MEMORY_MB,
+                                   warpOptions=['NUM_THREADS=ALL_CPUS'],
+                                   creationOptions=['COMPRESS=LZW', 'TILED=YES'])
+        result = gdal.Warp(outputPath, vrtPath, options=options)
+        if result is None:
+            raise RuntimeError('gdal.Warp failed reprojecting %s: %s'
+                               % (inputPath, gdal.GetLastErrorMsg()))
+        result = None  # flush and close the output
+    finally:
+        gdal.Unlink(vrtPath)
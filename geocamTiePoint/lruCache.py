@@ -0,0 +1,83 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+import threading
+from collections import OrderedDict
+
+
+class LruCache(object):
+    """
+    A thread-safe in-process cache that evicts its least recently used
+    entries once the total size of its values exceeds maxBytes. The size
+    of a value is measured once, when it is set, by calling getSize(value).
+    The most recently set entry is always kept, even if it is larger than
+    maxBytes by itself.
+    """
+
+    def __init__(self, maxBytes, getSize):
+        self.maxBytes = maxBytes
+        self.getSize = getSize
+        self.entries = OrderedDict()  # key -> (value, size), oldest first
+        self.numBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        size = self.getSize(value)
+        with self.lock:
+            oldEntry = self.entries.pop(key, None)
+            if oldEntry is not None:
+                self.numBytes -= oldEntry[1]
+            self.entries[key] = (value, size)
+            self.numBytes += size
+            while self.numBytes > self.maxBytes and len(self.entries) > 1:
+                _, (_, evictedSize) = self.entries.popitem(last=False)
+                self.numBytes -= evictedSize
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.numBytes -= entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.numBytes = 0
+
+    def getStats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hitRatio': float(self.hits) / lookups if lookups else None,
+                    'numEntries': len(self.entries),
+                    'numBytes': self.numBytes,
+                    'maxBytes': self.maxBytes}
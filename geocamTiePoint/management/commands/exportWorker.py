@@ -0,0 +1,40 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.conf import settings
+
+from geocamTiePoint import exportQueue
+
+
+class Command(NoArgsCommand):
+    help = 'Run worker processes that generate queued overlay exports'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('-n', '--numWorkers',
+                    type='int',
+                    default=settings.GEOCAM_TIE_POINT_EXPORT_QUEUE_WORKERS,
+                    help='Number of worker processes [%default]'),
+        make_option('-p', '--pollSeconds',
+                    type='float',
+                    default=settings.GEOCAM_TIE_POINT_EXPORT_QUEUE_POLL_SECONDS,
+                    help='Seconds between checks of an empty queue [%default]'),
+    )
+
+    def handle_noargs(self, **options):
+        exportQueue.runWorkers(options['numWorkers'], options['pollSeconds'])
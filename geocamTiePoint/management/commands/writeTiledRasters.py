@@ -0,0 +1,35 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+from django.core.management.base import NoArgsCommand
+
+from geocamTiePoint import tiledRaster
+from geocamTiePoint.models import QuadTree
+
+
+class Command(NoArgsCommand):
+    help = 'Write tiled source rasters for images imported before they were written'
+
+    def handle_noargs(self, **options):
+        done = set()
+        for qt in QuadTree.objects.exclude(transform='').exclude(imageData=None):
+            imageData = qt.imageData
+            if imageData.id in done or not imageData.image:
+                continue
+            done.add(imageData.id)
+            if not tiledRaster.TiledRaster.exists(imageData.getTiledRasterPath()):
+                print 'writing tiled raster for ImageData %s' % imageData.id
+                imageData.writeTiledRaster(qt.getImage())
@@ -19,10 +19,12 @@
 
 import os
 import datetime
+import hashlib
 import re
 import logging
-import threading
 import sys
+import threading
+import urllib2
 
 try:
     from cStringIO import StringIO
@@ -30,13 +32,17 @@ except ImportError:
     from StringIO import StringIO
 
 import PIL.Image
+import PIL.ImageFile
 import numpy as np
 from osgeo import gdal
 
-from django.db import models
+from django.db import models, transaction, connection, IntegrityError
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
+from django.core.cache import cache
 from django.shortcuts import get_object_or_404
 from django.template.loader import render_to_string
 from django.conf import settings
@@ -44,20 +50,36 @@ from django.conf import settings
 from geocamUtil import anyjson as json
 from geocamUtil import gdal2tiles, imageInfo
 from geocamUtil.models.ExtrasDotField import ExtrasDotField
-from geocamTiePoint import quadTree, transform, rpcModel, gdalUtil
+from geocamTiePoint import quadTree, transform, rpcModel, gdalUtil, lruCache, rasterCache, tiledRaster, tileStore
 from geocamUtil.ErrorJSONResponse import ErrorJSONResponse, checkIfErrorJSONResponse
 from georef_imageregistration import offline_config, registration_common
 
 from deepzoom.models import DeepZoom
 
 
-# poor man's local memory cache for one quadtree tile generator. a
-# common access pattern is that the same instance of the app gets
-# multiple tile requests on the same quadtree. optimize for that case by
-# keeping the generator in memory. note: an alternative approach would
-# use the memcached cache, but that would get rid of much of the benefit
-# in terms of serialization/deserialization.
-cachedGeneratorG = threading.local()
+# local memory cache of quadtree tile generators, shared by all threads
+# of the process. a common access pattern is that the same instance of
+# the app gets multiple tile requests on a few quadtrees. optimize for
+# that case by keeping their generators, and their decoded images, in
+# memory. note: an alternative approach would use the memcached cache,
+# but that would get rid of much of the benefit in terms of
+# serialization/deserialization.
+generatorCacheG = lruCache.LruCache(settings.GEOCAM_TIE_POINT_GENERATOR_CACHE_MAX_BYTES,
+                                    lambda gen: gen.getMemorySize())
+
+# local memory cache of quadtree tile content ids. a tile request needs
+# the content id to build its cache key, so keeping it in process lets
+# hot tiles be served without any shared cache round trip. a quadtree's
+# content id only changes when its legacy image is converted to RGBA,
+# which leaves the tile pixels the same, so other processes may keep
+# the old id.
+tileContentIdCacheG = lruCache.LruCache(settings.GEOCAM_TIE_POINT_TILE_CONTENT_ID_CACHE_MAX_ENTRIES,
+                                        lambda contentId: 1)
+
+# paths of tiled rasters being written in the background, so each is
+# only written once per process
+tiledRasterWritesG = set()
+tiledRasterWritesLockG = threading.Lock()
 
 
 def getNewImageFileName(instance, filename):
@@ -93,13 +115,42 @@ def dosys(cmd):
     return ret
         
 
+ISS_SENSOR_SIZE = (.036, .0239)  # TODO: calculate this
+
+
+def getRemoteImageSize(url, chunkSize=8192):
+    """
+    Returns the (width, height) of the image at @url, reading only as
+    much of the response as PIL needs to parse the image header. Returns
+    None if the header can't be parsed.
+    """
+    response = urllib2.urlopen(url)
+    try:
+        parser = PIL.ImageFile.Parser()
+        while True:
+            chunk = response.read(chunkSize)
+            if not chunk:
+                break
+            parser.feed(chunk)
+            if parser.image:
+                return parser.image.size
+    finally:
+        response.close()
+    return None
+
+
 class ISSimage:
-    def __init__(self, mission, roll, frame, sizeType):
+    def __init__(self, mission, roll, frame, sizeType, metadataOnly=False):
+        """
+        Fetches the image and the PhotoInfo metadata for an ISS photo. If
+        @metadataOnly is set, only the image header is read (enough to
+        get the image size and focal length) and imageFile is None.
+        """
         self.mission = mission
         self.roll = roll
         self.frame = frame
         self.sizeType = sizeType
-        self.infoUrl = "http://eo-web.jsc.nasa.gov/GeoCam/PhotoInfo.pl?photo=%s-%s-%s" % (self.mission, self.roll, self.frame)
+        self.infoUrl = settings.GEOCAM_TIE_POINT_ISS_PHOTO_INFO_URL % (self.mission, self.roll, self.frame)
         self.imageUrl = self.__getImageUrl()
         self.width = None
         self.height = None
@@ -108,36 +159,120 @@ class ISSimage:
         assert self.roll != ""
         assert self.frame != ""
         assert self.sizeType != ""
-        # set image file
-        self.imageFile = imageInfo.getImageFile(self.imageUrl)
         # set extras
         self.extras = imageInfo.constructExtrasDict(self.infoUrl) 
-        try:  # open it as a PIL image
-            bits = self.imageFile.file.read()
-            image = PIL.Image.open(StringIO(bits))
-            if image.size: 
-                self.width, self.height = image.size
-            # set focal length
-            sensorSize = (.036,.0239) #TODO: calculate this
-            focalLength = imageInfo.getAccurateFocalLengths(image.size, self.extras.focalLength_unitless, sensorSize)
-            self.extras['focalLength'] = [round(focalLength[0],2), round(focalLength[1],2)]        
-        except Exception as e:  # pylint: disable=W0703
-            logging.error("PIL failed to open image: " + str(e))
-        
+        imageSize = None
+        if metadataOnly:
+            self.imageFile = None
+            try:
+                imageSize = getRemoteImageSize(self.imageUrl)
+            except Exception as e:  # pylint: disable=W0703
+                logging.error("failed to read image header: " + str(e))
+        else:
+            # set image file
+            self.imageFile = imageInfo.getImageFile(self.imageUrl)
+            try:  # open it as a PIL image
+                bits = self.imageFile.file.read()
+                image = PIL.Image.open(StringIO(bits))
+                imageSize = image.size
+            except Exception as e:  # pylint: disable=W0703
+                logging.error("PIL failed to open image: " + str(e))
+        if imageSize:
+            self.width, self.height = imageSize
+            try:
+                # set focal length
+                focalLength = imageInfo.getAccurateFocalLengths(imageSize, self.extras.focalLength_unitless, ISS_SENSOR_SIZE)
+                self.extras['focalLength'] = [round(focalLength[0],2), round(focalLength[1],2)]        
+            except Exception as e:  # pylint: disable=W0703
+                logging.error("failed to calculate focal length: " + str(e))
+
     def __getImageUrl(self):
+        imageRootUrl = settings.GEOCAM_TIE_POINT_ISS_IMAGE_ROOT_URL
         if self.sizeType == 'small':
             if (self.roll == "E") or (self.roll == "ESC"):
-                rootUrl = "http://eo-web.jsc.nasa.gov/DatabaseImages/ESC/small" 
+                rootUrl = imageRootUrl + "/ESC/small" 
             else: 
-                rootUrl = "http://eo-web.jsc.nasa.gov/DatabaseImages/ISD/lowres"
+                rootUrl = imageRootUrl + "/ISD/lowres"
         else: 
             if (self.roll == "E") or (self.roll == "ESC"):
-                rootUrl = "http://eo-web.jsc.nasa.gov/DatabaseImages/ESC/large" 
+                rootUrl = imageRootUrl + "/ESC/large" 
             else: 
-                rootUrl = "http://eo-web.jsc.nasa.gov/DatabaseImages/ISD/highres"
+                rootUrl = imageRootUrl + "/ISD/highres"
         return  rootUrl + "/" + self.mission + "/" + self.mission + "-" + self.roll + "-" + self.frame + ".jpg"
 
 
+class IssImageMetadata(models.Model):
+    """
+    Persistent cache of ISS photo metadata (ISSimage.extras plus image
+    width and height), keyed by mission-roll-frame. Entries expire after
+    GEOCAM_TIE_POINT_ISS_METADATA_CACHE_SECONDS, and the least recently
+    used entries are evicted once there are more than
+    GEOCAM_TIE_POINT_ISS_METADATA_CACHE_MAX_ENTRIES.
+    """
+    issMRF = models.CharField(max_length=255, unique=True, help_text="Please use the following format: <em>[Mission ID]-[Roll]-[Frame number]</em>") 
+    extras = ExtrasDotField()
+    fetchTime = models.DateTimeField()
+    lastAccessTime = models.DateTimeField(db_index=True)
+
+    def __unicode__(self):
+        return ('IssImageMetadata issMRF=%s fetchTime=%s'
+                % (self.issMRF, self.fetchTime))
+
+    @classmethod
+    def evictLeastRecentlyUsed(cls):
+        maxEntries = settings.GEOCAM_TIE_POINT_ISS_METADATA_CACHE_MAX_ENTRIES
+        staleIds = list(cls.objects
+                        .order_by('-lastAccessTime')
+                        .values_list('id', flat=True)[maxEntries:])
+        if staleIds:
+            cls.objects.filter(id__in=staleIds).delete()
+
+
+def getIssImageMetadata(mission, roll, frame):
+    """
+    Returns the extras of the ISS photo mission-roll-frame, including
+    width, height and focalLength. Served from the IssImageMetadata
+    cache when possible; otherwise fetches the PhotoInfo page and just
+    the header of the large image. Incomplete results are returned
+    without being cached.
+    """
+    issMRF = '%s-%s-%s' % (mission, roll, frame)
+    now = datetime.datetime.utcnow()
+    ttl = datetime.timedelta(seconds=settings.GEOCAM_TIE_POINT_ISS_METADATA_CACHE_SECONDS)
+    try:
+        entry = IssImageMetadata.objects.get(issMRF=issMRF)
+    except IssImageMetadata.DoesNotExist:
+        entry = None
+
+    if entry is not None and now - entry.fetchTime <= ttl:
+        logging.debug('getIssImageMetadata hit %s', issMRF)
+        IssImageMetadata.objects.filter(id=entry.id).update(lastAccessTime=now)
+        return entry.extras
+
+    logging.debug('getIssImageMetadata miss %s', issMRF)
+    issImage = ISSimage(mission, roll, frame, 'large', metadataOnly=True)
+    extras = issImage.extras
+    extras['width'] = issImage.width
+    extras['height'] = issImage.height
+    if None in (issImage.width, issImage.height, extras.get('focalLength')):
+        # don't cache a partial fetch; the next request will retry it
+        logging.warning('getIssImageMetadata got incomplete metadata for %s, not caching it', issMRF)
+        return extras
+    if entry is None:
+        entry = IssImageMetadata(issMRF=issMRF)
+    entry.extras = extras
+    entry.fetchTime = now
+    entry.lastAccessTime = now
+    try:
+        with transaction.atomic():
+            entry.save()
+    except IntegrityError:
+        # another request cached the same frame first. ours is just as good.
+        logging.debug('getIssImageMetadata lost race to cache %s', issMRF)
+    IssImageMetadata.evictLeastRecentlyUsed()
+    return extras
+
+
 class ImageData(models.Model):
     lastModifiedTime = models.DateTimeField()
     # image.max_length needs to be long enough to hold a blobstore key
@@ -186,6 +321,87 @@ class ImageData(models.Model):
                                             editable=False,
                                             on_delete=models.SET_NULL)
     
+    def getTiledRasterDir(self):
+        return settings.DATA_ROOT + 'geocamTiePoint/tiledRaster/%d' % self.id
+
+    def getTiledRasterPath(self):
+        # the stored file name changes whenever the image is replaced
+        return (self.getTiledRasterDir() + '/%s'
+                % os.path.basename(self.image.name))
+
+    def getRasterCacheDir(self):
+        return settings.DATA_ROOT + 'geocamTiePoint/rasterCache/%d' % self.id
+
+    def getRasterCachePath(self):
+        # the stored file name changes whenever the image is replaced
+        return (self.getRasterCacheDir() + '/%s.npy'
+                % os.path.basename(self.image.name))
+
+    def clearRasterCache(self, keepCurrent=False):
+        """
+        Deletes the decoded copies of this image from the raster cache
+        and its tiled rasters. If @keepCurrent is set, only copies of
+        replaced images are deleted.
+        """
+        if keepCurrent and self.image:
+            rasterCache.clearRasters(self.getRasterCacheDir(), self.getRasterCachePath())
+            rasterCache.clearRasters(self.getTiledRasterDir(), self.getTiledRasterPath())
+        else:
+            rasterCache.clearRasters(self.getRasterCacheDir())
+            rasterCache.clearRasters(self.getTiledRasterDir())
+
+    def getChecksum(self):
+        """
+        Returns the SHA-1 checksum of the displayed image file. Images
+        imported before checksums were recorded get one on first use.
+        """
+        if not self.checksum:
+            checksum = hashlib.sha1()
+            self.image.open('rb')
+            try:
+                for chunk in self.image.chunks():
+                    checksum.update(chunk)
+            finally:
+                self.image.close()
+            self.checksum = checksum.hexdigest()
+            ImageData.objects.filter(id=self.id).update(checksum=self.checksum)
+        return self.checksum
+
+    def writeTiledRaster(self, image):
+        """
+        Writes @image, the decoded display image, as the tiled source
+        raster that warped tiles are generated from.
+        """
+        if settings.GEOCAM_TIE_POINT_TILED_SOURCE_ENABLED:
+            tiledRaster.writeTiledRaster(image, self.getTiledRasterPath())
+
+    def writeTiledRasterInBackground(self, image):
+        """
+        Like writeTiledRaster(), but on a background thread, for images
+        imported before tiled rasters were written. Tile requests use
+        the untiled image until the raster is ready.
+        """
+        if not settings.GEOCAM_TIE_POINT_TILED_SOURCE_ENABLED:
+            return
+        path = self.getTiledRasterPath()
+        with tiledRasterWritesLockG:
+            if path in tiledRasterWritesG:
+                return
+            tiledRasterWritesG.add(path)
+
+        def write():
+            try:
+                tiledRaster.writeTiledRaster(image, path)
+            except Exception:  # pylint: disable=W0703
+                logging.exception('writeTiledRasterInBackground failed for %s', path)
+            finally:
+                with tiledRasterWritesLockG:
+                    tiledRasterWritesG.discard(path)
+
+        thread = threading.Thread(target=write)
+        thread.daemon = True
+        thread.start()
+
     def create_deepzoom_slug(self):
         """
         Returns a string instance for deepzoom slug.
@@ -253,6 +469,8 @@ class ImageData(models.Model):
     def save(self, *args, **kwargs):
         self.lastModifiedTime = datetime.datetime.utcnow()
         super(ImageData, self).save(*args, **kwargs)
+        # the image may have been replaced
+        self.clearRasterCache(keepCurrent=True)
 
     def delete(self, *args, **kwargs):
         self.image.delete()
@@ -314,63 +532,201 @@ class QuadTree(models.Model):
         self.lastModifiedTime = datetime.datetime.utcnow()
         super(QuadTree, self).save(*args, **kwargs)
 
+    @classmethod
+    def getBasePathForId(cls, quadTreeId):
+        return settings.DATA_ROOT + 'geocamTiePoint/tiles/%d' % int(quadTreeId)
+
     def getBasePath(self):
-        return settings.DATA_ROOT + 'geocamTiePoint/tiles/%d' % self.id
+        return self.getBasePathForId(self.id)
+
+    def getStaticTilesUrl(self):
+        """
+        Returns the tile url template for fetching the tiles in the tile
+        store directly from the web server.
+        """
+        # warped tiles are png and simple tiles are jpg
+        if self.transform:
+            ext = '.png'
+        else:
+            ext = '.jpg'
+        return (settings.DATA_URL + 'geocamTiePoint/tiles/%d/[ZOOM]/[X]/[Y]%s'
+                % (self.id, ext))
+
+    def getTilesUrl(self, urlName):
+        if (settings.GEOCAM_TIE_POINT_STATIC_TILES_ENABLED
+                and settings.GEOCAM_TIE_POINT_TILE_STORE_ENABLED):
+            return self.getStaticTilesUrl()
+        else:
+            return reverse(urlName, args=[str(self.id)])
+
+    def clearTileStore(self):
+        """
+        Deletes the tiles of this quadtree from the on-disk tile store.
+        """
+        tileStore.clearTiles(self.getBasePath())
 
     def convertImageToRgbaIfNeeded(self, image):
         """
         With the latest code we convert to RGBA on image import. This
         special case helps migrate any remaining images that didn't get
-        that conversion.
+        that conversion. Returns the RGBA image.
         """
         if image.mode != 'RGBA':
             image = image.convert('RGBA')
             out = StringIO()
             image.save(out, format='png')
-            self.imageData.image.save('dummy.png', ContentFile(out.getvalue()), save=False)
+            bits = out.getvalue()
+            self.imageData.image.save('dummy.png', ContentFile(bits), save=False)
             self.imageData.contentType = 'image/png'
+            self.imageData.checksum = hashlib.sha1(bits).hexdigest()
             self.imageData.save()
-    
-    def getImage(self):
+            # tile content ids include the image checksum
+            for quadTreeId in (QuadTree.objects.filter(imageData=self.imageData)
+                               .values_list('id', flat=True)):
+                QuadTree.clearTileContentIdCache(quadTreeId)
+        return image
+
+    def decodeImage(self):
         # apparently image.file is not a very good file work-alike,
         # so let's delegate to StringIO(), which PIL is tested against
         bits = self.imageData.image.file.read()
-        logging.info('getImage len=%s header=%s',
+        logging.info('decodeImage len=%s header=%s',
                      len(bits), repr(bits[:10]))
         fakeFile = StringIO(bits)
 
         im = PIL.Image.open(fakeFile)
-        self.convertImageToRgbaIfNeeded(im)
+        im = self.convertImageToRgbaIfNeeded(im)
+        # decode now rather than lazily, since generators built from the
+        # image are shared between threads
+        im.load()
         return im
 
+    def getImage(self):
+        if not settings.GEOCAM_TIE_POINT_RASTER_CACHE_ENABLED:
+            return self.decodeImage()
+        path = self.imageData.getRasterCachePath()
+        if not os.path.exists(path):
+            image = self.decodeImage()
+            # decoding a legacy image converts it to RGBA and stores it
+            # under a new name, so look up the path again
+            path = self.imageData.getRasterCachePath()
+            rasterCache.saveRaster(image, path)
+        return rasterCache.loadRaster(path)
+
+    def getTileContentId(self):
+        if self.transform:
+            transformDict = json.loads(self.transform)
+        else:
+            transformDict = None
+        return quadTree.getTileContentId(self.imageData.getChecksum(), transformDict)
+
+    @classmethod
+    def getTileContentIdCacheKey(cls, quadTreeId):
+        return 'geocamTiePoint.QuadTree.tileContentId.%s' % quadTreeId
+
+    @classmethod
+    def clearTileContentIdCache(cls, quadTreeId):
+        key = cls.getTileContentIdCacheKey(quadTreeId)
+        tileContentIdCacheG.delete(key)
+        cache.delete(key)
+
+    @classmethod
+    def getTileContentIdWithCache(cls, quadTreeId):
+        """
+        Returns the tile content id of the quadtree, saving a database
+        lookup per tile request. It is looked up in process first, then
+        in the shared cache. Overlays get a new quadtree whenever their
+        image or transform changes, so the id doesn't go stale.
+        """
+        key = cls.getTileContentIdCacheKey(quadTreeId)
+        result = tileContentIdCacheG.get(key)
+        if result is None:
+            result = cache.get(key)
+            if result is None:
+                q = get_object_or_404(QuadTree, id=quadTreeId)
+                result = q.getTileContentId()
+                cache.set(key, result)
+            tileContentIdCacheG.set(key, result)
+        return result
+
+    @classmethod
+    def getAncestorsCacheKey(cls, quadTreeId):
+        return 'geocamTiePoint.QuadTree.ancestors.%s' % quadTreeId
+
+    @classmethod
+    def getAncestors(cls, quadTreeId):
+        """
+        Returns the recent quadtrees this one replaced, newest first, as
+        dicts with their quadTreeId, tile contentId and transform. Tiles
+        cached for them may be carried over (see views.getCarriedOverTile).
+        """
+        return cache.get(cls.getAncestorsCacheKey(quadTreeId)) or []
+
+    def setPredecessor(self, previous):
+        """
+        Records that this quadtree replaces @previous after an alignment
+        change.
+        """
+        if not (previous.transform and previous.imageData_id == self.imageData_id):
+            return
+        ancestors = ([{'quadTreeId': previous.id,
+                       'contentId': previous.getTileContentId(),
+                       'transform': json.loads(previous.transform)}]
+                     + self.getAncestors(previous.id))
+        # each ancestor is compared with this quadtree directly, never
+        # through a chain, so displacements don't accumulate
+        cache.set(self.getAncestorsCacheKey(self.id),
+                  ancestors[:settings.GEOCAM_TIE_POINT_DELTA_RENDER_MAX_ANCESTORS])
+
     @classmethod
     def getGeneratorCacheKey(cls, quadTreeId):
         return 'geocamTiePoint.QuadTreeGenerator.%s' % quadTreeId
 
     @classmethod
     def getGeneratorWithCache(cls, quadTreeId):
-        cachedGeneratorCopy = getattr(cachedGeneratorG, 'gen',
-                                      {'key': None, 'value': None})
         key = cls.getGeneratorCacheKey(quadTreeId)
-        if cachedGeneratorCopy['key'] == key:
+        result = generatorCacheG.get(key)
+        if result is not None:
             logging.debug('getGeneratorWithCache hit %s', key)
-            result = cachedGeneratorCopy['value']
         else:
             logging.debug('getGeneratorWithCache miss %s', key)
             q = get_object_or_404(QuadTree, id=quadTreeId)
             result = q.getGenerator()
-            cachedGeneratorG.gen = dict(key=key, value=result)
+            generatorCacheG.set(key, result)
         return result
 
-    def getGenerator(self):
-        image = self.getImage()
+    def getTiledSource(self):
+        """
+        Returns the tiled source raster of the image, or None if it
+        hasn't been written.
+        """
+        path = self.imageData.getTiledRasterPath()
+        if not tiledRaster.TiledRaster.exists(path):
+            return None
+        return tiledRaster.TiledRaster(path)
+
+    def getGenerator(self, quality=None):
+        quality = quality or settings.GEOCAM_TIE_POINT_TILE_QUALITY
         if self.transform:
+            image = None
+            if settings.GEOCAM_TIE_POINT_TILED_SOURCE_ENABLED:
+                image = self.getTiledSource()
+            if image is None:
+                image = self.getImage()
+                if settings.GEOCAM_TIE_POINT_TILED_SOURCE_ENABLED:
+                    # the image was imported before tiled rasters were
+                    # written. don't make this request wait for one.
+                    self.imageData.writeTiledRasterInBackground(image)
             return quadTree.WarpedQuadTreeGenerator(self.id,
                                                    image,
-                                                   json.loads(self.transform))
+                                                   json.loads(self.transform),
+                                                   quality,
+                                                   contentId=self.getTileContentId())
         else:
             return quadTree.SimpleQuadTreeGenerator(self.id,
-                                                image)
+                                                self.getImage(),
+                                                contentId=self.getTileContentId(),
+                                                quality=quality)
 
     @staticmethod
     def getSimpleViewHtml(tileRootUrl, metaJson, slug):
@@ -391,23 +747,15 @@ class QuadTree(models.Model):
         """
         transformDict  = json.loads(self.transform)
         tform =  transform.makeTransform(transformDict)
-        pixels = None
-        for column in toPts.T:
-            # convert column (3D pts in WGS84) to gmap meters
-            lonlat = column[:2]
-            gmap_meters = transform.lonLatToMeters(lonlat)
-            px, py = tform.reverse(gmap_meters)
-            newCol = np.array([[px],[py]])
-            if pixels is None:
-                pixels = newCol
-            else:
-                pixels = np.column_stack((pixels, newCol))
-        return pixels        
-
-    def generateHtmlExport(self, exportName, metaJson, slug):
+        # convert columns (3D pts in WGS84) to gmap meters
+        gmap_meters = transform.lonLatToMetersMany(toPts[:2, :].T)
+        pixels = tform.reverseMany(gmap_meters).T
+        return pixels
+
+    def generateHtmlExport(self, exportName, metaJson, slug, progressCallback=None):
         overlay = Overlay.objects.get(alignedQuadTree = self)
         imageSizeType = overlay.imageData.sizeType
-        gen = self.getGeneratorWithCache(self.id)
+        gen = self.getGenerator(quality=settings.GEOCAM_TIE_POINT_EXPORT_TILE_QUALITY)
         now = datetime.datetime.utcnow()
         timestamp = now.strftime('%Y-%m-%d-%H%M%S-UTC')
         # generate html export
@@ -417,13 +765,19 @@ class QuadTree(models.Model):
         html = self.getSimpleViewHtml(tileRootUrl, metaJson, slug)
         logging.debug('html: len=%s head=%s', len(html), repr(html[:10]))
         # tar the html export
-        writer = quadTree.TarWriter(htmlExportName)
-        gen.writeQuadTree(writer, slug)
+        writer = quadTree.TempFileTarWriter(htmlExportName)
+        gen.writeQuadTree(writer, slug,
+                          numWorkers=settings.GEOCAM_TIE_POINT_EXPORT_WORKERS,
+                          progressCallback=progressCallback,
+                          downsampleLowZooms=settings.GEOCAM_TIE_POINT_EXPORT_DOWNSAMPLE_LOW_ZOOMS)
         writer.writeData(viewHtmlPath, html)
         writer.writeData('meta.json', dumps(metaJson))
         self.htmlExportName = '%s.tar.gz' % htmlExportName
-        self.htmlExport.save(self.htmlExportName,
-                            ContentFile(writer.getData()))
+        exportFile = writer.getFile()
+        try:
+            self.htmlExport.save(self.htmlExportName, File(exportFile))
+        finally:
+            exportFile.close()
 
         
     def generateGeotiffExport(self, exportName, metaJson, slug):
@@ -457,15 +811,26 @@ class QuadTree(models.Model):
         dosys('mkdir %s' % geotiffFolderPath)
 
         fullFilePath = geotiffFolderPath + '/' + geotiffExportName +'.tif'
-        gdalUtil.reprojectWithRpcMetadata(imgPath, T_rpc.getVrtMetadata(), srs, fullFilePath)
+        # output extent in lon/lat, from the ground footprint of the
+        # current transform. if nothing hits the ground, let GDAL decide.
+        bounds = quadTree.imageFootprintBounds([imageWidth, imageHeight], tform)
+        if bounds is None:
+            outputBounds = None
+        else:
+            outputBounds = (bounds['west'], bounds['south'], bounds['east'], bounds['north'])
+        gdalUtil.reprojectWithRpcMetadata(imgPath, T_rpc.getMetadataDict(), srs, fullFilePath,
+                                          outputBounds=outputBounds)
 
-        geotiff_writer = quadTree.TarWriter(geotiffExportName)
+        geotiff_writer = quadTree.TempFileTarWriter(geotiffExportName)
         arcName = geotiffExportName + '.tif'
         geotiff_writer.writeData('meta.json', dumps(metaJson))
         geotiff_writer.addFile(fullFilePath, geotiffExportName + '/' + arcName)  # double check this line (second arg may not be necessary)
         self.geotiffExportName = '%s.tar.gz' % geotiffExportName
-        self.geotiffExport.save(self.geotiffExportName,
-                                ContentFile(geotiff_writer.getData()))
+        exportFile = geotiff_writer.getFile()
+        try:
+            self.geotiffExport.save(self.geotiffExportName, File(exportFile))
+        finally:
+            exportFile.close()
 
     
     def generateKmlExport(self, exportName, metaJson, slug):
@@ -490,12 +855,15 @@ class QuadTree(models.Model):
         g2t.process()
         
         # tar the kml
-        kml_writer = quadTree.TarWriter(kmlExportName)
+        kml_writer = quadTree.TempFileTarWriter(kmlExportName)
         kml_writer.writeData('meta.json', dumps(metaJson))
         kml_writer.addFile(kmlFolderPath, kmlExportName)  # double check. second arg may not be necessary
         self.kmlExportName = '%s.tar.gz' % kmlExportName
-        self.kmlExport.save(self.kmlExportName, 
-                            ContentFile(kml_writer.getData()))      
+        exportFile = kml_writer.getFile()
+        try:
+            self.kmlExport.save(self.kmlExportName, File(exportFile))
+        finally:
+            exportFile.close()
         
         
 class Overlay(models.Model):
@@ -571,8 +939,7 @@ class Overlay(models.Model):
             urlName = 'geocamTiePoint_publicTile'
         else:
             urlName = 'geocamTiePoint_tile'
-        return reverse(urlName,
-                       args=[str(self.alignedQuadTree.id)])
+        return self.alignedQuadTree.getTilesUrl(urlName)
 
     def getJsonDict(self):
         # export all schema-free subfields of extras
@@ -601,8 +968,7 @@ class Overlay(models.Model):
         if 'issMRF' not in result:
             result['issMRF'] = self.imageData.issMRF
         if self.unalignedQuadTree is not None:
-            result['unalignedTilesUrl'] = reverse('geocamTiePoint_tile',
-                                                  args=[str(self.unalignedQuadTree.id)])
+            result['unalignedTilesUrl'] = self.unalignedQuadTree.getTilesUrl('geocamTiePoint_tile')
             result['unalignedTilesZoomOffset'] = quadTree.ZOOM_OFFSET
         if self.alignedQuadTree is not None:
             result['alignedTilesUrl'] = self.getAlignedTilesUrl()
@@ -693,14 +1059,17 @@ class Overlay(models.Model):
         qt = QuadTree(imageData=originalImageData,
                     transform=dumps(self.extras.transform))
         qt.save()
+        if self.alignedQuadTree is not None and settings.GEOCAM_TIE_POINT_DELTA_RENDER_ENABLED:
+            qt.setPredecessor(self.alignedQuadTree)
         self.alignedQuadTree = qt
         return qt
 
-    def generateHtmlExport(self):
+    def generateHtmlExport(self, progressCallback=None):
         (self.alignedQuadTree.generateHtmlExport
          (self.getExportName(),
           self.getJsonDict(),
-          self.getSlug()))
+          self.getSlug(),
+          progressCallback))
         return self.alignedQuadTree.htmlExport 
 
     def generateKmlExport(self):
@@ -731,6 +1100,227 @@ class Overlay(models.Model):
                                    self.getSlug()))
         
         
+class ExportCancelled(Exception):
+    pass
+
+
+class ExportJob(models.Model):
+    """
+    An export of an overlay's aligned quadtree, queued to run in an
+    export worker process (see geocamTiePoint.exportQueue) instead of
+    inside the HTTP request.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    ACTIVE_STATUSES = (QUEUED, RUNNING)
+    EXPORT_TYPES = ('html', 'kml', 'geotiff')
+    # kml and geotiff exports are a single long GDAL step with no
+    # progress updates, so only html exports can be cancelled once
+    # they are running
+    CANCELLABLE_RUNNING_TYPES = ('html',)
+
+    overlay = models.ForeignKey('Overlay')
+    # the aligned quadtree when the export was requested. identical
+    # requests for the same quadtree share a job.
+    quadTree = models.ForeignKey('QuadTree')
+    exportType = models.CharField(max_length=16)
+    status = models.CharField(max_length=16, default=QUEUED, db_index=True)
+    # fraction of the export completed, from 0 to 1
+    progress = models.FloatField(default=0)
+    cancelRequested = models.BooleanField(default=False)
+    errorMessage = models.TextField(blank=True)
+    createdTime = models.DateTimeField()
+    startTime = models.DateTimeField(null=True, blank=True)
+    endTime = models.DateTimeField(null=True, blank=True)
+    # updated on every progress update and by a background thread while
+    # the export runs. running jobs whose heartbeat goes stale belonged
+    # to a worker that died.
+    heartbeatTime = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return ('ExportJob id=%s overlay_id=%s exportType=%s status=%s'
+                % (self.id, self.overlay_id, self.exportType, self.status))
+
+    @classmethod
+    def submit(cls, overlay, exportType):
+        """
+        Queues an export of the aligned quadtree of @overlay, or returns
+        the queued or running job that will already produce it.
+        """
+        if exportType not in cls.EXPORT_TYPES:
+            raise ValueError('unknown export type %s' % exportType)
+        cls.failStaleJobs()
+        activeJobs = cls.objects.filter(quadTree=overlay.alignedQuadTree,
+                                        exportType=exportType,
+                                        status__in=cls.ACTIVE_STATUSES)
+        for job in activeJobs[:1]:
+            return job
+        return cls.objects.create(overlay=overlay,
+                                  quadTree=overlay.alignedQuadTree,
+                                  exportType=exportType,
+                                  createdTime=datetime.datetime.utcnow())
+
+    @classmethod
+    def failStaleJobs(cls):
+        """
+        Marks running jobs whose heartbeat is older than
+        GEOCAM_TIE_POINT_EXPORT_QUEUE_HEARTBEAT_TIMEOUT_SECONDS as
+        failed, so a new request regenerates the export.
+        """
+        now = datetime.datetime.utcnow()
+        timeout = datetime.timedelta(seconds=settings.GEOCAM_TIE_POINT_EXPORT_QUEUE_HEARTBEAT_TIMEOUT_SECONDS)
+        numFailed = (cls.objects
+                     .filter(status=cls.RUNNING, heartbeatTime__lt=now - timeout)
+                     .update(status=cls.FAILED,
+                             errorMessage='export worker stopped responding',
+                             endTime=now))
+        if numFailed:
+            logging.warning('ExportJob.failStaleJobs: failed %s stale jobs', numFailed)
+
+    @classmethod
+    def claimNext(cls):
+        """
+        Marks the oldest queued job as running and returns it, or returns
+        None if the queue is empty. The conditional update makes sure
+        only one worker claims each job.
+        """
+        cls.failStaleJobs()
+        queued = (cls.objects
+                  .filter(status=cls.QUEUED)
+                  .order_by('createdTime', 'id')
+                  .values_list('id', flat=True))
+        for jobId in queued[:10]:
+            now = datetime.datetime.utcnow()
+            numClaimed = (cls.objects
+                          .filter(id=jobId, status=cls.QUEUED)
+                          .update(status=cls.RUNNING,
+                                  startTime=now,
+                                  heartbeatTime=now))
+            if numClaimed:
+                return cls.objects.get(id=jobId)
+        return None
+
+    def cancel(self):
+        """
+        Cancels a queued job right away. A running html job stops at its
+        next progress update. Returns False if the job can't be
+        cancelled, because it is running a kml or geotiff export or has
+        already ended.
+        """
+        numCancelled = (ExportJob.objects
+                        .filter(id=self.id, status=self.QUEUED)
+                        .update(status=self.CANCELLED, endTime=datetime.datetime.utcnow()))
+        if numCancelled:
+            return True
+        if self.exportType not in self.CANCELLABLE_RUNNING_TYPES:
+            return False
+        numRequested = (ExportJob.objects
+                        .filter(id=self.id, status=self.RUNNING)
+                        .update(cancelRequested=True))
+        return bool(numRequested)
+
+    def setProgress(self, progress):
+        """
+        Records the progress of a running job. Raises ExportCancelled if
+        cancellation was requested.
+        """
+        self.progress = progress
+        ExportJob.objects.filter(id=self.id).update(progress=progress,
+                                                     heartbeatTime=datetime.datetime.utcnow())
+        if ExportJob.objects.filter(id=self.id, cancelRequested=True).exists():
+            raise ExportCancelled()
+
+    def touchHeartbeat(self):
+        ExportJob.objects.filter(id=self.id, status=self.RUNNING).update(heartbeatTime=datetime.datetime.utcnow())
+
+    def heartbeatLoop(self, stopEvent):
+        """
+        Updates the heartbeat every
+        GEOCAM_TIE_POINT_EXPORT_QUEUE_HEARTBEAT_INTERVAL_SECONDS until
+        @stopEvent is set. Runs in a background thread during run(), so
+        kml and geotiff exports, which have no progress updates, aren't
+        mistaken for dead jobs.
+        """
+        try:
+            while not stopEvent.wait(settings.GEOCAM_TIE_POINT_EXPORT_QUEUE_HEARTBEAT_INTERVAL_SECONDS):
+                self.touchHeartbeat()
+        except:  # pylint: disable=W0702
+            logging.exception('ExportJob %s heartbeat failed', self.id)
+        finally:
+            connection.close()
+
+    def finish(self, status, errorMessage=''):
+        """
+        Records how a running job ended. Returns False and leaves the
+        job alone if it is no longer running, e.g. because
+        failStaleJobs() already marked it failed.
+        """
+        endTime = datetime.datetime.utcnow()
+        progress = 1 if status == self.DONE else self.progress
+        numFinished = (ExportJob.objects
+                       .filter(id=self.id, status=self.RUNNING)
+                       .update(status=status,
+                               errorMessage=errorMessage,
+                               endTime=endTime,
+                               progress=progress))
+        if not numFinished:
+            logging.warning('ExportJob %s is no longer running, not marking it %s', self.id, status)
+            return False
+        self.status = status
+        self.errorMessage = errorMessage
+        self.endTime = endTime
+        self.progress = progress
+        return True
+
+    def generateExport(self):
+        overlay = self.overlay
+        if overlay.alignedQuadTree_id != self.quadTree_id:
+            raise ValueError('overlay was realigned after the export was requested')
+        self.setProgress(0)
+        if self.exportType == 'html':
+            def progressCallback(zoom, tilesSoFar, totalTiles):
+                self.setProgress(float(tilesSoFar) / max(totalTiles, 1))
+            overlay.generateHtmlExport(progressCallback)
+        elif self.exportType == 'kml':
+            overlay.generateKmlExport()
+        elif self.exportType == 'geotiff':
+            overlay.generateGeotiffExport()
+
+    def run(self):
+        """
+        Runs a claimed job and records how it ended.
+        """
+        stopEvent = threading.Event()
+        heartbeatThread = threading.Thread(target=self.heartbeatLoop, args=(stopEvent,))
+        heartbeatThread.daemon = True
+        heartbeatThread.start()
+        try:
+            self.generateExport()
+        except ExportCancelled:
+            logging.info('ExportJob %s cancelled', self.id)
+            self.finish(self.CANCELLED)
+        except Exception as e:  # pylint: disable=W0703
+            logging.exception('ExportJob %s failed', self.id)
+            self.finish(self.FAILED, str(e))
+        else:
+            self.finish(self.DONE)
+        finally:
+            stopEvent.set()
+            heartbeatThread.join()
+
+    def getJsonDict(self):
+        return {'id': self.id,
+                'overlay': self.overlay_id,
+                'exportType': self.exportType,
+                'status': self.status,
+                'progress': self.progress,
+                'errorMessage': self.errorMessage,
+                'url': reverse('geocamTiePoint_exportJobJson', args=[self.id])}
+
+
 #########################################
 # models for autoregistration pipeline  #
 #########################################
@@ -770,3 +1360,15 @@ class GeoSens(models.Model):
     y = models.FloatField(null=True, blank=True, default=0)
     centerLat = models.FloatField(null=True, blank=True, default=0)
     centerLon = models.FloatField(null=True, blank=True, default=0) 
+
+
+@receiver(post_delete, sender=ImageData)
+def clearImageDataRasterCache(sender, instance, **kwargs):
+    # also runs for cascade and queryset deletes, which skip delete()
+    instance.clearRasterCache()
+
+
+@receiver(post_delete, sender=QuadTree)
+def clearQuadTreeTileStore(sender, instance, **kwargs):
+    # also runs for cascade and queryset deletes, which skip delete()
+    instance.clearTileStore()
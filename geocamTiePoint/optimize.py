@@ -181,7 +181,7 @@ def lm(y, f, x0,
     return x, status
 
 
-def optimize(y, f, x0):
+def optimize(y, f, x0, jacobian=None):
 #     if HAVE_SCIPY_LEASTSQ:
 #         # ack! scipy.optimize.leastsq is not thread-safe
 #         scipyLeastSqLockG.acquire()
@@ -189,7 +189,7 @@ def optimize(y, f, x0):
 #         scipyLeastSqLockG.release()
 #         return x
 #     else:
-    x, _status = lm(y, f, x0)
+    x, _status = lm(y, f, x0, jacobian=jacobian)
     return x
 
 
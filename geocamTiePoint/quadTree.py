@@ -19,6 +19,7 @@
 
 import json
 import os
+import hashlib
 import math
 import sys
 import time
@@ -28,21 +29,41 @@ except ImportError:
     from StringIO import StringIO
 import zipfile
 import tarfile
+import tempfile
+import itertools
+import multiprocessing
 
 from PIL import Image
 import numpy
 import numpy.linalg
 
-from django.core.cache import cache
+from geocamTiePoint import transform, tiledRaster, tileCache
 
-from geocamTiePoint import transform
-
-PATCH_SIZE = 32
 TILE_SIZE = transform.TILE_SIZE
-PATCHES_PER_TILE = int(TILE_SIZE / PATCH_SIZE)
-PATCH_ZOOM_OFFSET = math.log(PATCHES_PER_TILE, 2)
+# general (non-projective) transforms are warped with a MESH whose patches
+# are subdivided until bilinear interpolation across each patch is within
+# MESH_MAX_ERROR_PIXELS (in tile pixels) of the exact transform
+MESH_MAX_ERROR_PIXELS = 0.25
+MESH_MIN_PATCH_SIZE = 8
+# warped tile quality modes. 'high' warps at double resolution and
+# downsamples; 'fast' warps directly to the tile size, prefiltering the
+# source when the warp shrinks it; 'adaptive' uses 'fast' at the max zoom
+# and above, where tiles magnify the source, and 'high' below.
+TILE_QUALITY_FAST = 'fast'
+TILE_QUALITY_HIGH = 'high'
+TILE_QUALITY_ADAPTIVE = 'adaptive'
+TILE_QUALITY_CHOICES = (TILE_QUALITY_FAST, TILE_QUALITY_HIGH, TILE_QUALITY_ADAPTIVE)
+# context pixels read around the footprint of a warp in a tiled source,
+# enough for the bicubic filter
+WINDOW_PAD = 3
 ZOOM_OFFSET = 3
+# part of every tile cache key. bump it when a change to tile rendering
+# makes previously cached tiles stale.
+TILE_CACHE_VERSION = 1
 BENCHMARK_WARP_STEPS = False
+PARALLEL_CHUNK_SIZE = 8
+# tiles between progress updates while writing a quadtree
+PROGRESS_INTERVAL_TILES = 64
 BLACK = (0, 0, 0)
 GRAY = (192, 192, 192)
 
@@ -190,15 +211,44 @@ def flatten(listOfLists):
     return [item for subList in listOfLists for item in subList]
 
 
+def getImageMemorySize(image):
+    """
+    Returns the number of bytes taken by the decoded pixels of @image.
+    """
+    w, h = image.size
+    return w * h * len(image.getbands())
+
+
 def getImageDataPng(image):
     out = StringIO()
     image.save(out, format='png')
     return (out.getvalue(), 'image/png')
 
 
-def getTileCacheKey(quadTreeId, zoom, x, y):
-    return ('geocamTiePoint.tile.%s.%s.%s.%s'
-            % (quadTreeId, zoom, x, y))
+def getTileContentId(imageChecksum, transformDict=None):
+    """
+    Returns a hash identifying the tiles rendered from the image with
+    checksum @imageChecksum warped by @transformDict (None for a simple
+    quadtree). Quadtrees with the same inputs get the same id whatever
+    their database ids, so they share cached tiles.
+    """
+    if transformDict is None:
+        canonicalTransform = ''
+    else:
+        canonicalTransform = json.dumps(transformDict, sort_keys=True,
+                                        separators=(',', ':'))
+    return hashlib.sha1('%s\n%s' % (imageChecksum, canonicalTransform)).hexdigest()
+
+
+def getTileCacheKey(contentId, zoom, x, y, quality):
+    """
+    Returns the cache key of a tile. Generators and the tile views both
+    build keys here, so the same tile always gets the same key. Tiles of
+    different quality must not be served from the cache in place of
+    each other.
+    """
+    return ('geocamTiePoint.tile.v%s.%s.%s.%s.%s.%s'
+            % (TILE_CACHE_VERSION, contentId, zoom, x, y, quality))
 
 
 def setBackgroundColor(image, backgroundColor):
@@ -219,10 +269,17 @@ def getImageDataJpg(image):
 
 
 def imageMapBounds(imageSize, tform):
+    """
+    Returns the lat/lon bounds of the image corners that @tform maps to
+    the ground, or None if no corner does.
+    """
     w, h = imageSize
     imageCorners = cornerPoints([0, 0, w, h])
-    mercatorCorners = [tform.forward(c) for c in imageCorners]
-    latLonCorners = [transform.metersToLatLon(c) for c in mercatorCorners]
+    mercatorCorners = numpy.asarray(tform.forwardMany(imageCorners), dtype='float64')
+    mercatorCorners = mercatorCorners[numpy.isfinite(mercatorCorners).all(axis=1)]
+    if not len(mercatorCorners):
+        return None
+    latLonCorners = transform.metersToLatLonMany(mercatorCorners).tolist()
     bounds = Bounds(latLonCorners)
     return {'west': bounds.xmin,
             'south': bounds.ymin,
@@ -230,6 +287,173 @@ def imageMapBounds(imageSize, tform):
             'north': bounds.ymax}
 
 
+def imageFootprintBounds(imageSize, tform, numSteps=33):
+    """
+    Returns the lat/lon bounds, like imageMapBounds(), of the pixels on
+    a @numSteps x @numSteps grid over the image that @tform maps to the
+    ground. Unlike the corners alone, the grid follows the horizon of
+    photos that include sky. Returns None if no sampled pixel hits the
+    ground.
+    """
+    w, h = imageSize
+    u, v = numpy.meshgrid(numpy.linspace(0, w, numSteps),
+                          numpy.linspace(0, h, numSteps))
+    mercatorPts = tform.forwardMany(numpy.column_stack([u.ravel(), v.ravel()]))
+    mercatorPts = mercatorPts[numpy.isfinite(mercatorPts).all(axis=1)]
+    if not len(mercatorPts):
+        return None
+    lonLats = transform.metersToLatLonMany(mercatorPts)
+    west, south = lonLats.min(axis=0)
+    east, north = lonLats.max(axis=0)
+    return {'west': west,
+            'south': south,
+            'east': east,
+            'north': north}
+
+
+def getMaxTileDisplacement(oldTransform, newTransform, zoom, x, y, numSamples=5):
+    """
+    Returns the max distance, in tile pixels, that a source image point
+    inside tile (zoom, x, y) moves when @oldTransform is replaced by
+    @newTransform, sampled on a @numSamples x @numSamples grid. Returns
+    inf if the displacement can't be measured.
+    """
+    u = numpy.linspace(0, TILE_SIZE, numSamples)
+    px, py = numpy.meshgrid(x * TILE_SIZE + u, y * TILE_SIZE + u)
+    res = transform.resolution(zoom)
+    tilePts = numpy.column_stack([px.ravel() * res - transform.ORIGIN_SHIFT,
+                                  transform.ORIGIN_SHIFT - py.ravel() * res])
+    sourcePts = newTransform.reverseMany(tilePts)
+    oldTilePts = oldTransform.forwardMany(sourcePts)
+    displacement = numpy.hypot(*(oldTilePts - tilePts).T).max() / res
+    if numpy.isnan(displacement):
+        return float('inf')
+    return displacement
+
+
+def getMeshPatches(transformArgs):
+    """
+    Returns the (targetBox, sourceQuad) patches of PIL QUAD or MESH
+    transform args.
+    """
+    size, method, data, _resample = transformArgs
+    if method == Image.QUAD:
+        return [((0, 0) + tuple(size), data)]
+    else:
+        return data
+
+
+def getPolygonAreas(quads):
+    """
+    Returns the areas of the quadrilaterals in the rows of Nx8 array
+    @quads, using the shoelace formula.
+    """
+    x = quads[:, 0::2]
+    y = quads[:, 1::2]
+    return 0.5 * numpy.abs((x * numpy.roll(y, -1, axis=1)
+                            - numpy.roll(x, -1, axis=1) * y).sum(axis=1))
+
+
+def getSourceScale(patches, quads):
+    """
+    Returns the average number of source pixels per output pixel of a
+    warp with the given (targetBox, sourceQuad) @patches, whose source
+    quads are the rows of Nx8 array @quads.
+    """
+    boxes = numpy.array([box for box, _ in patches], dtype='float64')
+    targetArea = ((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])).sum()
+    return math.sqrt(getPolygonAreas(quads).sum() / targetArea)
+
+
+def getFootprintBox(quads, pad, size):
+    """
+    Returns the integer bounding box of the source @quads, padded by
+    @pad pixels and clipped to an image of @size, or None if it is empty.
+    """
+    w, h = size
+    left = max(int(math.floor(quads[:, 0::2].min())) - pad, 0)
+    top = max(int(math.floor(quads[:, 1::2].min())) - pad, 0)
+    right = min(int(math.ceil(quads[:, 0::2].max())) + pad, w)
+    bottom = min(int(math.ceil(quads[:, 1::2].max())) + pad, h)
+    if right <= left or bottom <= top:
+        return None
+    return left, top, right, bottom
+
+
+def replaceSourceQuads(transformArgs, patches, quads):
+    """
+    Returns a copy of @transformArgs with the source quads of its
+    @patches replaced by the rows of @quads.
+    """
+    size, method, _data, resample = transformArgs
+    if method == Image.QUAD:
+        data = quads[0].tolist()
+    else:
+        data = [[box, quad] for (box, _), quad in zip(patches, quads.tolist())]
+    return size, method, data, resample
+
+
+def prefilterSource(image, transformArgs):
+    """
+    Prepares to warp @image directly to the output size, with no
+    supersampled resize pass to average over source pixels. If the warp
+    shrinks the source, crops the source to the footprint of the warp and
+    shrinks it to the output resolution with an area-averaging filter, so
+    output pixels don't alias. Returns (image, transformArgs) adjusted to
+    match.
+    """
+    patches = getMeshPatches(transformArgs)
+    if not patches:
+        return image, transformArgs
+    quads = numpy.array([quad for _, quad in patches], dtype='float64')
+    factor = getSourceScale(patches, quads)
+    if factor <= 1:
+        return image, transformArgs
+
+    # pad the crop a little so the resampling filter sees past the footprint
+    box = getFootprintBox(quads, int(math.ceil(factor)), image.size)
+    if box is None:
+        return image, transformArgs
+    left, top, right, bottom = box
+    shrunkSize = (int(math.ceil((right - left) / factor)),
+                  int(math.ceil((bottom - top) / factor)))
+    shrunk = image.crop(box).resize(shrunkSize, Image.ANTIALIAS)
+    scale = (float(shrunkSize[0]) / (right - left),
+             float(shrunkSize[1]) / (bottom - top))
+    quads = ((quads.reshape((-1, 4, 2)) - (left, top)) * scale).reshape((-1, 8))
+    return shrunk, replaceSourceQuads(transformArgs, patches, quads)
+
+
+def getSourceWindow(source, transformArgs):
+    """
+    Reads the part of @source, a tiledRaster.TiledRaster or
+    ImagePyramid, under the footprint of a warp. Reads from the coarsest
+    overview level that still has at least the output resolution.
+    Returns (image, transformArgs) with the source coordinates adjusted
+    to the window.
+    """
+    patches = getMeshPatches(transformArgs)
+    if not patches:
+        return source.readWindow(0, (0, 0, 1, 1)), transformArgs
+    quads = numpy.array([quad for _, quad in patches], dtype='float64')
+    factor = getSourceScale(patches, quads)
+    level = 0
+    if factor >= 2:
+        level = min(int(math.log(factor, 2)), source.getNumLevels() - 1)
+
+    w0, h0 = source.size
+    w, h = source.getLevelSize(level)
+    quads = quads.reshape((-1, 4, 2)) * (float(w) / w0, float(h) / h0)
+    box = getFootprintBox(quads.reshape((-1, 8)), WINDOW_PAD, (w, h))
+    if box is None:
+        # the footprint misses the source. warping any window gives an
+        # empty tile.
+        box = (0, 0, 1, 1)
+    left, top, _, _ = box
+    quads = (quads - (left, top)).reshape((-1, 8))
+    return source.readWindow(level, box), replaceSourceQuads(transformArgs, patches, quads)
+
+
 def intMap(floatList):
     if floatList is None:
         return None
@@ -265,16 +489,18 @@ def getFileTarInfo(name, rawData, mode=0644):
 
 class TarWriter(object):
     """
-    A writer class where writeX() methods add file entries to an
-    in-memory tar.gz file.  The paths of all entries in the tarball are
-    prefixed with dirName. Once all entries have been added, the raw
-    tarball contents can be extracted using the getData() method and
-    written to a file or blob storage.
+    A writer class where writeX() methods add file entries to a tar.gz
+    file, in memory unless a file object is passed as @out.  The paths
+    of all entries in the tarball are prefixed with dirName. Once all
+    entries have been added, the raw tarball contents can be extracted
+    using the getData() method and written to a file or blob storage.
     """
 
-    def __init__(self, dirName):
+    def __init__(self, dirName, out=None):
         self.dirName = dirName
-        self.out = StringIO()
+        if out is None:
+            out = StringIO()
+        self.out = out
         self.tar = tarfile.open(fileobj=self.out, mode='w:gz')
         self.tar.addfile(getDirTarInfo(self.dirName))
         self.closed = False
@@ -293,13 +519,39 @@ class TarWriter(object):
                                data)
         self.tar.addfile(tinfo, fileobj=StringIO(data))
 
-    def getData(self):
+    def close(self):
         if not self.closed:
             self.tar.close()
             self.closed = True
+
+    def getData(self):
+        self.close()
         return self.out.getvalue()
 
 
+class TempFileTarWriter(TarWriter):
+    """
+    A TarWriter that streams the tar.gz file to an anonymous temporary
+    file rather than holding it in memory, so memory use stays bounded
+    by the size of the largest single entry. Once all entries have been
+    added, getFile() returns the temp file rewound to the start, ready
+    to be saved to a FileField with django.core.files.File. The temp
+    file is deleted when it is closed.
+    """
+
+    def __init__(self, dirName):
+        super(TempFileTarWriter, self).__init__(dirName,
+                                                out=tempfile.TemporaryFile())
+
+    def getFile(self):
+        self.close()
+        self.out.seek(0)
+        return self.out
+
+    def getData(self):
+        return self.getFile().read()
+
+
 class ZipWriter(object):
     """
     A writer class where writeX() methods add file entries to an
@@ -345,10 +597,13 @@ class ZipWriter(object):
         self.zip.writestr(os.path.join(self.dirName, path),
                           data)
 
-    def getData(self):
+    def close(self):
         if not self.closed:
             self.zip.close()
             self.closed = True
+
+    def getData(self):
+        self.close()
         return self.out.getvalue()
 
 
@@ -376,16 +631,26 @@ class AbstractQuadTreeGenerator(object):
     def getTileData(self, zoom, x, y):
         raise NotImplementedError('implement in derived classes')
 
+    def getMemorySize(self):
+        """
+        Returns the approximate number of bytes of decoded image data
+        held by the generator.
+        """
+        raise NotImplementedError('implement in derived classes')
+
+    def getTileCacheKey(self, zoom, x, y):
+        return getTileCacheKey(self.contentId, zoom, x, y, self.quality)
+
     def getTileDataWithCache(self, zoom, x, y):
-        key = getTileCacheKey(self.quadTreeId, zoom, x, y)
-        data = cache.get(key)
-        if data is None:
-            data = self.getTileData(zoom, x, y)
-            cache.set(key, data)
-        return data
+        return tileCache.getTileData(self.getTileCacheKey(zoom, x, y),
+                                     lambda: self.getTileData(zoom, x, y))
 
     def writeTile(self, writer, slug, zoom, x, y):
-        bits, contentType = self.getTileDataWithCache(zoom, x, y)
+        self.writeTileData(writer, slug, zoom, x, y,
+                           self.getTileDataWithCache(zoom, x, y))
+
+    def writeTileData(self, writer, slug, zoom, x, y, data):
+        bits, contentType = data
 
         if BENCHMARK_WARP_STEPS:
             saveStart = time.time()
@@ -397,8 +662,13 @@ class AbstractQuadTreeGenerator(object):
 
 
 class SimpleQuadTreeGenerator(AbstractQuadTreeGenerator):
-    def __init__(self, quadTreeId, image):
+    def __init__(self, quadTreeId, image, contentId=None, quality=TILE_QUALITY_HIGH):
         self.quadTreeId = quadTreeId
+        # contentId names the tiles in the cache, see getTileContentId()
+        self.contentId = contentId or quadTreeId
+        # unwarped tiles look the same at any quality, but the quality
+        # they are served at is part of their cache key
+        self.quality = quality
         self.imageSize = image.size
         w, h = self.imageSize
         self.coords = ((0, 0),
@@ -414,6 +684,10 @@ class SimpleQuadTreeGenerator(AbstractQuadTreeGenerator):
         self.zoomedImage = {}
         self.zoomedImage[self.maxZoom] = image
 
+    def getMemorySize(self):
+        # the downsampled copies of the image add at most 1/3 more
+        return getImageMemorySize(self.zoomedImage[self.maxZoom]) * 4 / 3
+
     def getZoomedImage(self, zoom):
         result = self.zoomedImage.get(zoom, None)
         if result is None:
@@ -505,15 +779,75 @@ def fillEdges(corners, numSteps):
     return [v.tolist() for v in resultVec]
 
 
+# generator shared with the writeQuadTree() worker pool. it is set in
+# the parent just before the pool forks, so the workers inherit it
+# (including the decoded source image) instead of unpickling a copy.
+parallelGeneratorG = None
+
+
+def generateTileInWorker(tile):
+    zoom, x, y = tile
+    try:
+        return parallelGeneratorG.getTileData(zoom, x, y)
+    except OutOfBounds:
+        return None
+
+
+class ImagePyramid(object):
+    """
+    In-memory counterpart of tiledRaster.TiledRaster for a PIL image.
+    The power-of-two overviews are computed on first use, like
+    SimpleQuadTreeGenerator.getZoomedImage().
+    """
+
+    def __init__(self, image):
+        self.size = image.size
+        self.sizes = tiledRaster.getOverviewSizes(image.size, tiledRaster.BLOCK_SIZE)
+        self.levels = {0: image}
+
+    def getNumLevels(self):
+        return len(self.sizes)
+
+    def getLevelSize(self, level):
+        return self.sizes[level]
+
+    def getLevel(self, level):
+        result = self.levels.get(level)
+        if result is None:
+            result = self.getLevel(level - 1).resize(self.sizes[level], Image.ANTIALIAS)
+            self.levels[level] = result
+        return result
+
+    def buildOverviews(self):
+        self.getLevel(self.getNumLevels() - 1)
+
+    def readWindow(self, level, box):
+        return self.getLevel(level).crop(box)
+
+
 class WarpedQuadTreeGenerator(AbstractQuadTreeGenerator):
-    def __init__(self, quadTreeId, image, transformDict):
+    def __init__(self, quadTreeId, image, transformDict, quality=TILE_QUALITY_HIGH,
+                 contentId=None):
+        if quality not in TILE_QUALITY_CHOICES:
+            raise ValueError('unknown tile quality %s, expected one of: %s'
+                             % (quality, ', '.join(TILE_QUALITY_CHOICES)))
         self.quadTreeId = quadTreeId
+        # contentId names the tiles in the cache, see getTileContentId()
+        self.contentId = contentId or quadTreeId
+        # image is either a PIL image or a tiledRaster.TiledRaster. either
+        # way, tiles only read the source window they need from the
+        # matching overview level.
         self.image = image
+        self.isTiled = isinstance(image, tiledRaster.TiledRaster)
+        if self.isTiled:
+            self.source = image
+        else:
+            self.source = ImagePyramid(image)
         self.transform = transform.makeTransform(transformDict)
+        self.quality = quality
 
         corners = getImageCorners(self.image)
-        self.mercatorCorners = [self.transform.forward(corner)
-                                for corner in corners]
+        self.mercatorCorners = self.transform.forwardMany(corners).tolist()
 
         if 0:
             # debug getProjectiveInverse
@@ -526,8 +860,7 @@ class WarpedQuadTreeGenerator(AbstractQuadTreeGenerator):
                 print >> sys.stderr, i, numpy.array(c1) - numpy.array(c2)
 
         imageEdgePoints = fillEdges(corners, 5)
-        self.mercatorEdgePoints = [self.transform.forward(edgePoint)
-                                   for edgePoint in imageEdgePoints]
+        self.mercatorEdgePoints = self.transform.forwardMany(imageEdgePoints).tolist()
 
         bounds = Bounds()
         for edgePoint in self.mercatorEdgePoints:
@@ -546,36 +879,178 @@ class WarpedQuadTreeGenerator(AbstractQuadTreeGenerator):
             self.tileBounds[zoom] = result
         return result
 
-    def writeQuadTree(self, writer, slug):
+    def getMemorySize(self):
+        if self.isTiled:
+            return self.image.getMemorySize()
+        else:
+            # the overviews add at most 1/3 more
+            return getImageMemorySize(self.image) * 4 / 3
+
+    def getTilesAtZoom(self, zoom):
+        xmin, ymin, xmax, ymax = self.getTileBounds(zoom).bounds
+        return [(zoom, x, y)
+                for x in xrange(int(xmin), int(xmax) + 1)
+                for y in xrange(int(ymin), int(ymax) + 1)]
+
+    def getTileDataOrNone(self, zoom, x, y):
+        try:
+            return self.getTileDataWithCache(zoom, x, y)
+        except OutOfBounds:
+            # no surprise if some tiles are empty around the edges
+            return None
+
+    def startWorkerPool(self, numWorkers):
+        global parallelGeneratorG
+        # decode the source image and build its overviews before forking
+        # so the workers share their pixels copy-on-write
+        self.image.load()
+        if not self.isTiled:
+            self.source.buildOverviews()
+        parallelGeneratorG = self
+        return multiprocessing.Pool(numWorkers)
+
+    def writeDownsampledQuadTree(self, writer, slug, pool, progressCallback, totalTiles):
+        """
+        Writes the tiles for writeQuadTree(downsampleLowZooms=True). The
+        max zoom tiles are rendered depth first, in quadtree order, and
+        each lower zoom tile is built as soon as its last child is done.
+        At most four tiles per zoom level are held in memory, whatever
+        the size of the image. @progressCallback is called every
+        PROGRESS_INTERVAL_TILES tiles and once at the end.
+        """
+        maxZoom = int(self.maxZoom)
+
+        def quadTreeOrder(tile):
+            _, x, y = tile
+            return [(x >> shift, y >> shift) for shift in xrange(maxZoom, -1, -1)]
+        tiles = sorted(self.getTilesAtZoom(maxZoom), key=quadTreeOrder)
+
+        # siblings[zoom] is (parent, {(x, y): data}) for the tiles at zoom
+        # whose parent tile is not built yet
+        siblings = {}
+        tilesSoFar = [0]
+
+        def addTile(zoom, x, y, data):
+            parent = (x // 2, y // 2)
+            if zoom in siblings and siblings[zoom][0] != parent:
+                # tiles arrive depth first, so the last parent is complete
+                buildParent(zoom)
+            if data is not None:
+                self.writeTileData(writer, slug, zoom, x, y, data)
+            tilesSoFar[0] += 1
+            if progressCallback and tilesSoFar[0] % PROGRESS_INTERVAL_TILES == 0:
+                progressCallback(zoom, tilesSoFar[0], totalTiles)
+            if zoom > 0:
+                _, levelData = siblings.setdefault(zoom, (parent, {}))
+                if data is not None:
+                    levelData[(x, y)] = data
+
+        def buildParent(zoom):
+            (x, y), levelData = siblings.pop(zoom)
+            addTile(zoom - 1, x, y, self.getTileDataFromChildren(levelData, x, y))
+
+        for (zoom, x, y), data in itertools.izip(tiles, self.renderTiles(tiles, pool)):
+            addTile(zoom, x, y, data)
+        for zoom in xrange(maxZoom, 0, -1):
+            if zoom in siblings:
+                buildParent(zoom)
+        sys.stderr.write('[completed tiles: %d / %d]\n' % (tilesSoFar[0], totalTiles))
+        if progressCallback:
+            progressCallback(0, totalTiles, totalTiles)
+
+    def getTileDataFromChildren(self, childLevelData, x, y):
+        """
+        Builds tile (x, y) by compositing its four children from the
+        next zoom level up and downsampling 2x. @childLevelData maps
+        (x, y) to the tile data of that level. Returns None if none of
+        the children exist.
+        """
+        composite = None
+        for dx in (0, 1):
+            for dy in (0, 1):
+                childData = childLevelData.get((2 * x + dx, 2 * y + dy))
+                if childData is None:
+                    continue
+                if composite is None:
+                    composite = Image.new('RGBA', (int(TILE_SIZE * 2),) * 2, (0, 0, 0, 0))
+                bits, _contentType = childData
+                child = Image.open(StringIO(bits))
+                composite.paste(child, (int(dx * TILE_SIZE), int(dy * TILE_SIZE)))
+        if composite is None:
+            return None
+        return getImageDataPng(composite.resize((int(TILE_SIZE),) * 2, Image.ANTIALIAS))
+
+    def renderTiles(self, tiles, pool=None):
+        """
+        Returns an iterator over the data of the (zoom, x, y) @tiles, in
+        order, with None for tiles that are out of bounds. Tiles are
+        rendered in @pool if specified.
+        """
+        if pool:
+            # imap returns results in input order, keeping the archive
+            # layout deterministic
+            return pool.imap(generateTileInWorker, tiles, PARALLEL_CHUNK_SIZE)
+        else:
+            return (self.getTileDataOrNone(*tile) for tile in tiles)
+
+    def writeQuadTree(self, writer, slug, numWorkers=1, progressCallback=None,
+                      downsampleLowZooms=False):
+        """
+        Writes all tiles of the quadtree to @writer. If @numWorkers > 1,
+        tiles are rendered in a pool of worker processes; they are still
+        written in the same order as the serial version. If specified,
+        @progressCallback(zoom, tilesSoFar, totalTiles) is called every
+        PROGRESS_INTERVAL_TILES tiles and after each zoom level.
+
+        If @downsampleLowZooms is set, only the max zoom level is warped
+        from the source image. Each lower level tile is built from its
+        children with getTileDataFromChildren(), see
+        writeDownsampledQuadTree().
+        """
+        global parallelGeneratorG
         print >> sys.stderr, 'warping...'
-        totalTiles = 0
         startTime = time.time()
 
-        totalTiles = 0
-        for zoom in xrange(int(self.maxZoom), -1, -1):
-            xmin, ymin, xmax, ymax = self.getTileBounds(zoom).bounds
-            numTilesAtZoom = (xmax - xmin + 1) * (ymax - ymin + 1)
-            totalTiles += numTilesAtZoom
+        zooms = range(int(self.maxZoom), -1, -1)
+        totalTiles = sum([len(self.getTilesAtZoom(zoom)) for zoom in zooms])
         sys.stderr.write('%d total tiles\n' % totalTiles)
 
-        tilesSoFar = 0
-        for zoom in xrange(int(self.maxZoom), -1, -1):
-            xmin, ymin, xmax, ymax = self.getTileBounds(zoom).bounds
-            maxNumTiles = (xmax - xmin + 1) * (ymax - ymin + 1)
-            sys.stderr.write('zoom %d (%d tiles)' % (zoom, maxNumTiles))
-            for x in xrange(int(xmin), int(xmax) + 1):
-                for y in xrange(int(ymin), int(ymax) + 1):
-                    try:
-                        self.writeTile(writer, slug, zoom, x, y)
-                    except OutOfBounds:
-                        # no surprise if some tiles are empty around the edges
-                        pass
-                    tilesSoFar += 1
-            sys.stderr.write('[completed tiles: %d / %d]\n' % (tilesSoFar, totalTiles))
+        pool = None
+        try:
+            if numWorkers > 1:
+                pool = self.startWorkerPool(numWorkers)
+            if downsampleLowZooms:
+                self.writeDownsampledQuadTree(writer, slug, pool, progressCallback, totalTiles)
+            else:
+                tilesSoFar = 0
+                for zoom in zooms:
+                    tiles = self.getTilesAtZoom(zoom)
+                    sys.stderr.write('zoom %d (%d tiles)' % (zoom, len(tiles)))
+                    for (_, x, y), data in itertools.izip(tiles, self.renderTiles(tiles, pool)):
+                        if data is not None:
+                            self.writeTileData(writer, slug, zoom, x, y, data)
+                        tilesSoFar += 1
+                        if progressCallback and tilesSoFar % PROGRESS_INTERVAL_TILES == 0:
+                            progressCallback(zoom, tilesSoFar, totalTiles)
+                    sys.stderr.write('[completed tiles: %d / %d]\n' % (tilesSoFar, totalTiles))
+                    if progressCallback:
+                        progressCallback(zoom, tilesSoFar, totalTiles)
+        except:
+            if pool:
+                pool.terminate()
+                pool = None
+            raise
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            if numWorkers > 1:
+                # don't keep this generator and its decoded image alive
+                parallelGeneratorG = None
 
         elapsedTime = time.time() - startTime
         print >> sys.stderr, ('warping complete: %d tiles, elapsed time %.1f seconds = %d ms/tile'
-                              % (totalTiles, elapsedTime, int(1000 * elapsedTime / totalTiles)))
+                              % (totalTiles, elapsedTime, int(1000 * elapsedTime / max(totalTiles, 1))))
 
     def getTileData(self, zoom, x, y):
         return getImageDataPng(self.generateTile(zoom, x, y))
@@ -589,89 +1064,139 @@ class WarpedQuadTreeGenerator(AbstractQuadTreeGenerator):
 
         sys.stderr.write('.')
 
-        if isinstance(self.transform,
-                      (transform.LinearTransform,
-                       transform.ProjectiveTransform)):
-            transformArgs = self.getPilTransformArgsProjective(zoom, x, y)
-        else:
-            transformArgs = self.getPilTransformArgsGeneral(zoom, x, y)
+        supersample = self.getSupersample(zoom)
+        transformArgs = self.getPilTransformArgs(zoom, x, y, int(TILE_SIZE * supersample))
+        sourceImage, transformArgs = getSourceWindow(self.source, transformArgs)
+        if supersample == 1:
+            sourceImage, transformArgs = prefilterSource(sourceImage, transformArgs)
 
         if BENCHMARK_WARP_STEPS:
             warpDataStart = time.time()
-        tileImage = self.image.transform(*transformArgs)
+        tileImage = sourceImage.transform(*transformArgs)
         if BENCHMARK_WARP_STEPS:
             print 'warpDataTime:', time.time() - warpDataStart
 
-        if BENCHMARK_WARP_STEPS:
-            resizeStart = time.time()
-        tileImage = tileImage.resize((int(TILE_SIZE),) * 2, Image.ANTIALIAS)
-        if BENCHMARK_WARP_STEPS:
-            print 'resizeTime:', time.time() - resizeStart
+        if supersample > 1:
+            if BENCHMARK_WARP_STEPS:
+                resizeStart = time.time()
+            tileImage = tileImage.resize((int(TILE_SIZE),) * 2, Image.ANTIALIAS)
+            if BENCHMARK_WARP_STEPS:
+                print 'resizeTime:', time.time() - resizeStart
 
         return tileImage
 
-    def getPilTransformArgsProjective(self, zoom, x, y):
+    def getSupersample(self, zoom):
+        """
+        Returns the factor by which tiles at @zoom are oversized during
+        warping, according to the quality mode.
+        """
+        if self.quality == TILE_QUALITY_HIGH:
+            return 2
+        elif self.quality == TILE_QUALITY_FAST:
+            return 1
+        else:
+            return 1 if zoom >= self.maxZoom else 2
+
+    def getPilTransformArgs(self, zoom, x, y, size):
+        if isinstance(self.transform,
+                      (transform.LinearTransform,
+                       transform.ProjectiveTransform)):
+            return self.getPilTransformArgsProjective(zoom, x, y, size)
+        else:
+            return self.getPilTransformArgsGeneral(zoom, x, y, size)
+
+    def getPilTransformArgsProjective(self, zoom, x, y, size=int(TILE_SIZE * 2)):
         corners = tileExtent(zoom, x, y)
-        sourceCorners = [intMap(self.transform.reverse(corner))
-                         for corner in corners]
+        sourceCorners = [intMap(corner)
+                         for corner in self.transform.reverseMany(corners).tolist()]
 
-        return ((int(TILE_SIZE * 2),) * 2,
+        return ((size, size),
                 Image.QUAD,
                 flatten(sourceCorners),
                 Image.BICUBIC)
 
-    def getPilTransformArgsGeneral(self, zoom, x, y):
-        corners = tileExtent(zoom, x, y)
+    def getAdaptiveMeshPatches(self, zoom, x, y):
+        """
+        Returns (targetBoxes, sourceCorners) arrays describing MESH
+        patches that cover tile (zoom, x, y). targetBoxes rows are
+        (left, top, right, bottom) in tile pixels and sourceCorners rows
+        are the matching source quads in PIL MESH order. Source corners
+        are not rounded to whole pixels, which would swamp the error
+        tolerance.
+
+        Starting from one patch covering the whole tile, a patch is split
+        into four while bilinear interpolation between its corners misses
+        the exact transform at its center or edge midpoints by more than
+        MESH_MAX_ERROR_PIXELS. Patches with out-of-bounds corners at
+        MESH_MIN_PATCH_SIZE are dropped.
+        """
+        # 3x3 grid of sample points within a patch, indexed [i, j] with
+        # i stepping in x and j stepping in y
+        gridOffsets = numpy.array([[(i, j) for j in (0, 0.5, 1)]
+                                   for i in (0, 0.5, 1)])
+        tileOrigin = numpy.array(tileIndexToPixels(x, y))
+
+        origins = numpy.zeros((1, 2))
+        size = TILE_SIZE
+        targetBoxes = []
+        sourceCorners = []
+        while len(origins):
+            samplePixels = (tileOrigin + origins[:, numpy.newaxis, numpy.newaxis, :]
+                            + size * gridOffsets)
+            mercator = transform.pixelsToMeters(samplePixels[..., 0].ravel(),
+                                                samplePixels[..., 1].ravel(),
+                                                zoom)
+            source = (self.transform.reverseMany(numpy.column_stack(mercator))
+                      .reshape((len(origins), 3, 3, 2)))
+
+            # corners in PIL MESH order: upper left, lower left, lower
+            # right, upper right
+            ul, ll, lr, ur = source[:, 0, 0], source[:, 0, 2], source[:, 2, 2], source[:, 2, 0]
+            corners = numpy.concatenate([ul, ll, lr, ur], axis=1)
+            interpolationErrors = [source[:, 1, 1] - (ul + ll + lr + ur) / 4,
+                                   source[:, 0, 1] - (ul + ll) / 2,
+                                   source[:, 2, 1] - (ur + lr) / 2,
+                                   source[:, 1, 0] - (ul + ur) / 2,
+                                   source[:, 1, 2] - (ll + lr) / 2]
+            sourceError = numpy.max([numpy.hypot(e[:, 0], e[:, 1])
+                                     for e in interpolationErrors], axis=0)
+            # convert the error from source pixels to tile pixels
+            sourcePixelsPerTilePixel = (numpy.hypot(*(ur - ul).T)
+                                        + numpy.hypot(*(ll - ul).T)) / (2 * size)
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                accurate = sourceError <= MESH_MAX_ERROR_PIXELS * sourcePixelsPerTilePixel
+
+            cornersOk = numpy.isfinite(corners).all(axis=1)
+            if size / 2 < MESH_MIN_PATCH_SIZE:
+                split = numpy.zeros(len(origins), dtype=bool)
+            else:
+                split = ~accurate
+            done = ~split & cornersOk
+            targetBoxes.append(numpy.column_stack((origins[done], origins[done] + size)))
+            sourceCorners.append(corners[done])
+
+            size /= 2
+            origins = numpy.concatenate([origins[split] + size * numpy.array(offset)
+                                         for offset in ((0, 0), (0, 1), (1, 1), (1, 0))])
+
+        return numpy.concatenate(targetBoxes), numpy.concatenate(sourceCorners)
 
+    def getPilTransformArgsGeneral(self, zoom, x, y, size=int(TILE_SIZE * 2)):
         if BENCHMARK_WARP_STEPS:
             transformStart = time.time()
-        doublePatchSize = PATCH_SIZE * 2
-        meshPatches = []
-
-        patchTable = {}
-        for px in xrange(PATCHES_PER_TILE + 1):
-            for py in xrange(PATCHES_PER_TILE + 1):
-                targetPatchOrigin = tileIndexToPixels(x * PATCHES_PER_TILE + px,
-                                                      y * PATCHES_PER_TILE + py)
-                mercatorPatchOrigin = transform.pixelsToMeters(targetPatchOrigin[0],
-                                                     targetPatchOrigin[1],
-                                                     zoom + PATCH_ZOOM_OFFSET)
-                sourcePatchOrigin = intMap(self.transform.reverse(mercatorPatchOrigin))
-                patchTable[(px, py)] = sourcePatchOrigin
+        targetBoxes, sourceCorners = self.getAdaptiveMeshPatches(zoom, x, y)
         if BENCHMARK_WARP_STEPS:
             print
             print 'transformTime:', time.time() - transformStart
 
         if BENCHMARK_WARP_STEPS:
             meshStart = time.time()
-        for px in xrange(PATCHES_PER_TILE):
-            for py in xrange(PATCHES_PER_TILE):
-                corners = ((px, py),
-                           (px, py + 1),
-                           (px + 1, py + 1),
-                           (px + 1, py))
-                sourcePatchCorners = [patchTable[corner]
-                                      for corner in corners]
-
-                # reject the patch if any corner is out of bounds
-                if any([c is None
-                        for c in sourcePatchCorners]):
-                    continue
-
-                xoff = px * doublePatchSize
-                yoff = py * doublePatchSize
-                targetBox = (xoff,
-                             yoff,
-                             xoff + doublePatchSize,
-                             yoff + doublePatchSize)
-                meshPatches.append([targetBox, flatten(sourcePatchCorners)])
-
-                if 0:
-                    print >> sys.stderr, 'patchCorners:', corners
-                    print >> sys.stderr, 'sourceCorners:', sourcePatchCorners
-                    print >> sys.stderr, 'targetBox:', targetBox
+        meshPatches = [[tuple(targetBox), corners]
+                       for targetBox, corners
+                       in zip(numpy.round(size / TILE_SIZE * targetBoxes).astype(int).tolist(),
+                              sourceCorners.tolist())]
 
-        transformArgs = ((int(TILE_SIZE * 2),) * 2,
+        transformArgs = ((size, size),
                          Image.MESH,
                          meshPatches,
                          Image.BICUBIC)
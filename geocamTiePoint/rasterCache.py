@@ -0,0 +1,104 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Local disk cache of decoded source images. Each image is stored as a
+raw .npy pixel array that is memory-mapped when loaded, so processes
+that open the same image share its pages through the OS page cache and
+don't pay to decode it again. PIL stores RGB pixels padded to 4 bytes,
+so RGB images are still copied into process memory when loaded; only
+L and RGBA images are shared.
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy
+from PIL import Image
+
+# modes whose pixels map directly to a numpy array that Image.fromarray()
+# understands. other modes are converted to RGBA before caching.
+CACHEABLE_MODES = ('L', 'RGB', 'RGBA')
+
+
+def saveRaster(image, path):
+    """
+    Writes the decoded pixels of @image to @path as a .npy file. Writes
+    to a temp file and renames it into place, so concurrent readers
+    never see a partial file.
+    """
+    if image.mode not in CACHEABLE_MODES:
+        image = image.convert('RGBA')
+    dirName = os.path.dirname(path)
+    if not os.path.exists(dirName):
+        try:
+            os.makedirs(dirName)
+        except OSError:
+            # another process created it first
+            pass
+    fd, tempPath = tempfile.mkstemp(suffix='.npy', dir=dirName)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            numpy.save(out, numpy.asarray(image))
+        os.rename(tempPath, path)
+    except:
+        os.unlink(tempPath)
+        raise
+
+
+def loadRaster(path):
+    """
+    Returns a read-only PIL image whose pixels are memory-mapped from
+    the .npy file at @path. RGB pixels are copied instead (see above).
+    """
+    return Image.fromarray(numpy.load(path, mmap_mode='r'))
+
+
+def getCachedImage(path, decodeImage):
+    """
+    Returns the image cached at @path, first calling @decodeImage() to
+    get the PIL image and caching it if needed.
+    """
+    if not os.path.exists(path):
+        saveRaster(decodeImage(), path)
+    return loadRaster(path)
+
+
+def clearRasters(dirPath, keepPath=None):
+    """
+    Deletes the cached rasters (files or directories) in directory
+    @dirPath other than @keepPath, and the directory itself if nothing
+    is kept. Processes
+    that have a deleted raster memory-mapped can keep reading it.
+    """
+    if not os.path.isdir(dirPath):
+        return
+    if keepPath is None:
+        shutil.rmtree(dirPath, ignore_errors=True)
+        return
+    keepName = os.path.basename(keepPath)
+    for name in os.listdir(dirPath):
+        if name != keepName:
+            path = os.path.join(dirPath, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                # another process deleted it first
+                pass
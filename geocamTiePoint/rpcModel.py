@@ -201,8 +201,11 @@ class RpcTransform(object):
         params, _cov = scipy.optimize.leastsq(errorFunc, params0)
         return params
 
-    def getVrtMetadata(self):
-        ctx = {
+    def getMetadataDict(self):
+        """
+        Returns the model as a dict of GDAL RPC metadata domain items.
+        """
+        return {
             'HEIGHT_OFF': self.heightOff,
             'HEIGHT_SCALE': self.heightScale,
             'LAT_OFF': self.latOff,
@@ -218,6 +221,9 @@ class RpcTransform(object):
             'SAMP_OFF': self.sampOff,
             'SAMP_SCALE': self.sampScale,
         }
+
+    def getVrtMetadata(self):
+        ctx = self.getMetadataDict()
         fields = '\n'.join(['    <MDI key="%s">%s</MDI>' % (key, val)
                               for key, val in sorted(ctx.items())])
         tmpl = ("""
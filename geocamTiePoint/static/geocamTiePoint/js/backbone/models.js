@@ -322,12 +322,32 @@ $(function($) {
             model.on(event, function() {
             		exportPending = false;},
             	this);
-            $.post(request_url, '', function() {
+            var fetchExport = function() {
                 model.fetch({ success: function() {
                 	if (model.get(exportUrl)) {
                 		model.trigger(event);
                 	}
                 } });
+            };
+            // queued exports return a job to poll until a worker is done
+            var pollJob = function(job) {
+                if (job.status == 'done') {
+                    fetchExport();
+                } else if (job.status == 'failed' || job.status == 'cancelled') {
+                    exportPending = false;
+                    if (options.error) options.error();
+                } else {
+                    setTimeout(function() {
+                        $.getJSON(job.url, pollJob);
+                    }, 2000);
+                }
+            };
+            $.post(request_url, '', function(response) {
+                if (response && response.job) {
+                    pollJob(response.job);
+                } else {
+                    fetchExport();
+                }
             }, 'json')
             .error(function(xhr, status, error) {
                  this.exportPending = false;
@@ -79,7 +79,7 @@ def testRpcModel():
     T_rpc = testFit(imgPath)
     srs = gdalUtil.EPSG_4326
     # srs = gdalUtil.GOOGLE_MAPS_SRS
-    gdalUtil.reprojectWithRpcMetadata(imgPath, T_rpc.getVrtMetadata(),
+    gdalUtil.reprojectWithRpcMetadata(imgPath, T_rpc.getMetadataDict(),
                                       srs, resultPath)
     dosys('rm -rf %s' % tilesPath)
     logging.info('fetch mostly-working version of gdal2tiles.py from here: http://www.klokan.cz/projects/gdal2tiles/gdal2tiles.py')
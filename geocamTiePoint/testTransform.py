@@ -91,6 +91,15 @@ def testTransformClass2(cls):
            % (cls.__name__,
               numpy.linalg.norm(toPtsApprox - TO_PTS) / N))
 
+def testManyMatchesSingle(cls):
+    tform = cls.fit(TO_PTS, FROM_PTS)
+    forwardSingle = numpy.array([tform.forward(pt) for pt in FROM_PTS])
+    reverseSingle = numpy.array([tform.reverse(pt) for pt in TO_PTS])
+    print ('%s forwardMany: %e reverseMany: %e'
+           % (cls.__name__,
+              numpy.abs(tform.forwardMany(FROM_PTS) - forwardSingle).max(),
+              numpy.abs(tform.reverseMany(TO_PTS) - reverseSingle).max()))
+
 testTransformClass2(transform.CameraModelTransform)
 testTransformClass(transform.TranslateTransform)
 testTransformClass(transform.RotateScaleTranslateTransform)
@@ -99,4 +108,9 @@ testTransformClass(transform.ProjectiveTransform)
 testTransformClass(transform.QuadraticTransform)
 testTransformClass(transform.QuadraticTransform2)
 
+testManyMatchesSingle(transform.AffineTransform)
+testManyMatchesSingle(transform.ProjectiveTransform)
+testManyMatchesSingle(transform.QuadraticTransform)
+testManyMatchesSingle(transform.QuadraticTransform2)
+
 print transform.getTransform(TO_PTS, FROM_PTS)
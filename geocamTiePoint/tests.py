@@ -14,7 +14,41 @@
 # specific language governing permissions and limitations under the License.
 #__END_LICENSE__
 
-from django.test import TestCase
+import datetime
+import time
+import threading
+import tarfile
+import tempfile
+import shutil
+import os
+import json
+import hashlib
+import struct
+import unittest
+import BaseHTTPServer
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+import numpy
+import PIL.Image
+from django.conf import settings
+from django.test import TestCase, RequestFactory
+from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import HttpResponse
+
+from geocamUtil.dotDict import DotDict
+from geocamUtil import registration, geomath
+from geocamTiePoint import models, views, quadTree, transform, lruCache, rasterCache, tiledRaster, tileCache, tileStore, tileWarmup, gdalUtil
+
+try:
+    from osgeo import gdal
+    HAVE_GDAL_WARP = hasattr(gdal, 'Warp')
+except ImportError:
+    HAVE_GDAL_WARP = False
 
 
 class geocamTiePointTest(TestCase):
@@ -23,3 +57,1402 @@ class geocamTiePointTest(TestCase):
     """
     def test_geocamTiePoint(self):
         pass
+
+
+class FakeIssImageServer(object):
+    """
+    Local stand-in for the ISS image server. Serves the same JPEG for
+    every path and records the paths requested.
+    """
+    def __init__(self, imageSize):
+        out = StringIO()
+        PIL.Image.new('RGB', imageSize, (10, 20, 30)).save(out, format='jpeg')
+        imageBits = out.getvalue()
+        requests = []
+        self.requests = requests
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(imageBits)))
+                self.end_headers()
+                self.wfile.write(imageBits)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class IssImageMetadataTest(TestCase):
+    """
+    Tests for the ISS image metadata cache
+    """
+    def setUp(self):
+        self.imageServer = FakeIssImageServer((300, 200))
+        self.infoUrls = []
+        self.constructExtrasDict = models.imageInfo.constructExtrasDict
+        self.getAccurateFocalLengths = models.imageInfo.getAccurateFocalLengths
+
+        self.photoInfo = {'focalLength_unitless': 50,
+                          'nadirLat': 10.0,
+                          'nadirLon': 20.0,
+                          'altitude': 400000}
+
+        def fakeConstructExtrasDict(infoUrl):
+            self.infoUrls.append(infoUrl)
+            return DotDict(self.photoInfo)
+        models.imageInfo.constructExtrasDict = fakeConstructExtrasDict
+        models.imageInfo.getAccurateFocalLengths = lambda size, focalLength, sensorSize: (1000.0, 1001.0)
+
+        self.settingsOverride = override_settings(
+            GEOCAM_TIE_POINT_ISS_PHOTO_INFO_URL=self.imageServer.url + '/info/%s-%s-%s',
+            GEOCAM_TIE_POINT_ISS_IMAGE_ROOT_URL=self.imageServer.url,
+            GEOCAM_TIE_POINT_ISS_METADATA_CACHE_SECONDS=3600,
+            GEOCAM_TIE_POINT_ISS_METADATA_CACHE_MAX_ENTRIES=2)
+        self.settingsOverride.enable()
+
+    def tearDown(self):
+        self.settingsOverride.disable()
+        models.imageInfo.constructExtrasDict = self.constructExtrasDict
+        models.imageInfo.getAccurateFocalLengths = self.getAccurateFocalLengths
+        self.imageServer.shutdown()
+
+    def test_fetchesMetadataOnce(self):
+        extras = models.getIssImageMetadata('ISS039', 'E', '12345')
+        self.assertEqual((extras.width, extras.height), (300, 200))
+        self.assertEqual(extras.focalLength, [1000.0, 1001.0])
+        self.assertEqual(self.imageServer.requests,
+                         ['/ESC/large/ISS039/ISS039-E-12345.jpg'])
+
+        extras = models.getIssImageMetadata('ISS039', 'E', '12345')
+        self.assertEqual((extras.width, extras.height), (300, 200))
+        self.assertEqual(extras.nadirLat, 10.0)
+        self.assertEqual(len(self.imageServer.requests), 1)
+        self.assertEqual(len(self.infoUrls), 1)
+
+    def test_expiredEntryIsRefetched(self):
+        models.getIssImageMetadata('ISS039', 'E', '12345')
+        with override_settings(GEOCAM_TIE_POINT_ISS_METADATA_CACHE_SECONDS=-1):
+            models.getIssImageMetadata('ISS039', 'E', '12345')
+        self.assertEqual(len(self.infoUrls), 2)
+        self.assertEqual(models.IssImageMetadata.objects.count(), 1)
+
+    def test_incompleteMetadataIsNotCached(self):
+        del self.photoInfo['focalLength_unitless']
+        extras = models.getIssImageMetadata('ISS039', 'E', '12345')
+        self.assertEqual(extras.get('focalLength'), None)
+        self.assertEqual(models.IssImageMetadata.objects.count(), 0)
+        models.getIssImageMetadata('ISS039', 'E', '12345')
+        self.assertEqual(len(self.infoUrls), 2)
+
+    def test_leastRecentlyUsedIsEvicted(self):
+        models.getIssImageMetadata('ISS039', 'E', '1')
+        models.getIssImageMetadata('ISS039', 'E', '2')
+        models.getIssImageMetadata('ISS039', 'E', '1')  # touch frame 1
+        models.getIssImageMetadata('ISS039', 'E', '3')
+        cached = set(models.IssImageMetadata.objects.values_list('issMRF', flat=True))
+        self.assertEqual(cached, set(['ISS039-E-1', 'ISS039-E-3']))
+
+
+class LruCacheTest(TestCase):
+    def test_evictsLeastRecentlyUsedPastMaxBytes(self):
+        cache = lruCache.LruCache(10, len)
+        cache.set('a', 'xxxx')
+        cache.set('b', 'xxxx')
+        self.assertEqual(cache.get('a'), 'xxxx')
+        cache.set('c', 'xxxx')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'xxxx')
+        self.assertEqual(cache.get('c'), 'xxxx')
+        stats = cache.getStats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (3, 1, 1))
+        self.assertEqual((stats['numEntries'], stats['numBytes']), (2, 8))
+
+    def test_keepsOversizedNewestEntry(self):
+        cache = lruCache.LruCache(10, len)
+        cache.set('a', 'xxxx')
+        cache.set('b', 'x' * 20)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 'x' * 20)
+
+    def test_replacingEntryUpdatesSize(self):
+        cache = lruCache.LruCache(10, len)
+        cache.set('a', 'xxxx')
+        cache.set('a', 'xxxxxx')
+        self.assertEqual(cache.getStats()['numBytes'], 6)
+
+
+class TileCacheTest(TestCase):
+    def test_localTierServesRepeatedLookups(self):
+        key = 'geocamTiePoint.test.tileCache'
+        tileCache.delete(key)
+        generated = []
+
+        def generateTileData():
+            generated.append(1)
+            return ('bits', 'image/png')
+
+        before = tileCache.getStats()
+        for _ in xrange(3):
+            self.assertEqual(tileCache.getTileData(key, generateTileData), ('bits', 'image/png'))
+        # a restarted process has an empty local tier but shares the django cache
+        tileCache.localCacheG.delete(key)
+        self.assertEqual(tileCache.getTileData(key, generateTileData), ('bits', 'image/png'))
+        after = tileCache.getStats()
+
+        self.assertEqual(len(generated), 1)
+        self.assertEqual(after['local']['hits'] - before['local']['hits'], 2)
+        self.assertEqual(after['shared']['hits'] - before['shared']['hits'], 1)
+        self.assertEqual(after['shared']['misses'] - before['shared']['misses'], 1)
+
+    def test_getManyGeneratesOnlyMisses(self):
+        keys = ['geocamTiePoint.test.tileCacheMany.%d' % i for i in xrange(4)]
+        for key in keys:
+            tileCache.delete(key)
+        tileCache.getTileData(keys[0], lambda: ('cached', 'image/png'))
+        tileCache.localCacheG.delete(keys[0])  # only in the shared tier
+        tileCache.getTileData(keys[1], lambda: ('cached', 'image/png'))
+        generated = []
+
+        def getItem(key):
+            def generateTileData():
+                generated.append(key)
+                return (key, 'image/png')
+            return (key, generateTileData)
+
+        result = tileCache.getManyTileData([getItem(key) for key in keys], numThreads=2)
+        self.assertEqual([bits for bits, _ in result],
+                         ['cached', 'cached', keys[2], keys[3]])
+        self.assertEqual(sorted(generated), keys[2:])
+        self.assertEqual(tileCache.getTileData(keys[3], None), (keys[3], 'image/png'))
+
+    def test_getManyWithoutStore(self):
+        key = 'geocamTiePoint.test.tileCacheNoStore'
+        tileCache.delete(key)
+        result = tileCache.getManyTileData([(key, lambda: ('carried', 'image/png'))], store=False)
+        self.assertEqual(result, [('carried', 'image/png')])
+        self.assertEqual(tileCache.getCachedTileData(key), None)
+
+
+class TileStoreTest(TestCase):
+    def setUp(self):
+        self.storeDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.storeDir)
+
+    def test_writeReadClear(self):
+        basePath = os.path.join(self.storeDir, 'tiles', '12')
+        self.assertEqual(tileStore.readTile(basePath, 3, 1, 2), None)
+        tileStore.writeTile(basePath, 3, 1, 2, ('pngBits', 'image/png'))
+        tileStore.writeTile(basePath, 3, 1, 3, ('jpgBits', 'image/jpeg'))
+        self.assertEqual(tileStore.readTile(basePath, 3, 1, 2), ('pngBits', 'image/png'))
+        self.assertEqual(tileStore.readTile(basePath, 3, 1, 3), ('jpgBits', 'image/jpeg'))
+        self.assertEqual(sorted(os.listdir(os.path.join(basePath, '3', '1'))),
+                         ['2.png', '3.jpg'])
+
+        tileStore.clearTiles(basePath)
+        self.assertEqual(tileStore.readTile(basePath, 3, 1, 2), None)
+        self.assertEqual(os.listdir(os.path.join(self.storeDir, 'tiles')), [])
+
+    def test_cascadeDeleteClearsTiles(self):
+        with override_settings(DATA_ROOT=self.storeDir + '/'):
+            imageData = models.ImageData(contentType='image/png')
+            imageData.save()
+            qt = models.QuadTree(imageData=imageData)
+            qt.save()
+            tileStore.writeTile(qt.getBasePath(), 3, 1, 2, ('pngBits', 'image/png'))
+            # deleting the image data deletes its quadtrees without calling delete()
+            models.ImageData.objects.filter(id=imageData.id).delete()
+            self.assertFalse(models.QuadTree.objects.filter(id=qt.id).exists())
+            self.assertFalse(os.path.exists(qt.getBasePath()))
+
+
+class StaticTilesUrlTest(TestCase):
+    def test_staticTilesUrl(self):
+        warped = models.QuadTree(transform='{"type": "projective"}')
+        warped.save()
+        simple = models.QuadTree()
+        simple.save()
+        with override_settings(GEOCAM_TIE_POINT_STATIC_TILES_ENABLED=True,
+                               GEOCAM_TIE_POINT_TILE_STORE_ENABLED=True,
+                               DATA_URL='/data/'):
+            self.assertEqual(warped.getTilesUrl('geocamTiePoint_tile'),
+                             '/data/geocamTiePoint/tiles/%d/[ZOOM]/[X]/[Y].png' % warped.id)
+            self.assertEqual(simple.getTilesUrl('geocamTiePoint_tile'),
+                             '/data/geocamTiePoint/tiles/%d/[ZOOM]/[X]/[Y].jpg' % simple.id)
+
+
+class TileWarmupTest(TestCase):
+    def test_warmupTilesStartAtFitZoom(self):
+        # about 1/100 of the world's width
+        bounds = {'west': 0.1, 'east': 3.7, 'south': 0.1, 'north': 3.7}
+        tiles = tileWarmup.getWarmupTiles(bounds, 4, 3, 1000)
+        zooms = sorted(set([zoom for zoom, x, y in tiles]))
+        self.assertEqual(zooms, [8, 9, 10])
+        self.assertEqual(tiles[0], (8, 128, 125))
+        self.assertEqual(len(tileWarmup.getWarmupTiles(bounds, 4, 3, 5)), 5)
+
+    def test_nonFiniteBoundsSkipWarmup(self):
+        rendered = []
+        bounds = {'west': float('nan'), 'east': 3.7, 'south': 0.1, 'north': 3.7}
+        tileWarmup.startWarmup('test', 1, bounds, lambda *args: rendered.append(args))
+        tileWarmup.startWarmup('test', 1, None, lambda *args: rendered.append(args))
+        self.assertEqual(models.cache.get(tileWarmup.getCurrentQuadTreeKey('test')), None)
+        self.assertEqual(rendered, [])
+
+    def test_supersededWarmupIsSkipped(self):
+        rendered = []
+
+        def renderTile(quadTreeId, zoom, x, y):
+            rendered.append(quadTreeId)
+
+        key = tileWarmup.getCurrentQuadTreeKey('test')
+        models.cache.set(key, 2)
+        tileWarmup.warmTile('test', 1, (3, 1, 2), renderTile)
+        tileWarmup.warmTile('test', 2, (3, 1, 2), renderTile)
+        self.assertEqual(rendered, [2])
+
+
+class RasterCacheTest(TestCase):
+    def setUp(self):
+        self.cacheDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cacheDir)
+
+    def test_decodesOnceAndMemoryMaps(self):
+        image = PIL.Image.new('RGBA', (64, 48), (200, 100, 50, 255))
+        image.putpixel((3, 4), (1, 2, 3, 4))
+        decodes = []
+
+        def decodeImage():
+            decodes.append(1)
+            return image
+
+        path = os.path.join(self.cacheDir, 'sub', 'image.png.npy')
+        for _ in xrange(2):
+            cached = rasterCache.getCachedImage(path, decodeImage)
+            self.assertEqual((cached.mode, cached.size), ('RGBA', (64, 48)))
+            self.assertEqual(cached.getpixel((3, 4)), (1, 2, 3, 4))
+            self.assertTrue(cached.readonly)
+        self.assertEqual(len(decodes), 1)
+
+    def test_convertsPaletteImages(self):
+        path = os.path.join(self.cacheDir, 'image.npy')
+        rasterCache.saveRaster(PIL.Image.new('P', (8, 8)), path)
+        self.assertEqual(rasterCache.loadRaster(path).mode, 'RGBA')
+
+
+class ImageDataRasterCacheTest(TestCase):
+    def setUp(self):
+        self.dataDir = tempfile.mkdtemp() + '/'
+        self.settingsOverride = override_settings(DATA_ROOT=self.dataDir,
+                                                  MEDIA_ROOT=self.dataDir,
+                                                  GEOCAM_TIE_POINT_RASTER_CACHE_ENABLED=True)
+        self.settingsOverride.enable()
+
+    def tearDown(self):
+        self.settingsOverride.disable()
+        shutil.rmtree(self.dataDir)
+
+    def savePng(self, imageData, color):
+        out = StringIO()
+        PIL.Image.new('RGBA', (8, 8), color).save(out, format='png')
+        imageData.image.save('image.png', models.ContentFile(out.getvalue()), save=False)
+        imageData.save()
+
+    def test_cacheFollowsImage(self):
+        imageData = models.ImageData(contentType='image/png')
+        self.savePng(imageData, (1, 2, 3, 255))
+        imageData.writeTiledRaster(models.QuadTree(imageData=imageData).getImage())
+        oldPaths = [imageData.getRasterCachePath(), imageData.getTiledRasterPath()]
+        self.assertTrue(all([os.path.exists(path) for path in oldPaths]))
+
+        # replacing the image drops the decoded copies of the old one
+        self.savePng(imageData, (4, 5, 6, 255))
+        self.assertFalse(any([os.path.exists(path) for path in oldPaths]))
+        image = models.QuadTree(imageData=imageData).getImage()
+        self.assertEqual(image.getpixel((0, 0)), (4, 5, 6, 255))
+
+        # queryset deletes skip ImageData.delete() but still clean up
+        models.ImageData.objects.filter(id=imageData.id).delete()
+        self.assertFalse(os.path.exists(imageData.getRasterCacheDir()))
+        self.assertFalse(os.path.exists(imageData.getTiledRasterDir()))
+
+    def test_legacyImageIsCachedAfterConversion(self):
+        out = StringIO()
+        PIL.Image.new('RGB', (8, 8), (7, 8, 9)).save(out, format='png')
+        imageData = models.ImageData(contentType='image/png')
+        imageData.image.save('image.png', models.ContentFile(out.getvalue()), save=False)
+        imageData.save()
+        legacyPath = imageData.getRasterCachePath()
+        qt = models.QuadTree(imageData=imageData,
+                             transform=json.dumps({'type': 'projective',
+                                                   'matrix': [[10.0, 0.0, 0.0],
+                                                              [0.0, -10.0, 0.0],
+                                                              [0.0, 0.0, 1.0]]}))
+        qt.save()
+        with override_settings(GEOCAM_TIE_POINT_TILED_SOURCE_ENABLED=True):
+            qt.getGenerator()
+            tiledPath = imageData.getTiledRasterPath()
+            deadline = time.time() + 5
+            while tiledPath in models.tiledRasterWritesG and time.time() < deadline:
+                time.sleep(0.01)
+
+        # the decoded copies are stored under the converted image's name
+        self.assertNotEqual(imageData.getRasterCachePath(), legacyPath)
+        self.assertFalse(os.path.exists(legacyPath))
+        self.assertEqual(rasterCache.loadRaster(imageData.getRasterCachePath()).mode, 'RGBA')
+        self.assertEqual(tiledRaster.TiledRaster(tiledPath).mode, 'RGBA')
+
+
+class ImageChecksumTest(TestCase):
+    def setUp(self):
+        self.dataDir = tempfile.mkdtemp() + '/'
+        self.settingsOverride = override_settings(DATA_ROOT=self.dataDir,
+                                                  MEDIA_ROOT=self.dataDir)
+        self.settingsOverride.enable()
+
+    def tearDown(self):
+        self.settingsOverride.disable()
+        shutil.rmtree(self.dataDir)
+
+    def getPng(self, mode, color):
+        out = StringIO()
+        PIL.Image.new(mode, (8, 8), color).save(out, format='png')
+        return out.getvalue()
+
+    def readImage(self, imageData):
+        imageData.image.open('rb')
+        try:
+            return imageData.image.read()
+        finally:
+            imageData.image.close()
+
+    def test_rgbaUploadIsStoredAsIs(self):
+        bits = self.getPng('RGBA', (1, 2, 3, 255))
+        imageData = views.createImageData(SimpleUploadedFile('image.png', bits, 'image/png'), 'small')
+        self.assertEqual(imageData.checksum, hashlib.sha1(bits).hexdigest())
+        self.assertEqual(self.readImage(imageData), bits)
+        self.assertEqual((imageData.width, imageData.height), (8, 8))
+
+    def test_legacyConversionUpdatesChecksum(self):
+        # quadtree ids are reused across tests
+        models.tileContentIdCacheG.clear()
+        models.cache.clear()
+        bits = self.getPng('RGB', (7, 8, 9))
+        imageData = models.ImageData(contentType='image/png', checksum=hashlib.sha1(bits).hexdigest())
+        imageData.image.save('image.png', models.ContentFile(bits))
+        qt = models.QuadTree(imageData=imageData)
+        qt.save()
+        oldContentId = models.QuadTree.getTileContentIdWithCache(qt.id)
+
+        self.assertEqual(qt.decodeImage().mode, 'RGBA')
+        imageData = models.ImageData.objects.get(id=imageData.id)
+        self.assertEqual(imageData.checksum, hashlib.sha1(self.readImage(imageData)).hexdigest())
+        self.assertNotEqual(models.QuadTree.getTileContentIdWithCache(qt.id), oldContentId)
+
+
+class TiledRasterTest(TestCase):
+    def setUp(self):
+        self.rasterDir = tempfile.mkdtemp()
+        numpy.random.seed(0)
+        pixels = numpy.random.randint(0, 256, (150, 200, 4)).astype('uint8')
+        self.image = PIL.Image.fromarray(pixels, 'RGBA')
+        self.path = os.path.join(self.rasterDir, 'raster')
+        tiledRaster.writeTiledRaster(self.image, self.path, blockSize=64)
+
+    def tearDown(self):
+        shutil.rmtree(self.rasterDir)
+
+    def test_readWindowMatchesCrop(self):
+        raster = tiledRaster.TiledRaster(self.path)
+        self.assertEqual(raster.sizes, [(200, 150), (100, 75), (50, 38)])
+        for box in ((0, 0, 200, 150), (60, 10, 140, 100), (-5, -7, 30, 20), (190, 140, 210, 160)):
+            window = numpy.asarray(raster.readWindow(0, box))
+            self.assertEqual(window.tolist(), numpy.asarray(self.image.crop(box)).tolist())
+
+    def test_tiledGeneratorMatchesImageGenerator(self):
+        transformDict = {'type': 'projective',
+                         'matrix': [[20000.0, 1000.0, -300000.0],
+                                    [500.0, -20000.0, 500000.0],
+                                    [0.0, 0.0, 1.0]]}
+        imageGen = quadTree.WarpedQuadTreeGenerator('test-image', self.image, transformDict)
+        tiledGen = quadTree.WarpedQuadTreeGenerator('test-tiled', tiledRaster.TiledRaster(self.path),
+                                                    transformDict)
+        # at the max zoom both read full resolution pixels
+        for tile in imageGen.getTilesAtZoom(imageGen.maxZoom):
+            imageTile = numpy.asarray(imageGen.generateTile(*tile), dtype='float64')
+            tiledTile = numpy.asarray(tiledGen.generateTile(*tile), dtype='float64')
+            self.assertTrue(numpy.abs(imageTile - tiledTile).max() < 1, tile)
+
+    def test_rewriteReplacesRaster(self):
+        image = PIL.Image.new('L', (30, 20), 7)
+        tiledRaster.writeTiledRaster(image, self.path, blockSize=64)
+        raster = tiledRaster.TiledRaster(self.path)
+        self.assertEqual((raster.mode, raster.size), ('L', (30, 20)))
+        self.assertEqual(os.listdir(self.rasterDir), ['raster'])
+
+    def test_losingWriteRaceSucceeds(self):
+        rename = os.rename
+        image = PIL.Image.new('L', (30, 20), 7)
+
+        def renameAfterOtherWriter(src, dst):
+            if dst == self.path and not os.path.exists(dst):
+                # another process finishes writing first
+                os.rename = rename
+                tiledRaster.writeTiledRaster(image, self.path, blockSize=64)
+            rename(src, dst)
+        os.rename = renameAfterOtherWriter
+        try:
+            tiledRaster.writeTiledRaster(image, self.path, blockSize=64)
+        finally:
+            os.rename = rename
+        self.assertEqual(tiledRaster.TiledRaster(self.path).size, (30, 20))
+        self.assertEqual(os.listdir(self.rasterDir), ['raster'])
+
+
+class TempFileTarWriterTest(TestCase):
+    def test_matchesInMemoryWriter(self):
+        entries = [('meta.json', '{}'), ('tiles/0/0/0.png', 'x' * 100000)]
+        memWriter = quadTree.TarWriter('export')
+        fileWriter = quadTree.TempFileTarWriter('export')
+        for path, data in entries:
+            memWriter.writeData(path, data)
+            fileWriter.writeData(path, data)
+        exportFile = fileWriter.getFile()
+        try:
+            for out in (StringIO(memWriter.getData()), exportFile):
+                tar = tarfile.open(fileobj=out, mode='r:gz')
+                for path, data in entries:
+                    self.assertEqual(tar.extractfile('export/' + path).read(), data)
+                tar.close()
+        finally:
+            exportFile.close()
+
+
+class RecordingWriter(object):
+    """
+    quadTree writer that keeps a list of the (path, data) entries written.
+    """
+    def __init__(self):
+        self.entries = []
+
+    def writeData(self, path, data):
+        self.entries.append((path, data))
+
+
+def getTestWarpedGenerator(quadTreeId):
+    image = PIL.Image.new('RGBA', (64, 48), (200, 100, 50, 255))
+    for i in xrange(48):
+        image.putpixel((i, i), (0, 0, 0, 255))
+    metersPerPixel = 20000.0
+    transformDict = {'type': 'projective',
+                     'matrix': [[metersPerPixel, 0.0, -300000.0],
+                                [0.0, -metersPerPixel, 500000.0],
+                                [0.0, 0.0, 1.0]]}
+    return quadTree.WarpedQuadTreeGenerator(quadTreeId, image, transformDict)
+
+
+class AdaptiveMeshTest(TestCase):
+    """
+    Tests for WarpedQuadTreeGenerator.getAdaptiveMeshPatches
+    """
+    def getGenerator(self, quadraticScale):
+        image = PIL.Image.new('RGBA', (640, 480))
+        transformDict = {'type': 'quadratic',
+                         'matrix': [[quadraticScale, 0.0, 20000.0, 0.0, -3000000.0],
+                                    [0.0, -quadraticScale, 0.0, -20000.0, 5000000.0],
+                                    [0.0, 0.0, 0.0, 0.0, 1.0]]}
+        return quadTree.WarpedQuadTreeGenerator('test-mesh', image, transformDict)
+
+    def test_linearTileUsesOnePatch(self):
+        gen = self.getGenerator(0.0)
+        targetBoxes, _ = gen.getAdaptiveMeshPatches(*gen.getTilesAtZoom(3)[0])
+        self.assertEqual(targetBoxes.tolist(), [[0, 0, quadTree.TILE_SIZE, quadTree.TILE_SIZE]])
+
+    def test_curvedTileIsWithinTolerance(self):
+        gen = self.getGenerator(20.0)
+        zoom, x, y = gen.getTilesAtZoom(3)[4]
+        targetBoxes, sourceCorners = gen.getAdaptiveMeshPatches(zoom, x, y)
+        self.assertTrue(len(targetBoxes) > 1)
+        sizes = targetBoxes[:, 2] - targetBoxes[:, 0]
+        self.assertEqual((sizes ** 2).sum(), quadTree.TILE_SIZE ** 2)
+
+        # compare bilinear interpolation at random points in each patch
+        # against the exact transform
+        numpy.random.seed(0)
+        fractions = numpy.random.rand(len(targetBoxes), 2)
+        targetPts = targetBoxes[:, :2] + fractions * sizes[:, numpy.newaxis]
+        pixels = targetPts + numpy.array(quadTree.tileIndexToPixels(x, y))
+        exact = gen.transform.reverseMany(numpy.column_stack(
+            transform.pixelsToMeters(pixels[:, 0], pixels[:, 1], zoom)))
+        ul, ll, lr, ur = [sourceCorners[:, 2 * i:2 * i + 2] for i in xrange(4)]
+        fx, fy = fractions[:, :1], fractions[:, 1:]
+        interpolated = ((1 - fx) * (1 - fy) * ul + (1 - fx) * fy * ll
+                        + fx * fy * lr + fx * (1 - fy) * ur)
+        error = numpy.hypot(*(interpolated - exact).T)
+        sourcePixelsPerTilePixel = numpy.hypot(*(ur - ul).T) / sizes
+        self.assertTrue((error / sourcePixelsPerTilePixel).max()
+                        < 2 * quadTree.MESH_MAX_ERROR_PIXELS)
+
+
+class TileQualityTest(TestCase):
+    """
+    Tests for the WarpedQuadTreeGenerator tile quality modes
+    """
+    def getGenerator(self, quality):
+        # smooth gradient, so all modes should produce about the same tiles
+        gradient = numpy.zeros((480, 640, 4), dtype='uint8')
+        gradient[:, :, 0] = numpy.linspace(0, 255, 640)[numpy.newaxis, :]
+        gradient[:, :, 1] = numpy.linspace(0, 255, 480)[:, numpy.newaxis]
+        gradient[:, :, 3] = 255
+        image = PIL.Image.fromarray(gradient, 'RGBA')
+        transformDict = {'type': 'projective',
+                         'matrix': [[2000.0, 100.0, -300000.0],
+                                    [50.0, -2000.0, 500000.0],
+                                    [0.0, 0.0, 1.0]]}
+        return quadTree.WarpedQuadTreeGenerator('test-quality', image, transformDict, quality)
+
+    def test_fastMatchesHigh(self):
+        fastGen = self.getGenerator(quadTree.TILE_QUALITY_FAST)
+        highGen = self.getGenerator(quadTree.TILE_QUALITY_HIGH)
+        for zoom in (fastGen.maxZoom - 3, fastGen.maxZoom):
+            for tile in fastGen.getTilesAtZoom(zoom):
+                fastTile = numpy.asarray(fastGen.generateTile(*tile), dtype='float64')
+                highTile = numpy.asarray(highGen.generateTile(*tile), dtype='float64')
+                self.assertTrue(numpy.abs(fastTile - highTile).mean() < 3, tile)
+
+    def test_lowZoomReadsOverview(self):
+        gen = self.getGenerator(quadTree.TILE_QUALITY_HIGH)
+        zoom, x, y = gen.getTilesAtZoom(gen.maxZoom - 3)[0]
+        tile = numpy.asarray(gen.generateTile(zoom, x, y), dtype='float64')
+        self.assertTrue(len(gen.source.levels) > 1)
+
+        # compare with a warp of the full resolution image
+        transformArgs = gen.getPilTransformArgs(zoom, x, y, int(quadTree.TILE_SIZE * 4))
+        reference = (gen.image.transform(*transformArgs)
+                     .resize((int(quadTree.TILE_SIZE),) * 2, PIL.Image.ANTIALIAS))
+        self.assertTrue(numpy.abs(tile - numpy.asarray(reference, dtype='float64')).mean() < 3)
+
+    def test_qualityIsPartOfCacheKey(self):
+        fastGen = self.getGenerator(quadTree.TILE_QUALITY_FAST)
+        highGen = self.getGenerator(quadTree.TILE_QUALITY_HIGH)
+        self.assertNotEqual(fastGen.getTileCacheKey(3, 1, 2),
+                            highGen.getTileCacheKey(3, 1, 2))
+
+    def test_unknownQuality(self):
+        self.assertRaises(ValueError, self.getGenerator, 'best')
+
+
+class TileDisplacementTest(TestCase):
+    def test_displacementInTilePixels(self):
+        matrix = [[30.0, 2.0, -300000.0],
+                  [1.0, -30.0, 500000.0],
+                  [0.0, 0.0, 1.0]]
+        oldTransform = transform.makeTransform({'type': 'projective', 'matrix': matrix})
+        zoom = 12
+        res = transform.resolution(zoom)
+        # shift the new transform east by a quarter of a tile pixel
+        shifted = [row[:] for row in matrix]
+        shifted[0][2] += 0.25 * res
+        newTransform = transform.makeTransform({'type': 'projective', 'matrix': shifted})
+        x, y = quadTree.tileIndex(zoom, oldTransform.forward([100, 100]))
+
+        self.assertAlmostEqual(quadTree.getMaxTileDisplacement(oldTransform, oldTransform, zoom, x, y), 0)
+        self.assertAlmostEqual(quadTree.getMaxTileDisplacement(oldTransform, newTransform, zoom, x, y),
+                               0.25, places=3)
+
+
+class CarriedOverTileEtagTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def getResponse(self, ifNoneMatch, carriedOverKeys):
+        headers = {}
+        if ifNoneMatch:
+            headers['HTTP_IF_NONE_MATCH'] = ifNoneMatch
+        request = self.factory.get('/tile', **headers)
+        return views.conditionalTileResponse(request, ['newKey'],
+                                             lambda: (HttpResponse('tile'), carriedOverKeys))
+
+    def test_renderedTileHasStrongEtag(self):
+        response = self.getResponse(None, [])
+        self.assertFalse(response['ETag'].startswith('W/'))
+        self.assertTrue(response.has_header('Expires'))
+        response = self.getResponse(response['ETag'], [])
+        self.assertEqual(response.status_code, 304)
+
+    def test_carriedOverTileHasWeakEtag(self):
+        response = self.getResponse(None, ['oldKey'])
+        weakEtag = response['ETag']
+        self.assertTrue(weakEtag.startswith('W/'))
+        self.assertFalse(response.has_header('Expires'))
+        response = self.getResponse(weakEtag, ['oldKey'])
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(response.has_header('Expires'))
+        # once the real render replaces it, the client gets the new bits
+        response = self.getResponse(weakEtag, [])
+        self.assertEqual((response.status_code, response.content), (200, 'tile'))
+
+
+def saveTestOverlay():
+    """
+    Saves an overlay of an 8x8 RGBA image, with an unaligned and an
+    aligned quadtree. Uses the DATA_ROOT and MEDIA_ROOT settings.
+    """
+    out = StringIO()
+    PIL.Image.new('RGBA', (8, 8), (1, 2, 3, 255)).save(out, format='png')
+    imageData = models.ImageData(contentType='image/png', width=8, height=8)
+    imageData.image.save('image.png', models.ContentFile(out.getvalue()), save=False)
+    imageData.save()
+    unalignedQuadTree = models.QuadTree(imageData=imageData)
+    unalignedQuadTree.save()
+    alignedQuadTree = models.QuadTree(imageData=imageData,
+                                      transform='{"type": "projective"}')
+    alignedQuadTree.save()
+    overlay = models.Overlay(name='test', imageData=imageData,
+                             unalignedQuadTree=unalignedQuadTree,
+                             alignedQuadTree=alignedQuadTree)
+    overlay.save()
+    return overlay
+
+
+class ConditionalGetTest(TestCase):
+    """
+    Tests that views answer a matching If-None-Match with an empty 304
+    """
+    def setUp(self):
+        self.dataDir = tempfile.mkdtemp() + '/'
+        self.settingsOverride = override_settings(DATA_ROOT=self.dataDir,
+                                                  MEDIA_ROOT=self.dataDir,
+                                                  GEOCAM_TIE_POINT_TILE_STORE_ENABLED=False)
+        self.settingsOverride.enable()
+        self.overlay = saveTestOverlay()
+        self.quadTree = self.overlay.unalignedQuadTree
+        self.overlay.alignedQuadTree.htmlExport.save('export.tar.gz',
+                                                     models.ContentFile('html export'))
+
+    def tearDown(self):
+        self.settingsOverride.disable()
+        shutil.rmtree(self.dataDir)
+
+    def assertRevalidates(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content)
+        etag = response['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+        self.assertEqual(response['ETag'], etag)
+        # a stale copy gets the full body again
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"stale"')
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_tile(self):
+        self.assertRevalidates(reverse('geocamTiePoint_tile',
+                                       kwargs={'quadTreeId': self.quadTree.id,
+                                               'zoom': '0', 'x': '0', 'y': '0.png'}))
+
+    def test_overlayJson(self):
+        url = reverse('geocamTiePoint_overlayIdJson', kwargs={'key': self.overlay.key})
+        response = self.assertRevalidates(url)
+        self.assertEqual(json.loads(response.content)['name'], 'test')
+
+    def test_overlayImage(self):
+        url = reverse('geocamTiePoint_overlayIdImageFileName',
+                      kwargs={'key': self.overlay.key, 'fileName': 'image.png'})
+        response = self.assertRevalidates(url)
+        self.assertEqual(response['Content-Type'], 'image/png')
+
+    def test_export(self):
+        url = reverse('geocamTiePoint_overlayExport',
+                      kwargs={'key': self.overlay.key, 'type': 'html', 'fname': 'export.tar.gz'})
+        response = self.assertRevalidates(url)
+        self.assertEqual(response.content, 'html export')
+
+    def test_unknownExportType(self):
+        url = reverse('geocamTiePoint_overlayExport',
+                      kwargs={'key': self.overlay.key, 'type': 'pdf', 'fname': 'export.tar.gz'})
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(response.status_code, 404)
+
+
+class TileBatchTest(TestCase):
+    def setUp(self):
+        self.dataDir = tempfile.mkdtemp() + '/'
+        self.settingsOverride = override_settings(DATA_ROOT=self.dataDir,
+                                                  MEDIA_ROOT=self.dataDir,
+                                                  GEOCAM_TIE_POINT_TILE_STORE_ENABLED=False)
+        self.settingsOverride.enable()
+        self.quadTree = saveTestOverlay().unalignedQuadTree
+        self.url = reverse('geocamTiePoint_tileBatch', kwargs={'quadTreeId': self.quadTree.id})
+
+    def tearDown(self):
+        self.settingsOverride.disable()
+        shutil.rmtree(self.dataDir)
+
+    def unpack(self, body):
+        tiles = []
+        offset = 0
+        while offset < len(body):
+            typeLength, dataLength = struct.unpack_from('>II', body, offset)
+            offset += struct.calcsize('>II')
+            contentType = body[offset:offset + typeLength]
+            offset += typeLength
+            tiles.append((body[offset:offset + dataLength], contentType))
+            offset += dataLength
+        return tiles
+
+    def test_packedTilesMatchSingleTiles(self):
+        tiles = [(0, 0, 0), (1, 0, 0), (0, 0, 0)]
+        response = self.client.get(self.url, {'tiles': ','.join(['%s/%s/%s' % tile for tile in tiles])})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        batchTiles = self.unpack(response.content)
+        self.assertEqual(len(batchTiles), len(tiles))
+        for (zoom, x, y), (bits, contentType) in zip(tiles, batchTiles):
+            single = self.client.get(reverse('geocamTiePoint_tile',
+                                             kwargs={'quadTreeId': self.quadTree.id,
+                                                     'zoom': zoom, 'x': x, 'y': '%s.png' % y}))
+            self.assertEqual((bits, contentType), (single.content, single['Content-Type']))
+
+    def test_malformedTileList(self):
+        for tileList in ('', '0/0', '0/0/0,', 'a/b/c'):
+            response = self.client.get(self.url, {'tiles': tileList})
+            self.assertEqual(response.status_code, 400, tileList)
+
+    def test_tooManyTiles(self):
+        with override_settings(GEOCAM_TIE_POINT_TILE_BATCH_MAX_TILES=2):
+            response = self.client.get(self.url, {'tiles': '0/0/0,1/0/0,1/1/0'})
+        self.assertEqual(response.status_code, 400)
+
+
+class OverlayJsonPostTest(TestCase):
+    # the right edge of the image maps to infinity, like a camera model
+    # whose corner rays miss the earth
+    SKY_TRANSFORM = {'type': 'projective',
+                     'matrix': [[1000.0, 0.0, 0.0],
+                                [0.0, -1000.0, 0.0],
+                                [-1 / 8.0, 0.0, 1.0]]}
+
+    def setUp(self):
+        self.dataDir = tempfile.mkdtemp() + '/'
+        self.settingsOverride = override_settings(DATA_ROOT=self.dataDir,
+                                                  MEDIA_ROOT=self.dataDir,
+                                                  GEOCAM_TIE_POINT_WARMUP_ENABLED=True)
+        self.settingsOverride.enable()
+        self.overlay = saveTestOverlay()
+        self.url = reverse('geocamTiePoint_overlayIdJson', kwargs={'key': self.overlay.key})
+        self.warmups = []
+        self.startWarmup = tileWarmup.startWarmup
+        tileWarmup.startWarmup = lambda *args: self.warmups.append(args)
+
+    def tearDown(self):
+        tileWarmup.startWarmup = self.startWarmup
+        self.settingsOverride.disable()
+        shutil.rmtree(self.dataDir)
+
+    def postTransform(self, transformDict):
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return self.client.post(self.url, json.dumps({'transform': transformDict}),
+                                    content_type='application/json')
+
+    def test_skyCornerGivesFiniteBounds(self):
+        response = self.postTransform(self.SKY_TRANSFORM)
+        self.assertEqual(response.status_code, 200)
+        bounds = models.Overlay.objects.get(key=self.overlay.key).extras.bounds
+        self.assertTrue(tileWarmup.boundsAreFinite(bounds))
+        self.assertEqual(len(self.warmups), 1)
+        self.assertEqual(self.warmups[0][2], bounds)
+
+    def test_warmupFailureDoesNotFailRequest(self):
+        def failingStartWarmup(*args):
+            raise ValueError('cannot convert float NaN to integer')
+        tileWarmup.startWarmup = failingStartWarmup
+        response = self.postTransform(self.SKY_TRANSFORM)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['transform'], self.SKY_TRANSFORM)
+
+
+class TileContentIdTest(TestCase):
+    """
+    Tests for content-addressed tile cache keys
+    """
+    def test_sameInputsShareTiles(self):
+        transformDict = {'type': 'projective',
+                         'matrix': [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]}
+        # same transform, different key order, as after a round trip through the db
+        reordered = json.loads(json.dumps(transformDict, sort_keys=True))
+        self.assertEqual(quadTree.getTileContentId('abc', transformDict),
+                         quadTree.getTileContentId('abc', reordered))
+
+    def test_differentInputsDontShareTiles(self):
+        transformDict = {'type': 'projective',
+                         'matrix': [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]}
+        otherTransformDict = {'type': 'projective',
+                              'matrix': [[2.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]}
+        contentIds = set([quadTree.getTileContentId('abc', transformDict),
+                          quadTree.getTileContentId('abc', otherTransformDict),
+                          quadTree.getTileContentId('abd', transformDict),
+                          quadTree.getTileContentId('abc')])
+        self.assertEqual(len(contentIds), 4)
+
+    def test_generatorAndViewShareTileKey(self):
+        models.tileContentIdCacheG.clear()
+        models.cache.clear()
+        imageData = models.ImageData(contentType='image/png', checksum='abc')
+        imageData.save()
+        qt = models.QuadTree(imageData=imageData)
+        qt.save()
+        gen = quadTree.SimpleQuadTreeGenerator(qt.id, PIL.Image.new('RGBA', (8, 8)),
+                                               contentId=qt.getTileContentId(),
+                                               quality=settings.GEOCAM_TIE_POINT_TILE_QUALITY)
+        self.assertEqual(gen.getTileCacheKey(3, 1, 2),
+                         views.getServedTileCacheKey(qt.id, 3, 1, 2))
+
+    def test_contentIdIsCachedInProcess(self):
+        # quadtree ids are reused across tests
+        models.tileContentIdCacheG.clear()
+        models.cache.clear()
+        imageData = models.ImageData(contentType='image/png', checksum='abc')
+        imageData.save()
+        qt = models.QuadTree(imageData=imageData)
+        qt.save()
+        contentId = models.QuadTree.getTileContentIdWithCache(qt.id)
+        self.assertEqual(contentId, quadTree.getTileContentId('abc'))
+
+        # later lookups need neither the shared cache nor the database
+        sharedGet = models.cache.get
+        models.cache.get = None
+        try:
+            models.QuadTree.objects.filter(id=qt.id).update(transform='{"type": "projective"}')
+            self.assertEqual(models.QuadTree.getTileContentIdWithCache(qt.id), contentId)
+        finally:
+            models.cache.get = sharedGet
+
+
+class WriteQuadTreeTest(TestCase):
+    """
+    Tests for WarpedQuadTreeGenerator.writeQuadTree
+    """
+    def test_parallelMatchesSerial(self):
+        serialWriter = RecordingWriter()
+        getTestWarpedGenerator('test-serial').writeQuadTree(serialWriter, 'slug')
+
+        progress = []
+        parallelWriter = RecordingWriter()
+        (getTestWarpedGenerator('test-parallel')
+         .writeQuadTree(parallelWriter, 'slug', numWorkers=2,
+                        progressCallback=lambda *args: progress.append(args)))
+        self.assertEqual(quadTree.parallelGeneratorG, None)
+
+        self.assertTrue(serialWriter.entries)
+        self.assertEqual(serialWriter.entries, parallelWriter.entries)
+        self.assertEqual([zoom for zoom, _, _ in progress],
+                         range(len(progress) - 1, -1, -1))
+        _, tilesSoFar, totalTiles = progress[-1]
+        self.assertEqual(tilesSoFar, totalTiles)
+
+    def test_progressIsReportedWithinZoomLevels(self):
+        savedInterval = quadTree.PROGRESS_INTERVAL_TILES
+        quadTree.PROGRESS_INTERVAL_TILES = 1
+        try:
+            for downsampleLowZooms in (False, True):
+                progress = []
+                gen = getTestWarpedGenerator('test-progress')
+                gen.writeQuadTree(RecordingWriter(), 'slug',
+                                  progressCallback=lambda *args: progress.append(args),
+                                  downsampleLowZooms=downsampleLowZooms)
+                totalTiles = progress[-1][2]
+                tilesSoFar = [t for _, t, _ in progress]
+                self.assertTrue(totalTiles > len(range(int(gen.maxZoom) + 1)))
+                self.assertEqual(sorted(set(tilesSoFar)), range(1, totalTiles + 1))
+        finally:
+            quadTree.PROGRESS_INTERVAL_TILES = savedInterval
+
+    def test_downsampledLowZoomsMatchWarped(self):
+        warpedWriter = RecordingWriter()
+        getTestWarpedGenerator('test-warped').writeQuadTree(warpedWriter, 'slug')
+
+        downsampledWriter = RecordingWriter()
+        (getTestWarpedGenerator('test-downsampled')
+         .writeQuadTree(downsampledWriter, 'slug', downsampleLowZooms=True))
+
+        warpedTiles = dict(warpedWriter.entries)
+        downsampledTiles = dict(downsampledWriter.entries)
+        self.assertEqual(sorted(warpedTiles.keys()), sorted(downsampledTiles.keys()))
+        for path, bits in warpedTiles.iteritems():
+            warped = numpy.asarray(PIL.Image.open(StringIO(bits)), dtype='float64')
+            downsampled = numpy.asarray(PIL.Image.open(StringIO(downsampledTiles[path])),
+                                        dtype='float64')
+            self.assertTrue(numpy.abs(warped - downsampled).mean() < 2,
+                            'tile %s differs too much' % path)
+
+
+    def test_downsampledPyramidIsWrittenDepthFirst(self):
+        # big enough to have 20 tiles at the max zoom level
+        image = PIL.Image.new('RGBA', (1024, 768), (200, 100, 50, 255))
+        transformDict = {'type': 'projective',
+                         'matrix': [[1250.0, 0.0, 2600000.0],
+                                    [0.0, -1250.0, 2600000.0],
+                                    [0.0, 0.0, 1.0]]}
+        gen = quadTree.WarpedQuadTreeGenerator('test-depth-first', image, transformDict,
+                                               quality=quadTree.TILE_QUALITY_FAST)
+        writer = RecordingWriter()
+        gen.writeQuadTree(writer, 'slug', downsampleLowZooms=True)
+        self.assertTrue(len(gen.getTilesAtZoom(gen.maxZoom)) > 4)
+        # each parent is written before tiles of other parents' subtrees
+        # are rendered, so only its own children wait in memory
+        waiting = set()
+        for path, _ in writer.entries:
+            zoom, x, y = [int(v) for v in os.path.splitext(path)[0].split('/')[1:]]
+            waiting -= set([(zoom + 1, 2 * x + dx, 2 * y + dy) for dx in (0, 1) for dy in (0, 1)])
+            waiting.add((zoom, x, y))
+            for level in xrange(int(gen.maxZoom) + 1):
+                self.assertTrue(len([t for t in waiting if t[0] == level]) <= 4)
+        self.assertEqual(waiting, set([(0, 0, 0)]))
+
+
+class TransformJacobianTest(TestCase):
+    def setUp(self):
+        xs, ys = numpy.meshgrid(numpy.linspace(0, 1000, 5), numpy.linspace(0, 800, 4))
+        self.fromPts = numpy.column_stack([xs.flatten(), ys.flatten()])
+        x, y = self.fromPts[:, 0], self.fromPts[:, 1]
+        self.toPts = numpy.column_stack([-1.0e7 + 2000 * x + 0.4 * x * x + 30 * y,
+                                         4.0e6 - 1900 * y - 0.3 * y * y + 20 * x])
+
+    def assertMatchesNumericalJacobian(self, cls, params):
+        analytic = cls.jacobian(params, self.fromPts)
+        numerical = super(cls, cls).jacobian(params, self.fromPts)  # Transform.jacobian
+        self.assertEqual(analytic.shape, numerical.shape)
+        # forward differences with a 1e-7 step are only good to about
+        # 1e-4 relative for the projective terms at x ~ 1000
+        error = numpy.abs(analytic - numerical).max(axis=0)
+        self.assertTrue((error <= 2e-4 * numpy.abs(analytic).max(axis=0)).all(),
+                        '%s jacobian error %s' % (cls.__name__, error))
+
+    def test_rotateScaleTranslate(self):
+        cls = transform.RotateScaleTranslateTransform
+        self.assertMatchesNumericalJacobian(cls, cls.getInitParams(self.toPts, self.fromPts))
+
+    def test_projective(self):
+        cls = transform.ProjectiveTransform
+        params = numpy.array(cls.getInitParams(self.toPts, self.fromPts), dtype='float64')
+        params[6:8] = [2e-5, -1e-5]
+        self.assertMatchesNumericalJacobian(cls, params)
+
+    def test_quadratic(self):
+        cls = transform.QuadraticTransform
+        params = numpy.array(cls.getInitParams(self.toPts, self.fromPts), dtype='float64')
+        params[[0, 1, 5, 6]] = [0.4, 0.1, -0.2, -0.3]
+        params[10:12] = [2e-5, -1e-5]
+        self.assertMatchesNumericalJacobian(cls, params)
+
+    def test_quadratic2(self):
+        cls = transform.QuadraticTransform2
+        params = numpy.array(cls.getInitParams(self.toPts, self.fromPts), dtype='float64')
+        params[6:8] = [2e-5, -1e-5]
+        params[8:] = [1e-5, -2e-5, 3e-5, 1e-5]
+        self.assertMatchesNumericalJacobian(cls, params)
+
+
+class VectorizedTransformTest(TestCase):
+    """
+    forwardMany() and reverseMany() must agree with the single point
+    forward() and reverse()
+    """
+    def setUp(self):
+        xs, ys = numpy.meshgrid(numpy.linspace(0, 1000, 5), numpy.linspace(0, 800, 4))
+        self.fromPts = numpy.column_stack([xs.flatten(), ys.flatten()])
+        x, y = self.fromPts[:, 0], self.fromPts[:, 1]
+        self.toPts = numpy.column_stack([-1.0e7 + 2000 * x + 0.4 * x * x + 30 * y,
+                                         4.0e6 - 1900 * y - 0.3 * y * y + 20 * x])
+
+    def assertManyMatchesSingle(self, tform):
+        forward = numpy.array([tform.forward(pt) for pt in self.fromPts])
+        self.assertTrue(numpy.allclose(tform.forwardMany(self.fromPts), forward,
+                                       rtol=1e-12, atol=1e-6))
+        reverse = numpy.array([tform.reverse(pt) for pt in forward])
+        self.assertTrue(numpy.allclose(tform.reverseMany(forward), reverse,
+                                       rtol=1e-9, atol=1e-6))
+        self.assertTrue(numpy.allclose(reverse, self.fromPts, rtol=0, atol=1e-4))
+
+    def test_linear(self):
+        self.assertManyMatchesSingle(transform.AffineTransform.fit(self.toPts, self.fromPts))
+
+    def test_projective(self):
+        cls = transform.ProjectiveTransform
+        params = numpy.array(cls.getInitParams(self.toPts, self.fromPts), dtype='float64')
+        params[6:8] = [2e-5, -1e-5]
+        self.assertManyMatchesSingle(cls.fromParams(params))
+
+    def test_quadratic2(self):
+        cls = transform.QuadraticTransform2
+        params = numpy.array(cls.getInitParams(self.toPts, self.fromPts), dtype='float64')
+        params[6:8] = [2e-5, -1e-5]
+        params[8:] = [1e-5, -2e-5, 3e-5, 1e-5]
+        self.assertManyMatchesSingle(cls.fromParams(params))
+
+
+class QuadraticTransformTest(TestCase):
+    def setUp(self):
+        xs, ys = numpy.meshgrid(numpy.linspace(0, 1000, 11), numpy.linspace(0, 800, 9))
+        self.grid = numpy.column_stack([xs.flatten(), ys.flatten()])
+        # fit to a mapping with strong curvature in both axes
+        x, y = self.grid[:, 0], self.grid[:, 1]
+        toPts = numpy.column_stack([-1.0e7 + 2000 * x + 0.4 * x * x + 30 * y,
+                                    4.0e6 - 1900 * y - 0.3 * y * y + 20 * x])
+        self.tform = transform.QuadraticTransform.fit(toPts, self.grid)
+        self.assertTrue(numpy.abs(self.tform.matrix[:2, :2]).max() > 0.01)
+
+    def assertRoundTrips(self, expected, fromPts, toPts):
+        self.assertTrue(numpy.allclose(fromPts, expected, rtol=0, atol=1e-6))
+        error = numpy.abs(self.tform.forwardMany(fromPts) - toPts).max()
+        self.assertTrue(error < 1e-10 * numpy.abs(toPts).max())
+
+    def test_reverseManyInvertsForward(self):
+        toPts = self.tform.forwardMany(self.grid)
+        self.assertRoundTrips(self.grid, self.tform.reverseMany(toPts), toPts)
+
+    def test_reverseManyFallsBackToOptimizer(self):
+        # one newton step can't converge on a curved transform, so every
+        # point goes through the L-M fallback
+        self.tform.NEWTON_MAX_ITERATIONS = 1
+        fallbacks = []
+        reverseOptimize = self.tform._reverseOptimize
+
+        def recordingReverseOptimize(v, u0):
+            fallbacks.append(v)
+            return reverseOptimize(v, u0)
+        self.tform._reverseOptimize = recordingReverseOptimize
+
+        farPts = self.grid[-3:]  # far from the origin, where curvature matters
+        toPts = self.tform.forwardMany(farPts)
+        fromPts = self.tform.reverseMany(toPts)
+        self.assertEqual(len(fallbacks), 3)
+        self.assertRoundTrips(farPts, fromPts, toPts)
+
+
+def geocamUtilHas(module, *names):
+    return all(callable(getattr(module, name, None)) for name in names)
+
+
+class EcefConversionTest(TestCase):
+    LON_LAT_ALTS = [(-95.0, 30.0, 0.0),
+                    (0.0, 0.0, 400000.0),
+                    (179.5, -89.9, -100.0),
+                    (-10.0, 60.0, 8848.0)]
+
+    def test_lonLatAltToEcefManyMatchesGeomath(self):
+        ecef = transform.lonLatAltToEcefMany(self.LON_LAT_ALTS)
+        for lonLatAlt, row in zip(self.LON_LAT_ALTS, ecef):
+            expected = geomath.transformLonLatAltToEcef(lonLatAlt)
+            self.assertTrue(numpy.allclose(row, numpy.asarray(expected, dtype='float64').flatten(),
+                                           rtol=0, atol=1e-6))
+
+    @unittest.skipUnless(geocamUtilHas(geomath, 'transformEcefToLonLatAlt'),
+                         'requires geocamUtil.geomath.transformEcefToLonLatAlt')
+    def test_ecefToLonLatAltManyMatchesGeomath(self):
+        ecef = transform.lonLatAltToEcefMany(self.LON_LAT_ALTS)
+        lonLatAlts = transform.ecefToLonLatAltMany(ecef)
+        for ecefPt, row in zip(ecef, lonLatAlts):
+            expected = numpy.asarray(geomath.transformEcefToLonLatAlt(tuple(ecefPt)), dtype='float64').flatten()
+            self.assertTrue(numpy.allclose(row[:2], expected[:2], rtol=0, atol=1e-9))
+            self.assertAlmostEqual(row[2], expected[2], places=4)
+
+    def test_ecefRoundTrip(self):
+        lonLatAlts = transform.ecefToLonLatAltMany(transform.lonLatAltToEcefMany(self.LON_LAT_ALTS))
+        self.assertTrue(numpy.allclose(lonLatAlts[:, :2], numpy.asarray(self.LON_LAT_ALTS)[:, :2],
+                                       rtol=0, atol=1e-9))
+        self.assertTrue(numpy.allclose(lonLatAlts[:, 2], numpy.asarray(self.LON_LAT_ALTS)[:, 2],
+                                       rtol=0, atol=1e-4))
+
+
+@unittest.skipUnless(geocamUtilHas(registration, 'rotFromEul', 'eulFromRot', 'rotMatrixOfCameraInEcef'),
+                     'requires geocamUtil.registration')
+class CameraModelTransformTest(TestCase):
+    CAMERA_LON_LAT_ALT = (-95.0, 30.0, 400000.0)
+    WIDTH, HEIGHT = 4000, 3000
+    FOCAL_LENGTH = 4000.0
+    # far enough off axis (about 79 degrees from nadir) to miss the earth
+    SKY_PIXEL = [WIDTH / 2 + 5 * FOCAL_LENGTH, HEIGHT / 2]
+
+    def setUp(self):
+        lon, lat, alt = self.CAMERA_LON_LAT_ALT
+        # nadir pointing, tilted a bit so the rays aren't symmetric
+        rotMatrix = registration.rotMatrixOfCameraInEcef(lon, geomath.transformLonLatAltToEcef(self.CAMERA_LON_LAT_ALT))
+        roll, pitch, yaw = registration.eulFromRot(rotMatrix)
+        self.tform = transform.CameraModelTransform([lat, lon, alt, roll + 0.05, pitch - 0.03, yaw],
+                                                    self.WIDTH, self.HEIGHT,
+                                                    self.FOCAL_LENGTH, self.FOCAL_LENGTH)
+        xs, ys = numpy.meshgrid(numpy.linspace(0, self.WIDTH, 7), numpy.linspace(0, self.HEIGHT, 5))
+        self.pixels = numpy.column_stack([xs.flatten(), ys.flatten()])
+
+    @unittest.skipUnless(geocamUtilHas(registration, 'imageCoordToEcef') and
+                         geocamUtilHas(geomath, 'transformEcefToLonLatAlt'),
+                         'requires geocamUtil.registration.imageCoordToEcef')
+    def test_forwardManyMatchesImageCoordToEcef(self):
+        lat, lon, alt, roll, pitch, yaw = self.tform.params
+        rotMatrix = registration.rotFromEul(roll, pitch, yaw)
+        pixels = numpy.vstack([self.pixels, [self.SKY_PIXEL]])
+        result = self.tform.forwardMany(pixels)
+        for pixel, row in zip(pixels, result):
+            ecef = registration.imageCoordToEcef((lon, lat, alt), pixel,
+                                                 (self.WIDTH / 2, self.HEIGHT / 2),
+                                                 (self.FOCAL_LENGTH, self.FOCAL_LENGTH),
+                                                 rotMatrix)
+            if ecef is None:
+                self.assertFalse(numpy.isfinite(row).any())
+                continue
+            ecef = numpy.asarray(ecef, dtype='float64').flatten()
+            lonLatAlt = geomath.transformEcefToLonLatAlt(tuple(ecef))
+            expected = transform.lonLatToMeters(lonLatAlt[:2])
+            self.assertTrue(numpy.allclose(row, expected, rtol=0, atol=1e-3))
+        self.assertEqual(self.tform.forward(self.SKY_PIXEL), None)
+
+    def test_reverseManyMatchesScalarProjection(self):
+        lat, lon, alt, roll, pitch, yaw = self.tform.params
+        rotation = numpy.transpose(registration.rotFromEul(roll, pitch, yaw))
+        cameraMatrix = numpy.matrix([[self.FOCAL_LENGTH, 0, self.WIDTH / 2.0],
+                                     [0, self.FOCAL_LENGTH, self.HEIGHT / 2.0],
+                                     [0, 0, 1]])
+        cameraPose = numpy.matrix(geomath.transformLonLatAltToEcef((lon, lat, alt)), dtype='float64').reshape((3, 1))
+        rotTransMat = numpy.c_[rotation, -1 * rotation * cameraPose]
+        meters = self.tform.forwardMany(self.pixels)
+        result = self.tform.reverseMany(meters)
+        for pt, row in zip(meters, result):
+            ptLon, ptLat = transform.metersToLatLon(pt)
+            ptEcef = geomath.transformLonLatAltToEcef([ptLon, ptLat, 0])
+            ptInImage = cameraMatrix * rotTransMat * numpy.matrix(list(ptEcef) + [1]).transpose()
+            expected = [ptInImage.item(0) / ptInImage.item(2), ptInImage.item(1) / ptInImage.item(2)]
+            self.assertTrue(numpy.allclose(row, expected, rtol=0, atol=1e-6))
+
+    def test_forwardReverseRoundTrip(self):
+        result = self.tform.reverseMany(self.tform.forwardMany(self.pixels))
+        self.assertTrue(numpy.allclose(result, self.pixels, rtol=0, atol=1e-4))
+
+    def test_rayThatMissesTheEarth(self):
+        result = self.tform.forwardMany([self.pixels[0], self.SKY_PIXEL])
+        self.assertTrue(numpy.isfinite(result[0]).all())
+        self.assertFalse(numpy.isfinite(result[1]).any())
+        self.assertEqual(self.tform.forward(self.SKY_PIXEL), None)
+
+
+class ImageFootprintBoundsTest(TestCase):
+    def test_skipsPixelsThatMissTheGround(self):
+        tform = transform.makeTransform({'type': 'projective',
+                                         'matrix': [[10.0, 0.0, 0.0],
+                                                    [0.0, -10.0, 0.0],
+                                                    [0.0, 0.0, 1.0]]})
+        bounds = quadTree.imageFootprintBounds((100, 100), tform)
+        corners = quadTree.imageMapBounds((100, 100), tform)
+        for key in ('west', 'south', 'east', 'north'):
+            self.assertAlmostEqual(bounds[key], corners[key])
+
+        # a "sky" transform where the left half of the image misses the ground
+        class HalfSkyTransform(object):
+            def forwardMany(self, pts):
+                result = tform.forwardMany(pts)
+                result[numpy.asarray(pts)[:, 0] < 50] = numpy.nan
+                return result
+        bounds = quadTree.imageFootprintBounds((100, 100), HalfSkyTransform())
+        self.assertTrue(all(numpy.isfinite(bounds.values())))
+        self.assertAlmostEqual(bounds['west'], transform.metersToLatLon([500, 0])[0])
+
+        class AllSkyTransform(object):
+            def forwardMany(self, pts):
+                return numpy.nan * numpy.ones((len(pts), 2))
+        self.assertEqual(quadTree.imageFootprintBounds((100, 100), AllSkyTransform()), None)
+
+    def test_imageMapBoundsSkipsSkyCorners(self):
+        tform = transform.makeTransform({'type': 'projective',
+                                         'matrix': [[10.0, 0.0, 0.0],
+                                                    [0.0, -10.0, 0.0],
+                                                    [0.0, 0.0, 1.0]]})
+
+        # the top right corner of the image misses the ground
+        class SkyCornerTransform(object):
+            def forwardMany(self, pts):
+                result = tform.forwardMany(pts)
+                result[(numpy.asarray(pts) == [100, 0]).all(axis=1)] = numpy.nan
+                return result
+        bounds = quadTree.imageMapBounds((100, 100), SkyCornerTransform())
+        self.assertTrue(all(numpy.isfinite(bounds.values())))
+        self.assertAlmostEqual(bounds['east'], transform.metersToLatLon([1000, 0])[0])
+
+        class AllSkyTransform(object):
+            def forwardMany(self, pts):
+                return numpy.nan * numpy.ones((len(pts), 2))
+        self.assertEqual(quadTree.imageMapBounds((100, 100), AllSkyTransform()), None)
+
+
+@unittest.skipUnless(HAVE_GDAL_WARP, 'requires the GDAL python bindings (2.1 or later)')
+class GdalReprojectTest(TestCase):
+    """
+    Tests for reprojecting images with RPC metadata
+    """
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def test_reprojectWithRpcMetadata(self):
+        # left half red, right half blue, 200 x 100 pixels
+        pixels = numpy.zeros((100, 200, 3), dtype='uint8')
+        pixels[:, :100, 0] = 255
+        pixels[:, 100:, 2] = 255
+        imgPath = os.path.join(self.tempDir, 'image.png')
+        PIL.Image.fromarray(pixels, 'RGB').save(imgPath)
+
+        # the image covers lon 9..11, lat 19..21, north up
+        numCoeff = ['0'] * 20
+        sampNumCoeff = list(numCoeff)
+        sampNumCoeff[1] = '1'  # longitude
+        lineNumCoeff = list(numCoeff)
+        lineNumCoeff[2] = '-1'  # latitude
+        denCoeff = ['1'] + ['0'] * 19
+        rpcMetadata = {'LONG_OFF': 10, 'LONG_SCALE': 1,
+                       'LAT_OFF': 20, 'LAT_SCALE': 1,
+                       'HEIGHT_OFF': 0, 'HEIGHT_SCALE': 1,
+                       'SAMP_OFF': 100, 'SAMP_SCALE': 100,
+                       'LINE_OFF': 50, 'LINE_SCALE': 50,
+                       'SAMP_NUM_COEFF': ' '.join(sampNumCoeff),
+                       'SAMP_DEN_COEFF': ' '.join(denCoeff),
+                       'LINE_NUM_COEFF': ' '.join(lineNumCoeff),
+                       'LINE_DEN_COEFF': ' '.join(denCoeff)}
+
+        outPath = os.path.join(self.tempDir, 'out.tif')
+        gdalUtil.reprojectWithRpcMetadata(imgPath, rpcMetadata, gdalUtil.EPSG_4326, outPath,
+                                          outputBounds=(9.5, 19.5, 10.5, 20.5))
+        out = gdal.Open(outPath)
+        x0, dx, _, y0, _, dy = out.GetGeoTransform()
+        self.assertAlmostEqual(x0, 9.5)
+        self.assertAlmostEqual(y0, 20.5)
+        self.assertAlmostEqual(x0 + dx * out.RasterXSize, 10.5)
+        self.assertAlmostEqual(y0 + dy * out.RasterYSize, 19.5)
+        red = out.GetRasterBand(1).ReadAsArray()
+        blue = out.GetRasterBand(3).ReadAsArray()
+        w = out.RasterXSize
+        # leave room for lanczos ringing at the red/blue edge
+        self.assertTrue((red[:, :w / 2 - 4] == 255).all())
+        self.assertTrue((blue[:, w / 2 + 4:] == 255).all())
+        out = None
+        # the temporary VRT is cleaned up
+        self.assertEqual([f for f in (gdal.ReadDir('/vsimem/') or [])
+                          if f.endswith('_rpc.vrt')], [])
+
+
+class ExportJobTest(TestCase):
+    """
+    Tests for the export job queue
+    """
+    def setUp(self):
+        self.quadTree = models.QuadTree(transform='{"type": "projective"}')
+        self.quadTree.save()
+        self.overlay = models.Overlay(name='test', alignedQuadTree=self.quadTree)
+        self.overlay.save()
+
+    def test_identicalRequestsShareJob(self):
+        job = models.ExportJob.submit(self.overlay, 'html')
+        self.assertEqual(models.ExportJob.submit(self.overlay, 'html').id, job.id)
+        self.assertNotEqual(models.ExportJob.submit(self.overlay, 'kml').id, job.id)
+        self.assertEqual(models.ExportJob.claimNext().id, job.id)
+        self.assertEqual(models.ExportJob.submit(self.overlay, 'html').id, job.id)
+        job.finish(models.ExportJob.DONE)
+        self.assertNotEqual(models.ExportJob.submit(self.overlay, 'html').id, job.id)
+        self.assertRaises(ValueError, models.ExportJob.submit, self.overlay, 'pdf')
+
+    def test_cancelQueuedJob(self):
+        job = models.ExportJob.submit(self.overlay, 'html')
+        job.cancel()
+        self.assertEqual(models.ExportJob.objects.get(id=job.id).status,
+                         models.ExportJob.CANCELLED)
+        self.assertEqual(models.ExportJob.claimNext(), None)
+
+    def test_cancelRunningJob(self):
+        models.ExportJob.submit(self.overlay, 'html')
+        job = models.ExportJob.claimNext()
+        job.cancel()
+        job.generateExport = lambda: job.setProgress(0.5)
+        job.run()
+        job = models.ExportJob.objects.get(id=job.id)
+        self.assertEqual((job.status, job.progress), (models.ExportJob.CANCELLED, 0.5))
+
+    def test_runningKmlJobIsNotCancellable(self):
+        models.ExportJob.submit(self.overlay, 'kml')
+        job = models.ExportJob.claimNext()
+        self.assertFalse(job.cancel())
+        job = models.ExportJob.objects.get(id=job.id)
+        self.assertEqual((job.status, job.cancelRequested), (models.ExportJob.RUNNING, False))
+
+    def test_staleRunningJobIsFailed(self):
+        job = models.ExportJob.submit(self.overlay, 'html')
+        models.ExportJob.claimNext()
+        staleTime = datetime.datetime.utcnow() - datetime.timedelta(hours=2)
+        models.ExportJob.objects.filter(id=job.id).update(heartbeatTime=staleTime)
+        with override_settings(GEOCAM_TIE_POINT_EXPORT_QUEUE_HEARTBEAT_TIMEOUT_SECONDS=3600):
+            newJob = models.ExportJob.submit(self.overlay, 'html')
+        self.assertNotEqual(newJob.id, job.id)
+        self.assertEqual(models.ExportJob.objects.get(id=job.id).status, models.ExportJob.FAILED)
+        self.assertEqual(models.ExportJob.claimNext().id, newJob.id)
+
+    def test_cancelEndedJob(self):
+        for exportType in ('html', 'kml'):
+            models.ExportJob.submit(self.overlay, exportType)
+            job = models.ExportJob.claimNext()
+            job.finish(models.ExportJob.DONE)
+            self.assertFalse(job.cancel())
+            job = models.ExportJob.objects.get(id=job.id)
+            self.assertEqual((job.status, job.cancelRequested), (models.ExportJob.DONE, False))
+
+    def test_finishDoesNotReviveFailedJob(self):
+        models.ExportJob.submit(self.overlay, 'kml')
+        job = models.ExportJob.claimNext()
+        models.ExportJob.objects.filter(id=job.id).update(status=models.ExportJob.FAILED)
+        job.generateExport = lambda: None
+        job.run()
+        self.assertEqual(models.ExportJob.objects.get(id=job.id).status, models.ExportJob.FAILED)
+
+    def test_heartbeatDuringLongExport(self):
+        models.ExportJob.submit(self.overlay, 'kml')
+        job = models.ExportJob.claimNext()
+        heartbeats = []
+        job.touchHeartbeat = lambda: heartbeats.append(time.time())
+
+        def generateExport():
+            # stands in for a long GDAL step with no progress updates
+            deadline = time.time() + 5
+            while len(heartbeats) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+        job.generateExport = generateExport
+        with override_settings(GEOCAM_TIE_POINT_EXPORT_QUEUE_HEARTBEAT_INTERVAL_SECONDS=0.01):
+            job.run()
+        self.assertTrue(len(heartbeats) >= 2)
+        self.assertEqual(models.ExportJob.objects.get(id=job.id).status, models.ExportJob.DONE)
+
+    def test_failedJob(self):
+        models.ExportJob.submit(self.overlay, 'kml')
+        job = models.ExportJob.claimNext()
+
+        def generateExport():
+            raise ValueError('no image')
+        job.generateExport = generateExport
+        job.run()
+        job = models.ExportJob.objects.get(id=job.id)
+        self.assertEqual((job.status, job.errorMessage), (models.ExportJob.FAILED, 'no image'))
@@ -0,0 +1,160 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Two-tier cache of encoded tiles. A small in-process LRU sits in front of
+the shared django cache, so hot tiles are served without a round trip
+to the cache backend.
+"""
+
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.core.cache import cache
+from django.conf import settings
+
+from geocamTiePoint import lruCache
+
+
+def getTileDataSize(data):
+    bits, contentType = data
+    return len(bits)
+
+
+localCacheG = lruCache.LruCache(settings.GEOCAM_TIE_POINT_LOCAL_TILE_CACHE_MAX_BYTES,
+                                getTileDataSize)
+
+# lookups that missed the local tier and went to the shared cache
+sharedStatsG = {'hits': 0, 'misses': 0}
+sharedStatsLockG = threading.Lock()
+
+
+def countSharedLookups(numHits, numMisses):
+    with sharedStatsLockG:
+        sharedStatsG['hits'] += numHits
+        sharedStatsG['misses'] += numMisses
+
+
+def setLocal(key, data):
+    if localCacheG.maxBytes > 0:
+        localCacheG.set(key, data)
+
+
+def getCachedTileData(key):
+    """
+    Returns the (bits, contentType) tile data cached under @key in
+    either tier, or None.
+    """
+    data = localCacheG.get(key)
+    if data is not None:
+        return data
+
+    data = cache.get(key)
+    countSharedLookups(int(data is not None), int(data is None))
+    if data is not None:
+        setLocal(key, data)
+    return data
+
+
+def setTileData(key, data):
+    cache.set(key, data)
+    setLocal(key, data)
+
+
+def getTileData(key, generateTileData):
+    """
+    Returns the tile data cached under @key, calling @generateTileData()
+    and caching its result in both tiers on a miss.
+    """
+    data = getCachedTileData(key)
+    if data is None:
+        logging.debug('tileCache miss %s', key)
+        data = generateTileData()
+        setTileData(key, data)
+    return data
+
+
+def getManyTileData(items, numThreads=1, store=True):
+    """
+    Batch version of getTileData(). @items is a list of (key,
+    generateTileData) pairs. Returns the list of tile data in the same
+    order. Local tier misses are fetched from the shared cache in one
+    round trip, and shared tier misses are generated on up to
+    @numThreads threads. If @store is False, generated data is not
+    cached; generateTileData() decides what to cache.
+    """
+    result = [localCacheG.get(key) for key, _ in items]
+    localMisses = [i for i, data in enumerate(result) if data is None]
+    if not localMisses:
+        return result
+
+    sharedData = cache.get_many([items[i][0] for i in localMisses])
+    sharedMisses = []
+    for i in localMisses:
+        key = items[i][0]
+        data = sharedData.get(key)
+        if data is None:
+            sharedMisses.append(i)
+        else:
+            result[i] = data
+            setLocal(key, data)
+    countSharedLookups(len(localMisses) - len(sharedMisses), len(sharedMisses))
+    if not sharedMisses:
+        return result
+
+    logging.debug('tileCache generating %d tiles', len(sharedMisses))
+    generators = [items[i][1] for i in sharedMisses]
+    numThreads = min(numThreads, len(sharedMisses))
+    if numThreads > 1:
+        pool = ThreadPool(numThreads)
+        try:
+            generated = pool.map(lambda generateTileData: generateTileData(), generators)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        generated = [generateTileData() for generateTileData in generators]
+    newData = {}
+    for i, data in zip(sharedMisses, generated):
+        key = items[i][0]
+        result[i] = data
+        newData[key] = data
+        if store:
+            setLocal(key, data)
+    if store:
+        cache.set_many(newData)
+    return result
+
+
+def getStats():
+    """
+    Returns hit counts and hit ratios for each tier. Shared tier lookups
+    only happen on local tier misses.
+    """
+    with sharedStatsLockG:
+        hits = sharedStatsG['hits']
+        misses = sharedStatsG['misses']
+    lookups = hits + misses
+    return {'local': localCacheG.getStats(),
+            'shared': {'hits': hits,
+                       'misses': misses,
+                       'hitRatio': float(hits) / lookups if lookups else None}}
+
+
+def delete(key):
+    localCacheG.delete(key)
+    cache.delete(key)
@@ -0,0 +1,94 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Persistent on-disk store of encoded tiles, so rendered tiles survive a
+cache flush or restart. The tiles of a quadtree are kept in a directory
+tree laid out like an html export, <basePath>/<zoom>/<x>/<y>.<ext>.
+"""
+
+import os
+import shutil
+import tempfile
+
+from geocamTiePoint.quadTree import contentTypeToExtension
+
+# content types of stored tiles, in the order readTile() looks for them
+TILE_CONTENT_TYPES = ('image/png', 'image/jpeg')
+
+
+def getTilePath(basePath, zoom, x, y, contentType):
+    return os.path.join(basePath, str(zoom), str(x),
+                        '%s%s' % (y, contentTypeToExtension(contentType)))
+
+
+def readTile(basePath, zoom, x, y):
+    """
+    Returns the (bits, contentType) tile data stored for the tile, or
+    None if it isn't stored.
+    """
+    for contentType in TILE_CONTENT_TYPES:
+        try:
+            with open(getTilePath(basePath, zoom, x, y, contentType), 'rb') as tileFile:
+                return (tileFile.read(), contentType)
+        except IOError:
+            pass
+    return None
+
+
+def writeTile(basePath, zoom, x, y, data):
+    """
+    Stores the (bits, contentType) tile @data. Writes to a temp file and
+    renames it into place, so concurrent readers never see a partial
+    tile.
+    """
+    bits, contentType = data
+    path = getTilePath(basePath, zoom, x, y, contentType)
+    dirName = os.path.dirname(path)
+    if not os.path.exists(dirName):
+        try:
+            os.makedirs(dirName)
+        except OSError:
+            # another process created it first
+            pass
+    fd, tempPath = tempfile.mkstemp(suffix='.tmp', dir=dirName)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(bits)
+        # the file is served as is by the web server, so make it readable
+        os.chmod(tempPath, 0644)
+        os.rename(tempPath, path)
+    except:
+        os.unlink(tempPath)
+        raise
+
+
+def clearTiles(basePath):
+    """
+    Deletes all stored tiles under @basePath. The directory is renamed
+    out of the way first, so readers see either all the old tiles or
+    none of them.
+    """
+    if not os.path.exists(basePath):
+        return
+    parentDir = os.path.dirname(os.path.abspath(basePath))
+    deadPath = tempfile.mkdtemp(prefix='.deleted-', dir=parentDir)
+    try:
+        os.rename(basePath, os.path.join(deadPath, 'tiles'))
+    except OSError:
+        # another process cleared it first
+        pass
+    shutil.rmtree(deadPath, ignore_errors=True)
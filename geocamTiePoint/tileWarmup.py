@@ -0,0 +1,133 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Background warm-up of the tiles an editor is about to request after an
+overlay's alignment changes. Tiles are rendered on a bounded thread
+pool. A warm-up stops as soon as a newer quadtree supersedes the one it
+is rendering.
+"""
+
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+from django.core.cache import cache
+from django.conf import settings
+
+from geocamTiePoint import quadTree, transform
+
+# deepest zoom considered when fitting the map to an overlay
+MAX_FIT_ZOOM = 24
+
+poolG = None
+poolLockG = threading.Lock()
+
+
+def getPool():
+    global poolG
+    with poolLockG:
+        if poolG is None:
+            poolG = ThreadPool(settings.GEOCAM_TIE_POINT_WARMUP_THREADS)
+        return poolG
+
+
+def getCurrentQuadTreeKey(overlayKey):
+    return 'geocamTiePoint.tileWarmup.currentQuadTree.%s' % overlayKey
+
+
+def getTileRange(bounds, zoom):
+    """
+    Returns the (xmin, ymin, xmax, ymax) indices of the tiles at @zoom
+    covering the lat/lon @bounds dict, as in overlay.extras.bounds.
+    """
+    nw, se = transform.lonLatToMetersMany([[bounds['west'], bounds['north']],
+                                           [bounds['east'], bounds['south']]]).tolist()
+    xmin, ymin = quadTree.tileIndex(zoom, nw)
+    xmax, ymax = quadTree.tileIndex(zoom, se)
+    return xmin, ymin, xmax, ymax
+
+
+def boundsAreFinite(bounds):
+    """
+    Returns True if @bounds is a lat/lon bounds dict with finite values.
+    """
+    if not bounds:
+        return False
+    values = [bounds.get(key) for key in ('west', 'south', 'east', 'north')]
+    return bool(numpy.isfinite(numpy.array(values, dtype='float64')).all())
+
+
+def getWarmupTiles(bounds, viewportTiles, numZooms, maxTiles):
+    """
+    Returns the (zoom, x, y) tiles to warm up for an overlay with
+    @bounds. The editor fits the map to the overlay, so it starts at
+    about the largest zoom where the bounds span at most @viewportTiles
+    tiles. Tiles are listed for that zoom and the @numZooms - 1 zooms
+    above it, coarsest first, up to @maxTiles tiles.
+    """
+    fitZoom = 0
+    for zoom in xrange(1, MAX_FIT_ZOOM + 1):
+        xmin, ymin, xmax, ymax = getTileRange(bounds, zoom)
+        if max(xmax - xmin, ymax - ymin) + 1 > viewportTiles:
+            break
+        fitZoom = zoom
+
+    tiles = []
+    for zoom in xrange(fitZoom, fitZoom + numZooms):
+        xmin, ymin, xmax, ymax = getTileRange(bounds, zoom)
+        for y in xrange(ymin, ymax + 1):
+            for x in xrange(xmin, xmax + 1):
+                if len(tiles) >= maxTiles:
+                    return tiles
+                tiles.append((zoom, x, y))
+    return tiles
+
+
+def warmTile(overlayKey, quadTreeId, tile, renderTile):
+    # checked per tile, so queued tiles of a superseded quadtree are
+    # skipped, even if it was superseded in another process
+    if cache.get(getCurrentQuadTreeKey(overlayKey)) != quadTreeId:
+        return
+    try:
+        renderTile(quadTreeId, *tile)
+    except:  # pylint: disable=W0702
+        logging.exception('warmTile: failed to render tile %s of quadTree %s',
+                          tile, quadTreeId)
+
+
+def startWarmup(overlayKey, quadTreeId, bounds, renderTile):
+    """
+    Starts rendering the tiles of quadtree @quadTreeId that the editor
+    will show for the overlay with @bounds, by calling
+    @renderTile(quadTreeId, zoom, x, y) in the background. Supersedes
+    any warm-up running for the same overlay. Does nothing if @bounds
+    are missing or not finite.
+    """
+    if not boundsAreFinite(bounds):
+        logging.info('startWarmup: no finite bounds for quadTree %s, skipping', quadTreeId)
+        return
+    cache.set(getCurrentQuadTreeKey(overlayKey), quadTreeId)
+    tiles = getWarmupTiles(bounds,
+                           settings.GEOCAM_TIE_POINT_WARMUP_VIEWPORT_TILES,
+                           settings.GEOCAM_TIE_POINT_WARMUP_ZOOM_LEVELS,
+                           settings.GEOCAM_TIE_POINT_WARMUP_MAX_TILES)
+    logging.info('startWarmup: %d tiles of quadTree %s', len(tiles), quadTreeId)
+    pool = getPool()
+    for tile in tiles:
+        pool.apply_async(warmTile, (overlayKey, quadTreeId, tile, renderTile))
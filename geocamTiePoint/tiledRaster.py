@@ -0,0 +1,194 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Internally tiled, multi-resolution storage for source images. A tiled
+raster is a directory holding an info.json header and one .npy file per
+overview level. Level 0 is the full-resolution image and each following
+level halves the previous one, down to a single block. Each level is
+stored as an array of square blocks, indexed [blockY, blockX, y, x, band],
+so reading a small window of a large image only touches the pages of
+the blocks under it.
+"""
+
+import os
+import json
+import math
+import shutil
+import tempfile
+
+import numpy
+import numpy.lib.format
+from PIL import Image
+
+BLOCK_SIZE = 256
+INFO_FILE = 'info.json'
+
+# modes whose pixels map directly to a numpy array that Image.fromarray()
+# understands. other modes are converted to RGBA before writing.
+TILED_RASTER_MODES = ('L', 'RGB', 'RGBA')
+
+
+def getLevelPath(path, level):
+    return os.path.join(path, 'level%d.npy' % level)
+
+
+def getOverviewSizes(size, blockSize):
+    sizes = [tuple(size)]
+    while max(size) > blockSize:
+        size = (int(math.ceil(size[0] / 2.)),
+                int(math.ceil(size[1] / 2.)))
+        sizes.append(size)
+    return sizes
+
+
+def getPixelArray(image):
+    pixels = numpy.asarray(image)
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, numpy.newaxis]
+    return pixels
+
+
+def writeLevel(image, levelPath, blockSize):
+    w, h = image.size
+    pixels = getPixelArray(image)
+    numBlocksX = int(math.ceil(float(w) / blockSize))
+    numBlocksY = int(math.ceil(float(h) / blockSize))
+    blocks = numpy.lib.format.open_memmap(levelPath, mode='w+', dtype=pixels.dtype,
+                                          shape=(numBlocksY, numBlocksX, blockSize,
+                                                 blockSize, pixels.shape[2]))
+    # fill one row of blocks at a time to bound memory use
+    for by in xrange(numBlocksY):
+        rows = pixels[by * blockSize:(by + 1) * blockSize]
+        for bx in xrange(numBlocksX):
+            block = rows[:, bx * blockSize:(bx + 1) * blockSize]
+            blocks[by, bx, :block.shape[0], :block.shape[1]] = block
+    blocks.flush()
+    del blocks
+
+
+def writeTiledRaster(image, path, blockSize=BLOCK_SIZE):
+    """
+    Writes @image and its overviews as a tiled raster in directory
+    @path. The raster is built in a temp directory and renamed into
+    place, so concurrent readers never see a partial raster. If another
+    process writes the same raster at the same time, whichever finishes
+    first wins.
+    """
+    if image.mode not in TILED_RASTER_MODES:
+        image = image.convert('RGBA')
+    parentDir = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(parentDir):
+        try:
+            os.makedirs(parentDir)
+        except OSError:
+            # another process created it first
+            pass
+    tempDir = tempfile.mkdtemp(dir=parentDir)
+    try:
+        sizes = getOverviewSizes(image.size, blockSize)
+        level = image
+        for i, size in enumerate(sizes):
+            if i > 0:
+                level = level.resize(size, Image.ANTIALIAS)
+            writeLevel(level, getLevelPath(tempDir, i), blockSize)
+        with open(os.path.join(tempDir, INFO_FILE), 'w') as out:
+            json.dump({'mode': image.mode,
+                       'blockSize': blockSize,
+                       'sizes': sizes},
+                      out)
+    except:
+        shutil.rmtree(tempDir, ignore_errors=True)
+        raise
+
+    # rename any old raster out of the way rather than deleting it in
+    # place, so readers see either a whole raster or none
+    deadPath = tempfile.mkdtemp(prefix='.deleted-', dir=parentDir)
+    try:
+        try:
+            os.rename(path, os.path.join(deadPath, 'raster'))
+        except OSError:
+            # no old raster
+            pass
+        try:
+            os.rename(tempDir, path)
+        except OSError:
+            shutil.rmtree(tempDir, ignore_errors=True)
+            if not TiledRaster.exists(path):
+                raise
+            # another process wrote the raster first. ours is the same.
+    finally:
+        shutil.rmtree(deadPath, ignore_errors=True)
+
+
+class TiledRaster(object):
+    """
+    Read-only view of a tiled raster written by writeTiledRaster(). Its
+    levels are memory-mapped, so processes opening the same raster
+    share its pages through the OS page cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INFO_FILE)) as infoFile:
+            info = json.load(infoFile)
+        self.mode = info['mode']
+        self.blockSize = info['blockSize']
+        self.sizes = [tuple(size) for size in info['sizes']]
+        self.size = self.sizes[0]
+        self.levels = [numpy.load(getLevelPath(path, i), mmap_mode='r')
+                       for i in xrange(len(self.sizes))]
+
+    @classmethod
+    def exists(cls, path):
+        return os.path.exists(os.path.join(path, INFO_FILE))
+
+    def getNumLevels(self):
+        return len(self.levels)
+
+    def getLevelSize(self, level):
+        return self.sizes[level]
+
+    def getMemorySize(self):
+        return sum([blocks.nbytes for blocks in self.levels])
+
+    def load(self):
+        # pixels are read on demand; present for compatibility with PIL images
+        pass
+
+    def readWindow(self, level, box):
+        """
+        Returns a PIL image holding the pixels of @box = (left, top,
+        right, bottom) at overview @level. Parts of the box outside the
+        raster are zero, which is transparent for RGBA rasters.
+        """
+        left, top, right, bottom = box
+        w, h = self.sizes[level]
+        blocks = self.levels[level]
+        bs = self.blockSize
+        window = numpy.zeros((bottom - top, right - left, blocks.shape[4]),
+                             dtype=blocks.dtype)
+        x0, y0 = max(left, 0), max(top, 0)
+        x1, y1 = min(right, w), min(bottom, h)
+        for by in xrange(y0 // bs, (y1 + bs - 1) // bs):
+            for bx in xrange(x0 // bs, (x1 + bs - 1) // bs):
+                bx0, bx1 = max(x0, bx * bs), min(x1, (bx + 1) * bs)
+                by0, by1 = max(y0, by * bs), min(y1, (by + 1) * bs)
+                window[by0 - top:by1 - top, bx0 - left:bx1 - left] = \
+                    blocks[by, bx, by0 - by * bs:by1 - by * bs, bx0 - bx * bs:bx1 - bx * bs]
+        if self.mode == 'L':
+            window = window[:, :, 0]
+        return Image.fromarray(window, self.mode)
@@ -25,8 +25,8 @@
 
 import math
 import numpy
-from geocamTiePoint.optimize import optimize
-from geocamUtil.registration import imageCoordToEcef, rotMatrixOfCameraInEcef, rotMatrixFromEcefToCamera, eulFromRot, rotFromEul
+from geocamTiePoint.optimize import optimize, numericalJacobian
+from geocamUtil.registration import rotMatrixOfCameraInEcef, rotMatrixFromEcefToCamera, eulFromRot, rotFromEul
 from geocamUtil.geomath import transformEcefToLonLatAlt, transformLonLatAltToEcef
 
 # TODO: Clean up these constants!
@@ -36,6 +36,10 @@ METERS_PER_DEGREE_LON = ORIGIN_SHIFT / 180
 DEGREES_LON_PER_METER = 180 / ORIGIN_SHIFT
 TILE_SIZE = 256.
 INITIAL_RESOLUTION = 2 * math.pi * 6378137 / TILE_SIZE
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_E2 = WGS84_F * (2 - WGS84_F)
+ECEF_TO_LON_LAT_ITERATIONS = 4
 
 
 def lonLatToMeters(lonLat):
@@ -56,6 +60,81 @@ def metersToLatLon(mercatorPt):
     return lon, lat
 
 
+def lonLatToMetersMany(lonLats):
+    '''Vectorized lonLatToMeters(). Takes an Nx2 array of (lon, lat)
+       rows and returns an Nx2 array of projected coordinates in meters.'''
+    lonLats = numpy.asarray(lonLats, dtype='float64')
+    mx = lonLats[:, 0] * METERS_PER_DEGREE_LON
+    my = numpy.log(numpy.tan((90 + lonLats[:, 1]) * math.pi / 360)) / (math.pi / 180) # Lat correction
+    my = my * METERS_PER_DEGREE_LON
+    return numpy.column_stack([mx, my])
+
+
+def metersToLatLonMany(mercatorPts):
+    '''Vectorized metersToLatLon(). Takes an Nx2 array of projected
+       coordinates in meters and returns an Nx2 array of (lon, lat) rows.'''
+    mercatorPts = numpy.asarray(mercatorPts, dtype='float64')
+    lon = mercatorPts[:, 0] * DEGREES_LON_PER_METER
+    lat = mercatorPts[:, 1] * DEGREES_LON_PER_METER
+    lat = ((numpy.arctan(numpy.exp((lat * (math.pi / 180)))) * 360) / math.pi) - 90 # Lat correction
+    return numpy.column_stack([lon, lat])
+
+
+def lonLatAltToEcefMany(lonLatAlts):
+    '''Vectorized WGS84 conversion of an Nx3 array of (lon, lat, alt)
+       rows (degrees, meters) to an Nx3 array of ECEF (x, y, z) meters.
+       Matches geocamUtil.geomath.transformLonLatAltToEcef.'''
+    lonLatAlts = numpy.asarray(lonLatAlts, dtype='float64')
+    lon = numpy.radians(lonLatAlts[:, 0])
+    lat = numpy.radians(lonLatAlts[:, 1])
+    alt = lonLatAlts[:, 2]
+    chi = numpy.sqrt(1 - WGS84_E2 * numpy.sin(lat) ** 2)
+    q = (WGS84_A / chi + alt) * numpy.cos(lat)
+    return numpy.column_stack([q * numpy.cos(lon),
+                               q * numpy.sin(lon),
+                               ((WGS84_A * (1 - WGS84_E2) / chi) + alt) * numpy.sin(lat)])
+
+
+def ecefToLonLatAltMany(ecef):
+    '''Vectorized WGS84 conversion of an Nx3 array of ECEF (x, y, z)
+       meters to an Nx3 array of (lon, lat, alt) rows (degrees, meters),
+       using a fixed number of Bowring iterations. Matches
+       geocamUtil.geomath.transformEcefToLonLatAlt.'''
+    ecef = numpy.asarray(ecef, dtype='float64')
+    x, y, z = ecef[:, 0], ecef[:, 1], ecef[:, 2]
+    a, f, e2 = WGS84_A, WGS84_F, WGS84_E2
+    lon = numpy.arctan2(y, x)
+    s = numpy.hypot(x, y)
+    beta = numpy.arctan2(z, (1 - f) * s)  # initial guess
+    for _ in xrange(ECEF_TO_LON_LAT_ITERATIONS):
+        lat = numpy.arctan2(z + (e2 * (1 - f) / (1 - e2)) * a * numpy.sin(beta) ** 3,
+                            s - e2 * a * numpy.cos(beta) ** 3)
+        beta = numpy.arctan2((1 - f) * numpy.sin(lat), numpy.cos(lat))  # improved guess
+    N = a / numpy.sqrt(1 - e2 * numpy.sin(lat) ** 2)
+    alt = s * numpy.cos(lat) + (z + e2 * N * numpy.sin(lat)) * numpy.sin(lat) - N
+    return numpy.column_stack([numpy.degrees(lon), numpy.degrees(lat), alt])
+
+
+def intersectEllipsoidMany(origin, directions):
+    '''Returns the Nx3 array of ECEF points where rays from the ECEF point
+       origin along each row of the Nx3 array directions first hit the
+       WGS84 ellipsoid. Rows for rays that miss the earth are NaN.'''
+    origin = numpy.asarray(origin, dtype='float64')
+    directions = numpy.asarray(directions, dtype='float64')
+    # scale axes so the ellipsoid becomes the unit sphere
+    scale = numpy.array([1 / WGS84_A, 1 / WGS84_A, 1 / (WGS84_A * (1 - WGS84_F))])
+    p = origin * scale
+    d = directions * scale
+    a = (d * d).sum(axis=1)
+    b = 2 * d.dot(p)
+    c = p.dot(p) - 1
+    with numpy.errstate(invalid='ignore'):
+        discriminant = b * b - 4 * a * c
+        t = (-b - numpy.sqrt(discriminant)) / (2 * a)  # nearer of the two hits
+        t[~(t >= 0)] = numpy.nan  # no hit, or the earth is behind the camera
+    return origin + t[:, numpy.newaxis] * directions
+
+
 def resolution(zoom):
     return INITIAL_RESOLUTION / (2 ** zoom)
 
@@ -102,6 +181,32 @@ def getProjectiveInverse(matrix):
     return result
 
 
+def homogenize(pts):
+    '''Append a column of ones to an Nxk array of points.'''
+    pts = numpy.asarray(pts, dtype='float64')
+    return numpy.column_stack([pts, numpy.ones(len(pts))])
+
+
+def applyProjectiveMany(matrix, pts):
+    '''Apply a 3x3 projective transform matrix to an Nx2 array of points.'''
+    v0 = homogenize(pts).dot(matrix.T)
+    # projective rescaling: divide by z and truncate
+    return v0[:, :2] / v0[:, 2:3]
+
+
+def applyEach(func, pts):
+    '''Apply a per-point transform function to each row of an Nx2 array
+       of points. Rows where func returns None are filled with NaN.'''
+    result = numpy.empty((len(pts), 2))
+    for i, pt in enumerate(pts):
+        v = func(pt)
+        if v is None:
+            result[i, :] = numpy.nan
+        else:
+            result[i, :] = v
+    return result
+
+
 def closest(tgt, vals):
     '''Return the element in vals which is closest to tgt'''
     return min(vals, key=lambda v: abs(tgt - v))
@@ -125,6 +230,45 @@ def solveQuad(a, p):
     else:
         # avoid divide by zero
         return p
+
+
+def projectiveJacobian(params, fromPts):
+    '''
+    Returns the forward projective transform of an Nx2 array of points
+    using the first 8 elements of params as the (row-major) matrix
+    entries, along with the Nx2x8 array of derivatives of each output
+    point with respect to those params.
+    '''
+    fromPts = numpy.asarray(fromPts, dtype='float64')
+    matrix = numpy.append(params[:8], 1).reshape((3, 3))
+    u = homogenize(fromPts)
+    v0 = u.dot(matrix.T)
+    w = v0[:, 2:3]
+    v = v0[:, :2] / w
+
+    result = numpy.zeros((len(u), 2, 8))
+    result[:, 0, 0:3] = u / w
+    result[:, 1, 3:6] = u / w
+    result[:, :, 6] = -v * fromPts[:, 0:1] / w
+    result[:, :, 7] = -v * fromPts[:, 1:2] / w
+    return v, result
+
+
+def solveQuadMany(a, p):
+    '''
+    Vectorized solveQuad() over an array p. Entries with no real root
+    are set to NaN.
+    '''
+    p = numpy.asarray(p, dtype='float64')
+    if a * a > 1e-20:
+        discriminant = 4 * a * p + 1
+        h = numpy.sqrt(numpy.where(discriminant < 0, numpy.nan, discriminant))
+        root1 = (-1 + h) / (2 * a)
+        root2 = (-1 - h) / (2 * a)
+        return numpy.where(abs(p - root1) <= abs(p - root2), root1, root2)
+    else:
+        # avoid divide by zero
+        return p
     
 
 class Transform(object):
@@ -138,9 +282,19 @@ class Transform(object):
         # and returns the toPts calculated from fromPts and params.
         params = optimize(toPts.flatten(),
                           lambda params: forwardPts(cls.fromParams(params), fromPts).flatten(),
-                          params0)
+                          params0,
+                          jacobian=lambda params: cls.jacobian(params, fromPts))
         return cls.fromParams(params)
 
+    @classmethod
+    def jacobian(cls, params, fromPts):
+        '''Returns the (2n x k) Jacobian of the flattened forwardPts() output
+           with respect to the k params, for n input points. This default
+           is numerical; derived classes override it with an analytic one.'''
+        return (numericalJacobian
+                (lambda params: forwardPts(cls.fromParams(params), fromPts).flatten())
+                (params))
+
     @classmethod
     def getInitParams(cls, toPts, fromPts):
         raise NotImplementedError('implement in derived class')
@@ -150,6 +304,18 @@ class Transform(object):
         '''Given a vector of parameters, it initializes the transform'''
         raise NotImplementedError('implement in derived class')
 
+    def forwardMany(self, fromPts):
+        '''Applies the forward transform to an Nx2 array of points and
+           returns an Nx2 array. Points that can't be transformed are NaN.
+           Derived classes should override this with a vectorized version.'''
+        return applyEach(self.forward, fromPts)
+
+    def reverseMany(self, toPts):
+        '''Applies the reverse transform to an Nx2 array of points and
+           returns an Nx2 array. Points that can't be transformed are NaN.
+           Derived classes should override this with a vectorized version.'''
+        return applyEach(self.reverse, toPts)
+
 
 class CameraModelTransform(Transform):
     '''Simple pinhole camera camera model.
@@ -160,6 +326,9 @@ class CameraModelTransform(Transform):
         self.height = height
         self.Fx     = Fx
         self.Fy     = Fy
+        # rotation and projection matrices are computed when first used.
+        self.cameraMatrices = None
+        self.cameraMatricesKey = None
         
     @classmethod
     def fit(cls, toPts, fromPts, imageId):
@@ -177,72 +346,81 @@ class CameraModelTransform(Transform):
                           params0)   
         return cls.fromParams(params, width, height, Fx, Fy)
 
+    def getCameraMatrices(self):
+        '''Returns the camera rotation (as returned by rotFromEul), the
+           camera position in ECEF and the composed 3x4 projection matrix
+           from ECEF to homogeneous image coordinates. They are computed
+           once per params vector.'''
+        key = tuple(self.params)
+        if self.cameraMatricesKey != key:
+            lat, lon, alt, roll, pitch, yaw = self.params
+            rotMatrix = rotFromEul(roll, pitch, yaw)  # euler to matrix
+            cameraMatrix = numpy.array([[self.Fx, 0,       self.width / 2.0],  # matrix of intrinsic camera parameters
+                                        [0,       self.Fy, self.height / 2.0],
+                                        [0,       0,       1]],
+                                       dtype='float64')
+            cameraPose = numpy.array(transformLonLatAltToEcef((lon, lat, alt)), dtype='float64').flatten()  # camera pose in ecef
+            rotation = numpy.asarray(rotMatrix).transpose()
+            rotTransMat = numpy.c_[rotation, -rotation.dot(cameraPose)]  # 3x4 [R' | -R' C]
+            self.cameraMatrices = (rotMatrix, cameraPose, cameraMatrix.dot(rotTransMat))
+            self.cameraMatricesKey = key
+        return self.cameraMatrices
+
     def forward(self, pt):
         '''Takes in a point in pixel coordinate and returns point in gmap units (meters)'''
-        lat, lon, alt, roll, pitch, yaw = self.params
-        width  = self.width
-        height = self.height
-        Fx     = self.Fx
-        Fy     = self.Fy
-        camLonLatAlt  = (lon, lat, alt)  # camera position in lon,lat,alt
-        opticalCenter = (int(width / 2.0), int(height / 2.0))
-        focalLength   = (Fx, Fy)
-        rotMatrix     = rotFromEul(roll, pitch, yaw)
-        # Convert image pixel coordinates to ecef
-        ecef = imageCoordToEcef(camLonLatAlt, pt, opticalCenter, focalLength, rotMatrix) 
-        try: 
-            ptLonLatAlt = transformEcefToLonLatAlt(ecef)  # convert image pixel coordinates to ecef
-        except:
+        xy_meters = self.forwardMany([pt])[0]
+        if not numpy.isfinite(xy_meters).all():
             return None
-        toPt = [ptLonLatAlt[0], ptLonLatAlt[1]]  # [lon, lat]
-        xy_meters = lonLatToMeters(toPt) 
-        return xy_meters
+        return xy_meters.tolist()
+
+    def forwardMany(self, fromPts):
+        '''Vectorized forward(). Takes an Nx2 array of pixel coordinates and
+           returns an Nx2 array of points in gmap meters. Pixels whose rays
+           miss the earth are NaN.'''
+        rotMatrix, cameraPose, _projection = self.getCameraMatrices()
+        fromPts = numpy.asarray(fromPts, dtype='float64')
+        opticalCenter = (int(self.width / 2.0), int(self.height / 2.0))
+        # ray through each pixel in the camera frame, then rotated into ecef
+        rays = numpy.column_stack([(fromPts[:, 0] - opticalCenter[0]) / self.Fx,
+                                   (fromPts[:, 1] - opticalCenter[1]) / self.Fy,
+                                   numpy.ones(len(fromPts))])
+        rays = rays.dot(numpy.asarray(rotMatrix).transpose())
+        ecef = intersectEllipsoidMany(cameraPose, rays)
+        ptLonLatAlt = ecefToLonLatAltMany(ecef)
+        return lonLatToMetersMany(ptLonLatAlt[:, :2])  # [lon, lat]
 
     def reverse(self, pt):
         '''Takes a point in gmap meters and converts it to image coordinates'''
-        lat, lon, alt, roll, pitch, yaw = self.params  # camera parameters (location, orientation, focal length)
-        width  = self.width  # image width
-        height = self.height  # image height
-        Fx     = self.Fx
-        Fy     = self.Fy
-        # convert input pt from meters to lat lon
-        ptlon, ptlat = metersToLatLon([pt[0], pt[1]])
-        ptalt = 0
-        px, py, pz = transformLonLatAltToEcef([ptlon, ptlat, ptalt])
-        pt = numpy.array([[px, py, pz, 1]]).transpose()  # convert to column vector
-        cameraMatrix = numpy.matrix([[Fx,  0,  width /2.0],  # matrix of intrinsic camera parameters
-                                     [0,   Fy, height/2.0],
-                                     [0,   0,  1]],
-                                   dtype='float64')  
-        x,y,z = transformLonLatAltToEcef((lon,lat,alt))  # camera pose in ecef
-        rotation = rotFromEul(roll, pitch, yaw)  # euler to matrix
-        rotation = numpy.transpose(rotation)
-        cameraPoseColVector = numpy.array([[x, y, z]]).transpose()
-        translation = -1* rotation * cameraPoseColVector
-        rotTransMat = numpy.c_[rotation, translation]  # append the translation matrix (3x1) to rotation matrix (3x3) -> becomes 3x4
-        ptInImage   = cameraMatrix * rotTransMat * pt
-        u = ptInImage.item(0) / ptInImage.item(2)
-        v = ptInImage.item(1) / ptInImage.item(2)
-        ptInImage =  [u, v]
-        return ptInImage
+        return self.reverseMany([pt])[0].tolist()
+
+    def reverseMany(self, toPts):
+        '''Vectorized reverse(). Takes an Nx2 array of points in gmap meters
+           and returns an Nx2 array of image coordinates.'''
+        _rotMatrix, _cameraPose, projection = self.getCameraMatrices()
+        # convert input pts from meters to lat lon
+        lonLats = metersToLatLonMany(toPts)
+        lonLatAlts = numpy.column_stack([lonLats, numpy.zeros(len(lonLats))])
+        ecef = lonLatAltToEcefMany(lonLatAlts)
+        return applyProjectiveMany(projection, ecef)
 
     @classmethod
     def getInitParams(cls, toPts, fromPts, imageId):
+        from geocamTiePoint.models import getIssImageMetadata  # avoid circular import
         mission, roll, frame = imageId.split('-')
-        issImage = ISSimage(mission, roll, frame, '')
+        extras = getIssImageMetadata(mission, roll, frame)
         try:
-            issLat = issImage.extras.nadirLat
-            issLon = issImage.extras.nadirLon
-            issAlt = issImage.extras.altitude
-            foLenX = issImage.extras.focalLength[0]
-            foLenY = issImage.extras.focalLength[1]
+            issLat = extras.nadirLat
+            issLon = extras.nadirLon
+            issAlt = extras.altitude
+            foLenX = extras.focalLength[0]
+            foLenY = extras.focalLength[1]
             camLonLatAlt = (issLon,issLat,issAlt)
             rotMatrix = rotMatrixOfCameraInEcef(issLon, transformLonLatAltToEcef(camLonLatAlt))  # initially nadir pointing
             roll, pitch, yaw = eulFromRot(rotMatrix)  # initially set to nadir rotation
             # these values are not going to be optimized. But needs to be passed to fromParams 
             # to set it as member vars.
-            width = issImage.extras.width
-            height = issImage.extras.height
+            width = extras.width
+            height = extras.height
         except Exception as e:
             print "Could not retrieve image metadata from the ISS MRF: " + str(e)
         return [issLat, issLon, issAlt, roll, pitch, yaw, foLenX, foLenY, width, height]
@@ -274,6 +452,14 @@ class LinearTransform(Transform):
         u = self.inverse.dot(v) # Multiply the matrix by the vector
         return u[:2].tolist()   # Return first two elements
 
+    def forwardMany(self, fromPts):
+        return homogenize(fromPts).dot(self.matrix.T)[:, :2]
+
+    def reverseMany(self, toPts):
+        if self.inverse is None:
+            self.inverse = numpy.linalg.inv(self.matrix)
+        return homogenize(toPts).dot(self.inverse.T)[:, :2]
+
     def getJsonDict(self):
         return {'type': 'projective',
                 'matrix': self.matrix.tolist()}
@@ -329,6 +515,23 @@ class RotateScaleTranslateTransform(LinearTransform):
         theta = math.atan2(-tmat[0, 1], tmat[0, 0])
         return [tx, ty, scale, theta]
 
+    @classmethod
+    def jacobian(cls, params, fromPts):
+        _tx, _ty, scale, theta = params
+        x = fromPts[:, 0]
+        y = fromPts[:, 1]
+        rx = math.cos(theta) * x - math.sin(theta) * y
+        ry = math.sin(theta) * x + math.cos(theta) * y
+
+        result = numpy.zeros((len(x), 2, 4))
+        result[:, 0, 0] = 1
+        result[:, 1, 1] = 1
+        result[:, 0, 2] = rx
+        result[:, 1, 2] = ry
+        result[:, 0, 3] = -scale * ry
+        result[:, 1, 3] = scale * rx
+        return result.reshape((2 * len(x), 4))
+
     def getJsonDict(self):
         return {'type': 'rotate_scale',
                 'matrix': self.matrix.tolist()}
@@ -377,6 +580,14 @@ class ProjectiveTransform(Transform):
             self.inverse = getProjectiveInverse(self.matrix)
         return self._apply(self.inverse, pt)
 
+    def forwardMany(self, fromPts):
+        return applyProjectiveMany(self.matrix, fromPts)
+
+    def reverseMany(self, toPts):
+        if self.inverse is None:
+            self.inverse = getProjectiveInverse(self.matrix)
+        return applyProjectiveMany(self.inverse, toPts)
+
     @classmethod
     def fromParams(cls, params):
         matrix = numpy.append(params, 1).reshape((3, 3))
@@ -386,6 +597,11 @@ class ProjectiveTransform(Transform):
     def getInitParams(cls, toPts, fromPts):
         tmat = AffineTransform.fit(toPts, fromPts).matrix
         return tmat.flatten()[:8]
+
+    @classmethod
+    def jacobian(cls, params, fromPts):
+        _v, result = projectiveJacobian(params, fromPts)
+        return result.reshape((2 * len(fromPts), 8))
  
     def getJsonDict(self):
         return {'type': 'projective',
@@ -393,6 +609,9 @@ class ProjectiveTransform(Transform):
  
 class QuadraticTransform(Transform):
     '''TODO'''
+    NEWTON_MAX_ITERATIONS = 20
+    NEWTON_TOLERANCE = 1e-6  # pixels
+
     def __init__(self, matrix):
         self.matrix = matrix
  
@@ -410,21 +629,86 @@ class QuadraticTransform(Transform):
         v0 = self.matrix.dot(u)
         v  = (v0 / v0[2])[:2]
         return v.tolist()
+
+    def forwardMany(self, fromPts):
+        fromPts = numpy.asarray(fromPts, dtype='float64')
+        u = numpy.column_stack([fromPts ** 2, homogenize(fromPts)])
+        v0 = u.dot(self.matrix.T)
+        return v0[:, :2] / v0[:, 2:3]
  
+    def _forwardWithJacobianMany(self, fromPts):
+        '''Returns the forward transform of an Nx2 array of points along
+           with the Nx2x2 array of its derivatives at each point.'''
+        x = fromPts[:, 0]
+        y = fromPts[:, 1]
+        u = numpy.column_stack([x ** 2, y ** 2, x, y, numpy.ones(len(x))])
+        v0 = u.dot(self.matrix.T)
+        w = v0[:, 2:3]
+        v = v0[:, :2] / w
+
+        # derivatives of the homogeneous vector with respect to x and y
+        m = self.matrix
+        dv0dx = numpy.outer(2 * x, m[:, 0]) + m[:, 2]
+        dv0dy = numpy.outer(2 * y, m[:, 1]) + m[:, 3]
+
+        jacobian = numpy.empty((len(x), 2, 2))
+        jacobian[:, :, 0] = (dv0dx[:, :2] - v * dv0dx[:, 2:3]) / w
+        jacobian[:, :, 1] = (dv0dy[:, :2] - v * dv0dy[:, 2:3]) / w
+        return v, jacobian
+
+    def _reverseOptimize(self, v, u0):
+        '''Slow but robust per-point inverse using the L-M optimizer.'''
+        umin = optimize(v,
+                        lambda u: numpy.array(self.forward(u)),
+                        numpy.array(u0))
+        return umin
+
     def reverse(self, vlist):
-        v = numpy.array(vlist)
- 
+        return self.reverseMany([vlist])[0].tolist()
+
+    def reverseMany(self, toPts):
+        '''Inverts the transform for an Nx2 array of points with a
+           vectorized Newton iteration. Any points where Newton fails to
+           converge fall back to the L-M optimizer.'''
+        v = numpy.asarray(toPts, dtype='float64')
+
         # to get a rough initial value, apply the inverse of the simpler
         # projective transform. this will give the exact answer if the
         # quadratic terms happen to be 0.
-        u0 = self.proj.reverse(vlist)
- 
-        # optimize to get an exact inverse.
-        umin = optimize(v,
-                        lambda u: numpy.array(self.forward(u)),
-                        numpy.array(u0))
- 
-        return umin.tolist()
+        u0 = self.proj.reverseMany(v)
+        u = u0.copy()
+
+        # active marks the points still being iterated
+        active = numpy.isfinite(u).all(axis=1)
+        for _ in xrange(self.NEWTON_MAX_ITERATIONS):
+            if not active.any():
+                break
+            index = numpy.flatnonzero(active)
+            vapprox, jacobian = self._forwardWithJacobianMany(u[index])
+            r = vapprox - v[index]
+
+            # solve the 2x2 system jacobian * delta = r for each point
+            a = jacobian[:, 0, 0]
+            b = jacobian[:, 0, 1]
+            c = jacobian[:, 1, 0]
+            d = jacobian[:, 1, 1]
+            det = a * d - b * c
+            delta = numpy.column_stack([(d * r[:, 0] - b * r[:, 1]) / det,
+                                        (a * r[:, 1] - c * r[:, 0]) / det])
+            u[index] -= delta
+
+            step = numpy.abs(delta).max(axis=1)
+            converged = step < self.NEWTON_TOLERANCE
+            diverged = ~numpy.isfinite(step)
+            active[index[converged | diverged]] = False
+            u[index[diverged]] = numpy.nan
+
+        # optimize to get an exact inverse where Newton didn't make it.
+        for i in numpy.flatnonzero(active | ~numpy.isfinite(u).all(axis=1)):
+            if numpy.isfinite(u0[i]).all():
+                u[i] = self._reverseOptimize(v[i], u0[i])
+
+        return u
  
     def getJsonDict(self):
         return {'type': 'quadratic',
@@ -448,6 +732,23 @@ class QuadraticTransform(Transform):
         params[10:12] = tmat[2, 0:2]
         return params
 
+    @classmethod
+    def jacobian(cls, params, fromPts):
+        tform = cls.fromParams(params)
+        x = fromPts[:, 0]
+        y = fromPts[:, 1]
+        u = numpy.column_stack([x ** 2, y ** 2, x, y, numpy.ones(len(x))])
+        v0 = u.dot(tform.matrix.T)
+        w = v0[:, 2:3]
+        v = v0[:, :2] / w
+
+        result = numpy.zeros((len(x), 2, 12))
+        result[:, 0, 0:5] = u / w
+        result[:, 1, 5:10] = u / w
+        result[:, :, 10] = -v * x[:, numpy.newaxis] / w
+        result[:, :, 11] = -v * y[:, numpy.newaxis] / w
+        return result.reshape((2 * len(x), 12))
+
 
 class QuadraticTransform2(Transform):
     '''TODO'''
@@ -506,6 +807,38 @@ class QuadraticTransform2(Transform):
 
         return [x, y]
 
+    def forwardMany(self, fromPts):
+        v1 = applyProjectiveMany(self.matrix, fromPts)
+        x = v1[:, 0]
+        y = v1[:, 1]
+        a, b, c, d = self.quadraticTerms
+
+        p = x + a * x * x
+        q = y + b * y * y
+        r = p + c * q * q
+        s = q + d * r * r
+
+        # correct for pre-conditioning
+        return numpy.column_stack([r, s]) * self.SCALE
+
+    def reverseMany(self, toPts):
+        if self.projInverse is None:
+            self.projInverse = getProjectiveInverse(self.matrix)
+
+        # correct for pre-conditioning
+        v = numpy.asarray(toPts, dtype='float64') / self.SCALE
+        r = v[:, 0]
+        s = v[:, 1]
+
+        a, b, c, d = self.quadraticTerms
+
+        q = s - d * r * r
+        p = r - c * q * q
+        x0 = solveQuadMany(a, p)
+        y0 = solveQuadMany(b, q)
+
+        return applyProjectiveMany(self.projInverse, numpy.column_stack([x0, y0]))
+
     def getJsonDict(self):
         return {'type': 'quadratic',
                 'matrix': self.matrix.tolist(),
@@ -525,6 +858,37 @@ class QuadraticTransform2(Transform):
         return numpy.append(tmat.flatten()[:8],
                             numpy.zeros(4))
 
+    @classmethod
+    def jacobian(cls, params, fromPts):
+        v1, projJacobian = projectiveJacobian(params, fromPts)
+        x = v1[:, 0]
+        y = v1[:, 1]
+        a, b, c, d = params[8:]
+
+        p = x + a * x * x
+        q = y + b * y * y
+        r = p + c * q * q
+
+        # chain rule through p, q, r, s in the same order as forward()
+        dp = numpy.zeros((len(x), 12))
+        dq = numpy.zeros((len(x), 12))
+        dp[:, :8] = (1 + 2 * a * x)[:, numpy.newaxis] * projJacobian[:, 0, :]
+        dq[:, :8] = (1 + 2 * b * y)[:, numpy.newaxis] * projJacobian[:, 1, :]
+        dp[:, 8] = x * x
+        dq[:, 9] = y * y
+
+        dr = dp + (2 * c * q)[:, numpy.newaxis] * dq
+        dr[:, 10] += q * q
+
+        ds = dq + (2 * d * r)[:, numpy.newaxis] * dr
+        ds[:, 11] += r * r
+
+        result = numpy.empty((len(x), 2, 12))
+        result[:, 0, :] = dr
+        result[:, 1, :] = ds
+        # correct for pre-conditioning
+        return result.reshape((2 * len(x), 12)) * cls.SCALE
+
 
 def makeTransform(transformDict):
     '''Make a transform from a specialized dictionary object'''
@@ -532,10 +896,11 @@ def makeTransform(transformDict):
     if transformType == 'CameraModelTransform': # Handle pinhole camera model case
         params  = transformDict['params' ]
         imageId = transformDict['imageId']
+        from geocamTiePoint.models import getIssImageMetadata  # avoid circular import
         mission, roll, frame = imageId.split('-')
-        issImage = ISSimage(mission, roll, frame, '')
-        return CameraModelTransform(params, issImage.extras.width, issImage.extras.height,
-                                    issImage.extras.focalLength[0], issImage.extras.focalLength[1])
+        extras = getIssImageMetadata(mission, roll, frame)
+        return CameraModelTransform(params, extras.width, extras.height,
+                                    extras.focalLength[0], extras.focalLength[1])
     else: # Handle all the matrix transform cases
         transformMatrix = numpy.array(transformDict['matrix'])
         if transformType == 'projective':
@@ -552,10 +917,7 @@ def makeTransform(transformDict):
 
 def forwardPts(tform, fromPts):
     '''Applies the provided forward transform to each of the input points.'''
-    toPts = numpy.zeros(fromPts.shape)
-    for i, pt in enumerate(fromPts):
-        toPts[i, :] = tform.forward(pt)
-    return toPts
+    return tform.forwardMany(fromPts)
 
 
 def getTransformClass(n):
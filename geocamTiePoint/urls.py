@@ -69,6 +69,12 @@ urlpatterns = [ ## New Workflow ##
                 url(r'^backend/overlay/(?P<key>\d+)/generateExport/$', views.overlayGenerateExport,
                     {}, 'geocamTiePoint_overlayGenerateExportBackend'),
             
+                url(r'^exportJob/(?P<jobId>\d+)\.json$', views.exportJobJson,
+                    {}, 'geocamTiePoint_exportJobJson'),
+
+                url(r'^exportJob/(?P<jobId>\d+)/cancel$', views.exportJobCancel,
+                    {}, 'geocamTiePoint_exportJobCancel'),
+
                 url(r'^overlay/(?P<key>\d+)/export/(?P<type>\w+)/(?P<fname>[^/]*)$', views.overlayExport,
                     {}, 'geocamTiePoint_overlayExport'),
                 
@@ -83,6 +89,14 @@ urlpatterns = [ ## New Workflow ##
                     views.dummyView,
                     {}, 'geocamTiePoint_tileRoot'),
             
+                url(r'^tile/(?P<quadTreeId>\d+)/batch$',
+                    views.getTileBatch,
+                    {}, 'geocamTiePoint_tileBatch'),
+
+                url(r'^public/tile/(?P<quadTreeId>\d+)/batch$',
+                    views.getPublicTileBatch,
+                    {}, 'geocamTiePoint_publicTileBatch'),
+            
                 url(r'^tile/(?P<quadTreeId>[^/]+)/\[ZOOM\]/\[X\]/\[Y\].png$',
                     views.getTile,
                     {}, 'geocamTiePoint_tile'),
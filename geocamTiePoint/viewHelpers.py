@@ -16,6 +16,7 @@
 
 import os
 import json
+import hashlib
 import time
 import glob
 import rfc822
@@ -41,7 +42,7 @@ from geocamUtil.ErrorJSONResponse import ErrorJSONResponse, checkIfErrorJSONResp
 from geocamUtil import registration as register
 from geocamUtil import imageInfo
 
-from geocamTiePoint.models import Overlay, QuadTree, ImageData, ISSimage
+from geocamTiePoint.models import Overlay, QuadTree, ImageData, ISSimage, ExportJob, getIssImageMetadata
 from django.conf import settings
 from geocamTiePoint import quadTree, transform, garbage
 from geocamTiePoint import anypdf as pdf
@@ -166,8 +167,11 @@ def saveImageToDatabase(PILimage, imageData, flags):
     if DISPLAY in flags:
         imageData.image.delete()
         imageData.image.save("dummy.png", ContentFile(convertedBits), save=False)
+        imageData.checksum = hashlib.sha1(convertedBits).hexdigest()
     imageData.contentType = 'image/png'
     imageData.save()
+    if DISPLAY in flags:
+        imageData.writeTiledRaster(PILimage)
     
 
 """
@@ -205,6 +209,7 @@ def createImageData(imageFile, sizeType):
             imageContent = convertedBits
             imageData.contentType = 'image/png'
         else:
+            imageContent = bits
             imageData.contentType = contentType
         if image:
             # save image width, height and sizeType
@@ -213,8 +218,11 @@ def createImageData(imageFile, sizeType):
             imageData.height = imageSize[1]
     
     imageData.image.save('dummy.png', ContentFile(imageContent), save=False)
+    imageData.checksum = hashlib.sha1(imageContent).hexdigest()
     imageData.unenhancedImage.save('dummy.png', ContentFile(imageContent), save=False)
     imageData.save()
+    if image:
+        imageData.writeTiledRaster(image)
     return imageData
 
 
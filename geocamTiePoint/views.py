@@ -14,11 +14,14 @@
 # specific language governing permissions and limitations under the License.
 #__END_LICENSE__
 
+import hashlib
+import struct
 from fileinput import filename
 
 from django.shortcuts import render_to_response
 from django.http import HttpResponse, HttpResponseRedirect, HttpResponseNotFound, JsonResponse
-from django.http import HttpResponseNotAllowed, Http404
+from django.http import HttpResponseNotAllowed, HttpResponseNotModified, HttpResponseBadRequest, Http404
+from django.utils.http import parse_etags, quote_etag
 from django.template import RequestContext
 from django.shortcuts import get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
@@ -34,7 +37,7 @@ from django.db.models.signals import pre_save, post_save, post_delete
 from django.db import transaction
 
 from geocamTiePoint.viewHelpers import *
-from geocamTiePoint import forms
+from geocamTiePoint import forms, tileCache, tileStore, tileWarmup
 from geocamUtil.icons import rotate
 from geocamUtil import imageInfo
 
@@ -183,12 +186,12 @@ def cameraModelTransformForward(request):
         params = data.getlist('params[]', None)
         issMRF = data.get('imageId', None)
         mission, roll, frame = issMRF.split('-')
-        issImage = ISSimage(mission, roll, frame, '')
+        extras = getIssImageMetadata(mission, roll, frame)
         # get the width and height from imageId
-        width = issImage.extras.width
-        height = issImage.extras.height
-        Fx = issImage.extras.focalLength[0]
-        Fy = issImage.extras.focalLength[1]
+        width = extras.width
+        height = extras.height
+        Fx = extras.focalLength[0]
+        Fy = extras.focalLength[1]
         # create a new transform and set its params, width, and height
         params = [float(param) for param in params]  # convert params from unicode to float.
         pt = [float(c) for c in pt]  # convert pt from unicode to float.
@@ -265,7 +268,11 @@ def overlayIdJson(request, key):
     """
     if request.method == 'GET':
         overlay = get_object_or_404(Overlay, key=key)
-        return HttpResponse(dumps(overlay.jsonDict), content_type='application/json')
+        # the dict pulls in fields of related objects, so hash the body
+        # itself. a 304 still saves sending it.
+        body = dumps(overlay.jsonDict)
+        return conditionalResponse(request, getEtag(body),
+                                   lambda: HttpResponse(body, content_type='application/json'))
     elif request.method in ('POST', 'PUT'):
         overlay = get_object_or_404(Overlay, key=key)
         overlay.jsonDict = json.loads(request.body)
@@ -273,14 +280,27 @@ def overlayIdJson(request, key):
         if transformDict:
             try: 
                 imageSize = [overlay.imageData.width, overlay.imageData.height]
-                overlay.extras.bounds = (quadTree.imageMapBounds
-                                         (imageSize,
-                                          transform.makeTransform(transformDict)))
+                # the footprint skips pixels that miss the ground, so a
+                # corner in the sky doesn't make the bounds NaN
+                bounds = (quadTree.imageFootprintBounds
+                          (imageSize,
+                           transform.makeTransform(transformDict)))
+                if bounds is not None:
+                    overlay.extras.bounds = bounds
                 overlay.generateAlignedQuadTree()
             except:
                 # could not generate aligned quad tree from opimized params
                 return HttpResponse(dumps(overlay.jsonDict), content_type='application/json')        
         overlay.save()
+        if transformDict and settings.GEOCAM_TIE_POINT_WARMUP_ENABLED:
+            # render the tiles the editor is about to ask for. the overlay
+            # is already saved, so a failed warm-up must not fail the request
+            try:
+                tileWarmup.startWarmup(overlay.key, overlay.alignedQuadTree.id,
+                                       overlay.extras.get('bounds'), getServedTileData)
+            except:  # pylint: disable=W0702
+                logging.exception('overlayIdJson: could not start tile warm-up for overlay %s',
+                                  overlay.key)
         return HttpResponse(dumps(overlay.jsonDict), content_type='application/json')
     elif request.method == 'DELETE':
         get_object_or_404(Overlay, pk=key).delete()
@@ -299,21 +319,83 @@ def overlayListJson(request):
 def overlayIdImageFileName(request, key, fileName):
     if request.method == 'GET':
         overlay = get_object_or_404(Overlay, key=key)
-        fobject = overlay.imageData.image.file
-        response = HttpResponse(fobject.read(), content_type=overlay.imageData.contentType)
-        return response
+        imageData = overlay.imageData
+
+        def getResponse():
+            # getChecksum() may have opened and closed the file already
+            imageData.image.open('rb')
+            try:
+                return HttpResponse(imageData.image.read(),
+                                    content_type=imageData.contentType)
+            finally:
+                imageData.image.close()
+
+        return conditionalResponse(request, getEtag(imageData.getChecksum()), getResponse)
     else:
         return HttpResponseNotAllowed(['GET'])
 
 
 def getTileData(quadTreeId, zoom, x, y):
+    useTileStore = settings.GEOCAM_TIE_POINT_TILE_STORE_ENABLED
+    if useTileStore:
+        basePath = QuadTree.getBasePathForId(quadTreeId)
+        data = tileStore.readTile(basePath, zoom, x, y)
+        if data is not None:
+            return data
     gen = QuadTree.getGeneratorWithCache(quadTreeId)
     try:
-        return gen.getTileData(zoom, x, y)
+        data = gen.getTileData(zoom, x, y)
     except quadTree.ZoomTooBig:
         return transparentPngData()
     except quadTree.OutOfBounds:
         return transparentPngData()
+    if useTileStore:
+        tileStore.writeTile(basePath, zoom, x, y, data)
+    return data
+
+
+def getEtag(*parts):
+    """
+    Returns a strong entity tag (unquoted) that changes whenever any of
+    @parts changes.
+    """
+    return hashlib.sha1('\n'.join([str(part) for part in parts])).hexdigest()
+
+
+def formatEtag(etag, weak=False):
+    if weak:
+        return 'W/' + quote_etag(etag)
+    return quote_etag(etag)
+
+
+def getNotModifiedResponse(request, etag, weak=False):
+    """
+    Returns a 304 Not Modified response if the If-None-Match header of
+    @request matches @etag, otherwise None.
+    """
+    ifNoneMatch = request.META.get('HTTP_IF_NONE_MATCH')
+    if ifNoneMatch:
+        etags = parse_etags(ifNoneMatch)
+        if etag in etags or '*' in etags:
+            response = HttpResponseNotModified()
+            response['ETag'] = formatEtag(etag, weak)
+            return response
+    return None
+
+
+def conditionalResponse(request, etag, getResponse):
+    """
+    Returns a 304 response if the client's copy matches @etag, otherwise
+    the response from @getResponse() with the ETag header set. Callers
+    compute @etag without reading the body, so a revalidation costs no
+    body bytes.
+    """
+    response = getNotModifiedResponse(request, etag)
+    if response is None:
+        response = getResponse()
+        if response.status_code == 200:
+            response['ETag'] = formatEtag(etag)
+    return response
 
 
 def neverExpires(response):
@@ -331,31 +413,132 @@ def neverExpires(response):
     return response
 
 
+def getServedTileCacheKey(quadTreeId, zoom, x, y, contentId=None):
+    """
+    Returns the cache key of a served tile. Pass the quadtree's
+    @contentId if it is already known, to skip looking it up.
+    """
+    if contentId is None:
+        contentId = QuadTree.getTileContentIdWithCache(quadTreeId)
+    return quadTree.getTileCacheKey(contentId, zoom, x, y,
+                                    settings.GEOCAM_TIE_POINT_TILE_QUALITY)
+
+
+def getCarriedOverTile(quadTreeId, zoom, x, y):
+    """
+    Returns the cached tile of a quadtree that @quadTreeId replaced, if
+    the alignment change moves no pixel of the tile by more than
+    GEOCAM_TIE_POINT_DELTA_RENDER_MAX_DISPLACEMENT_PIXELS, as a (data,
+    ancestorKey) pair where ancestorKey is the tile cache key of the
+    replaced quadtree's tile. Otherwise returns (None, None).
+    """
+    ancestors = QuadTree.getAncestors(quadTreeId)
+    if not ancestors:
+        return None, None
+    newTransform = QuadTree.getGeneratorWithCache(quadTreeId).transform
+    for ancestor in ancestors:
+        displacement = quadTree.getMaxTileDisplacement(transform.makeTransform(ancestor['transform']),
+                                                       newTransform, zoom, x, y)
+        if displacement > settings.GEOCAM_TIE_POINT_DELTA_RENDER_MAX_DISPLACEMENT_PIXELS:
+            continue
+        ancestorKey = quadTree.getTileCacheKey(ancestor['contentId'],
+                                               zoom, x, y,
+                                               settings.GEOCAM_TIE_POINT_TILE_QUALITY)
+        data = tileCache.getCachedTileData(ancestorKey)
+        if data is None and settings.GEOCAM_TIE_POINT_TILE_STORE_ENABLED:
+            data = tileStore.readTile(QuadTree.getBasePathForId(ancestor['quadTreeId']),
+                                      zoom, x, y)
+        if data is not None:
+            return data, ancestorKey
+    return None, None
+
+
+def getUncachedServedTile(quadTreeId, zoom, x, y, key):
+    """
+    Returns the tile to serve for a miss on tile cache @key as a (data,
+    carriedOverKey) pair. The tile is carried over from a replaced
+    quadtree if possible (carriedOverKey is then its cache key),
+    otherwise it is rendered and cached under @key (carriedOverKey is
+    None).
+    """
+    if settings.GEOCAM_TIE_POINT_DELTA_RENDER_ENABLED:
+        # carried over tiles are not cached under the new key, so a later
+        # quadtree compares against the transform they were rendered with
+        data, carriedOverKey = getCarriedOverTile(quadTreeId, zoom, x, y)
+        if data is not None:
+            return data, carriedOverKey
+    data = getTileData(quadTreeId, zoom, x, y)
+    tileCache.setTileData(key, data)
+    return data, None
+
+
+def getServedTile(quadTreeId, zoom, x, y, key=None):
+    """
+    Returns the tile to serve as a (data, carriedOverKey) pair. See
+    getUncachedServedTile(). @key is the tile's cache key, if the caller
+    already has it.
+    """
+    if key is None:
+        key = getServedTileCacheKey(quadTreeId, zoom, x, y)
+    data = tileCache.getCachedTileData(key)
+    if data is not None:
+        return data, None
+    return getUncachedServedTile(quadTreeId, zoom, x, y, key)
+
+
+def getServedTileData(quadTreeId, zoom, x, y):
+    return getServedTile(quadTreeId, zoom, x, y)[0]
+
+
+def conditionalTileResponse(request, keys, getResponse):
+    """
+    Like conditionalResponse(), for a response holding the tiles cached
+    under @keys. @getResponse() returns the response and the cache keys
+    of any carried over tiles in it. Carried over tiles will later be
+    replaced by a real render with different bytes, so those responses
+    get a weak etag naming the carried over tiles and no far-future
+    Expires header.
+    """
+    # the cache keys name the tile content, so they also make a good etag
+    etag = getEtag(*keys)
+    response = getNotModifiedResponse(request, etag)
+    if response is not None:
+        return neverExpires(response)
+    response, carriedOverKeys = getResponse()
+    if response.status_code != 200:
+        return response
+    if not carriedOverKeys:
+        response['ETag'] = formatEtag(etag)
+        return neverExpires(response)
+    weakEtag = getEtag(*(list(keys) + list(carriedOverKeys)))
+    notModified = getNotModifiedResponse(request, weakEtag, weak=True)
+    if notModified is not None:
+        return notModified
+    response['ETag'] = formatEtag(weakEtag, weak=True)
+    return response
+
+
 def getTile(request, quadTreeId, zoom, x, y):
     quadTreeId = int(quadTreeId)
     zoom = int(zoom)
     x = int(x)
     y = int(os.path.splitext(y)[0])
     
-    key = quadTree.getTileCacheKey(quadTreeId, zoom, x, y)
-    data = cache.get(key)
-    if data is None:
-        logging.info('\ngetTile MISS %s\n', key)
-        data = getTileData(quadTreeId, zoom, x, y)
-        cache.set(key, data)
-    else:
-        logging.info('getTile hit %s', key)
+    key = getServedTileCacheKey(quadTreeId, zoom, x, y)
 
-    bits, contentType = data
-    response = HttpResponse(bits, content_type=contentType)
-    return neverExpires(response)
+    def getResponse():
+        (bits, contentType), carriedOverKey = getServedTile(quadTreeId, zoom, x, y, key)
+        carriedOverKeys = [carriedOverKey] if carriedOverKey else []
+        return HttpResponse(bits, content_type=contentType), carriedOverKeys
 
+    return conditionalTileResponse(request, [key], getResponse)
 
-def getPublicTile(request, quadTreeId, zoom, x, y):
+
+def isQuadTreePublic(quadTreeId):
     cacheKey = 'geocamTiePoint.QuadTree.isPublic.%s' % quadTreeId
     quadTreeIsPublic = cache.get(cacheKey)
     if quadTreeIsPublic is None:
-        logging.info('getPublicTile MISS %s', cacheKey)
+        logging.info('isQuadTreePublic MISS %s', cacheKey)
         try:
             q = QuadTree.objects.get(id=quadTreeId)
             overlay = q.alignedOverlays.get()
@@ -367,15 +550,84 @@ def getPublicTile(request, quadTreeId, zoom, x, y):
             quadTreeIsPublic = False
         cache.set(cacheKey, quadTreeIsPublic, 60)
     else:
-        logging.info('getPublicTile hit %s', cacheKey)
+        logging.info('isQuadTreePublic hit %s', cacheKey)
+    return quadTreeIsPublic
+
 
-    if quadTreeIsPublic:
+def getPublicTile(request, quadTreeId, zoom, x, y):
+    if isQuadTreePublic(quadTreeId):
         return getTile(request, quadTreeId, zoom, x, y)
     else:
         return HttpResponseNotFound('QuadTree %s does not exist or is not public'
                                     % quadTreeId)
 
 
+def parseTileList(tileList):
+    """
+    Parses a tile list of the form 'zoom/x/y,zoom/x/y,...' into a list
+    of (zoom, x, y) tuples. Raises ValueError if it is malformed.
+    """
+    tiles = []
+    for tile in tileList.split(','):
+        zoom, x, y = [int(v) for v in tile.split('/')]
+        tiles.append((zoom, x, y))
+    return tiles
+
+
+def getTileBatch(request, quadTreeId):
+    """
+    Returns many tiles of a quadtree in one response. The tiles are
+    listed in the 'tiles' query parameter as 'zoom/x/y,zoom/x/y,...'.
+    The response body holds the tiles in the same order. Each tile is a
+    header of two big-endian unsigned ints, the lengths of its content
+    type and of its image data, followed by the content type and the
+    image data.
+    """
+    quadTreeId = int(quadTreeId)
+    try:
+        tiles = parseTileList(request.GET.get('tiles', ''))
+    except ValueError:
+        return HttpResponseBadRequest("expected tiles=zoom/x/y,zoom/x/y,...")
+    if len(tiles) > settings.GEOCAM_TIE_POINT_TILE_BATCH_MAX_TILES:
+        return HttpResponseBadRequest('at most %d tiles per batch'
+                                      % settings.GEOCAM_TIE_POINT_TILE_BATCH_MAX_TILES)
+    contentId = QuadTree.getTileContentIdWithCache(quadTreeId)
+    keys = [getServedTileCacheKey(quadTreeId, zoom, x, y, contentId) for zoom, x, y in tiles]
+
+    def getResponse():
+        # misses take the same carry over or render path as getTile()
+        carriedOverKeys = {}
+
+        def getUncachedData(key, tile):
+            zoom, x, y = tile
+            data, carriedOverKey = getUncachedServedTile(quadTreeId, zoom, x, y, key)
+            if carriedOverKey:
+                carriedOverKeys[key] = carriedOverKey
+            return data
+
+        items = [(key, lambda key=key, tile=tile: getUncachedData(key, tile))
+                 for key, tile in zip(keys, tiles)]
+        chunks = []
+        for bits, contentType in tileCache.getManyTileData(items,
+                                                           settings.GEOCAM_TIE_POINT_TILE_BATCH_THREADS,
+                                                           store=False):
+            chunks.append(struct.pack('>II', len(contentType), len(bits)))
+            chunks.append(contentType)
+            chunks.append(bits)
+        return (HttpResponse(''.join(chunks), content_type='application/octet-stream'),
+                [carriedOverKeys[key] for key in keys if key in carriedOverKeys])
+
+    return conditionalTileResponse(request, keys, getResponse)
+
+
+def getPublicTileBatch(request, quadTreeId):
+    if isQuadTreePublic(quadTreeId):
+        return getTileBatch(request, quadTreeId)
+    else:
+        return HttpResponseNotFound('QuadTree %s does not exist or is not public'
+                                    % quadTreeId)
+
+
 def dummyView(*args, **kwargs):
     return HttpResponseNotFound()
 
@@ -399,6 +651,16 @@ def overlayGenerateExport(request, key, type):
                 return HttpResponse('{"result": "ok"}',
                                     content_type='application/json')
         overlay = get_object_or_404(Overlay, key=key)
+        if settings.GEOCAM_TIE_POINT_EXPORT_QUEUE_ENABLED:
+            # a worker process generates the export. the client polls
+            # the job url for progress.
+            try:
+                job = ExportJob.submit(overlay, type)
+            except ValueError:
+                return HttpResponse('{"result": "error! Export type invalid."}',
+                                    content_type='application/json')
+            return HttpResponse(dumps({'result': 'ok', 'job': job.getJsonDict()}),
+                                content_type='application/json')
         if type == 'html':
             overlay.generateHtmlExport()
         elif type == 'kml':
@@ -415,6 +677,26 @@ def overlayGenerateExport(request, key, type):
         return HttpResponseNotAllowed(['GET', 'POST'])
 
 
+def exportJobJson(request, jobId):
+    if request.method == 'GET':
+        job = get_object_or_404(ExportJob, id=jobId)
+        return HttpResponse(dumps(job.getJsonDict()), content_type='application/json')
+    else:
+        return HttpResponseNotAllowed(['GET'])
+
+
+@csrf_exempt
+def exportJobCancel(request, jobId):
+    if request.method == 'POST':
+        job = get_object_or_404(ExportJob, id=jobId)
+        cancelled = job.cancel()
+        job = ExportJob.objects.get(id=job.id)
+        return HttpResponse(dumps(job.getJsonDict()), content_type='application/json',
+                            status=200 if cancelled else 409)
+    else:
+        return HttpResponseNotAllowed(['POST'])
+
+
 def overlayExport(request, key, type, fname):
     """
     Displays the generated exports.
@@ -424,18 +706,23 @@ def overlayExport(request, key, type, fname):
         if type == 'html': 
             if not (overlay.alignedQuadTree and overlay.alignedQuadTree.htmlExport):
                 raise Http404('no export archive generated for requested overlay yet')
-            return HttpResponse(overlay.alignedQuadTree.htmlExport.file.read(),
-                                content_type='application/x-tgz')
+            exportFile = overlay.alignedQuadTree.htmlExport
         elif type == 'kml':
             if not (overlay.alignedQuadTree and overlay.alignedQuadTree.kmlExport):
                 raise Http404('no export archive generated for requested overlay yet')
-            return HttpResponse(overlay.alignedQuadTree.kmlExport.file.read(),
-                                content_type='application/x-tgz')
+            exportFile = overlay.alignedQuadTree.kmlExport
         elif type == 'geotiff':
             if not (overlay.alignedQuadTree and overlay.alignedQuadTree.geotiffExport):
                 raise Http404('no export archive generated for requested overlay yet')
-            return HttpResponse(overlay.alignedQuadTree.geotiffExport.file.read(),
-                                content_type='application/x-tgz')
+            exportFile = overlay.alignedQuadTree.geotiffExport
+        else:
+            raise Http404('unknown export type %s' % type)
+        # each regenerated export is saved under a new timestamped file
+        # name, so the quadtree id and file name identify its contents
+        return conditionalResponse(request,
+                                   getEtag(overlay.alignedQuadTree.id, exportFile.name),
+                                   lambda: HttpResponse(exportFile.file.read(),
+                                                        content_type='application/x-tgz'))
     else:
         return HttpResponseNotAllowed(['GET'])
 